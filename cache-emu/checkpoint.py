@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+"""Checkpoints of a 'Cache', so that long experiments can be saved and
+   resumed later instead of replaying the whole trace from the start.
+
+   A checkpoint holds the configuration of the cache, its counters and
+   the arrays of its 'CacheState' (tags, validity, dirtiness, the policy
+   stamps and the clock of every set) as they are in memory, compressed
+   with zlib since most of it is usually zeros or small numbers. Sets
+   which are indexed are rebuilt from the state when restored, and the
+   'Instruments' are saved too if the cache has them. The references
+   given to 'Cache.plan' are not, and have to be planned again.
+
+   The layout is a little-endian header followed by the arrays:
+
+       magic   'CEMU' and a version byte
+       config  partition_size, partitions, ways, word_size, seed (4 × u64, i64)
+       flags   indexed, write-back, write-allocate, instrument (4 × u8)
+       policy  length (u8) and its name (empty for direct mapping)
+       stats   hits, misses, bytes read and written, writebacks, the
+               references accessed so far and the 'drrip' counter (7 × u64)
+       last    hit (u8, 2 if none), line and evicted (i64, -1 if none)
+       arrays  every array as its size in bytes (u64) and then its data
+"""
+import struct
+import sys
+import zlib
+from array import array
+
+from memory import Cache
+
+
+MAGIC = b'CEMU'
+VERSION = 1
+
+_CONFIG = struct.Struct('<4QqBBBB')
+_STATS = struct.Struct('<7Q')
+_LAST = struct.Struct('<Bqq')
+_COUNTERS = struct.Struct('<3Q')
+_SIZE = struct.Struct('<Q')
+
+# The arrays of a 'CacheState' and 'Instruments', in the order saved
+_STATE = ('tags', 'valid', 'dirty', 'usecount', 'lastuse', 'firstuse',
+          'nextuse', 'clock', 'bits', 'aux')
+_INSTRUMENTS = ('set_accesses', 'set_misses', 'evictions', 'lifetimes')
+
+
+def _put(out, data):
+    """Writes an array (or bytes) prefixed by its size"""
+    if isinstance(data, array) and data.itemsize > 1 \
+            and sys.byteorder != 'little':
+        data = array(data.typecode, data)
+        data.byteswap()
+    data = bytes(data)
+    out.append(_SIZE.pack(len(data)))
+    out.append(data)
+
+
+def _get(data, pos):
+    """Reads the data written by '_put', returning (data, next pos)"""
+    size, = _SIZE.unpack_from(data, pos)
+    pos += _SIZE.size
+    return data[pos:pos + size], pos + size
+
+
+def _into(target, data):
+    """Fills the array (or bytearray) 'target' with the given data"""
+    if isinstance(target, bytearray):
+        target[:] = data
+        return
+    values = array(target.typecode)
+    values.frombytes(data)
+    if values.itemsize > 1 and sys.byteorder != 'little':
+        values.byteswap()
+    if len(values) != len(target):
+        raise ValueError('The checkpoint does not fit the cache')
+    target[:] = values
+
+
+def _dump(cache, out):
+    policy = (cache.policy or '').encode('ascii')
+    out.append(MAGIC + bytes([VERSION]))
+    out.append(_CONFIG.pack(
+        cache.partition_size, cache.partitions, cache.ways,
+        cache.word_size, cache.seed, cache.indexed, cache.write_back,
+        cache.write_allocate, cache.instrument))
+    out.append(bytes([len(policy)]) + policy)
+    out.append(_STATS.pack(cache.hits, cache.misses, cache.bytes_read,
+                           cache.bytes_written, cache.writebacks,
+                           cache.position,
+                           getattr(cache.replacement, 'psel', 0)))
+
+    hit, line = cache.last_access
+    out.append(_LAST.pack(2 if hit is None else hit,
+                          -1 if line is None else line,
+                          -1 if cache.evicted is None else cache.evicted))
+
+    for name in _STATE:
+        _put(out, getattr(cache.state, name))
+
+    instruments = cache.instruments
+    if instruments is not None:
+        out.append(_COUNTERS.pack(instruments.compulsory,
+                                  instruments.capacity,
+                                  instruments.conflict))
+        for name in _INSTRUMENTS:
+            _put(out, getattr(instruments, name))
+        _put(out, array('q', sorted(instruments.seen)))
+        shadow = []
+        _dump(instruments.shadow, shadow)
+        _put(out, b''.join(shadow))
+
+
+def _load(data, pos=0):
+    """Loads the cache found at 'pos', returning (cache, next pos)"""
+    if data[pos:pos + len(MAGIC)] != MAGIC:
+        raise ValueError('Not a cache checkpoint')
+    pos += len(MAGIC)
+    if data[pos] != VERSION:
+        raise ValueError('Unsupported checkpoint version: {}'
+                         .format(data[pos]))
+    pos += 1
+
+    (psize, partc, wayc, word_size, seed,
+     indexed, write_back, write_allocate, instrument) = \
+        _CONFIG.unpack_from(data, pos)
+    pos += _CONFIG.size
+    length = data[pos]
+    policy = data[pos + 1:pos + 1 + length].decode('ascii') or None
+    pos += 1 + length
+
+    cache = Cache(psize, partc, wayc, policy, indexed=bool(indexed),
+                  write_policy='write-back' if write_back
+                  else 'write-through',
+                  write_allocate=bool(write_allocate), word_size=word_size,
+                  instrument=bool(instrument), seed=seed)
+
+    (cache.hits, cache.misses, cache.bytes_read, cache.bytes_written,
+     cache.writebacks, cache.position, psel) = _STATS.unpack_from(data, pos)
+    pos += _STATS.size
+    if hasattr(cache.replacement, 'psel'):
+        cache.replacement.psel = psel
+
+    hit, line, evicted = _LAST.unpack_from(data, pos)
+    pos += _LAST.size
+    cache.last_access = (None if hit == 2 else bool(hit),
+                         None if line == -1 else line)
+    cache.evicted = None if evicted == -1 else evicted
+
+    for name in _STATE:
+        values, pos = _get(data, pos)
+        _into(getattr(cache.state, name), values)
+
+    if cache.index:
+        for s, index in enumerate(cache.index):
+            index.load(cache.state, s * cache.ways)
+
+    if cache.instrument:
+        instruments = cache.instruments
+        (instruments.compulsory, instruments.capacity,
+         instruments.conflict) = _COUNTERS.unpack_from(data, pos)
+        pos += _COUNTERS.size
+        for name in _INSTRUMENTS:
+            values, pos = _get(data, pos)
+            _into(getattr(instruments, name), values)
+        values, pos = _get(data, pos)
+        seen = array('q')
+        seen.frombytes(values)
+        if sys.byteorder != 'little':
+            seen.byteswap()
+        instruments.seen = set(seen)
+        values, pos = _get(data, pos)
+        instruments.shadow, _ = _load(values)
+
+    return cache, pos
+
+
+def dumps(cache, level=1):
+    """Returns the checkpoint of the cache as bytes, compressed with the
+       given zlib level (0 to leave it uncompressed)
+    """
+    out = []
+    _dump(cache, out)
+    return zlib.compress(b''.join(out), level)
+
+
+def loads(data):
+    """Returns a new cache restored from the checkpoint bytes"""
+    cache, _ = _load(zlib.decompress(data))
+    return cache
+
+
+def save(cache, path, level=1):
+    """Saves the checkpoint of the cache to the file at 'path'"""
+    with open(path, 'wb') as f:
+        f.write(dumps(cache, level))
+
+
+def load(path):
+    """Restores the cache saved to the file at 'path'"""
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+if __name__ == '__main__':
+    import random
+
+    refs = [random.randrange(1 << 14) for _ in range(200000)]
+    for args in [(4, 64), (4, 64, 4, 'lru'), (4, 64, 64, 'lfu'),
+                 (4, 64, 8, 'fifo')]:
+        whole = Cache(*args, instrument=True)
+        whole.replay(refs)
+
+        half = Cache(*args, instrument=True)
+        half.replay(refs[:len(refs) // 2])
+        data = dumps(half)
+        resumed = loads(data)
+        resumed.replay(refs[len(refs) // 2:])
+
+        same = (whole.hits, whole.misses, whole.state.tags.tolist(),
+                str(whole.instruments)) == \
+               (resumed.hits, resumed.misses, resumed.state.tags.tolist(),
+                str(resumed.instruments))
+        print(whole, 'checkpoint of', len(data), 'bytes, resumed',
+              'equally' if same else 'DIFFERENTLY')
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+"""Several cores, each with its own private 'Cache', sharing a last level
+   cache and keeping their copies coherent with a snooping protocol.
+
+   The states of a block on a private cache are:
+   * 'M' (modified)  : the only copy, and dirty.
+   * 'O' (owned)     : dirty, but other cores may have it too (as shared)
+                       and this one answers for it ('moesi' only).
+   * 'E' (exclusive) : the only copy, and clean, so it can be written to
+                       without telling anyone.
+   * 'S' (shared)    : other cores may have it too.
+   And blocks which are not present are invalid.
+
+   Reading a block that another core has dirty ('M' or 'O') transfers it
+   straight from that core's cache. Under 'mesi' the block is also written
+   back to the last level cache and both end up sharing it, while under
+   'moesi' the owner keeps it dirty as 'O' and nothing is written back.
+   Any other miss reads the block from the last level cache. Writing a
+   block invalidates every other copy of it.
+
+   Misses caused by another core invalidating the block are classified as
+   true sharing, if the word accessed was written by another core since,
+   or false sharing otherwise (the cores only happened to use different
+   words of the same block), and counted per block.
+
+   The last level cache is non-inclusive: evicting a block from it does
+   not affect the private caches.
+"""
+from collections import defaultdict
+
+from memory import Cache
+
+
+PROTOCOLS = ('mesi', 'moesi')
+
+
+class Multicore:
+    def __init__(self, cores, llc, protocol='mesi'):
+        """cores    = list with the private 'Cache' of every core
+           llc      = the shared last level 'Cache'
+           protocol = coherence protocol, see 'PROTOCOLS'
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError('Unknown protocol given: '+protocol)
+
+        if not cores:
+            raise ValueError('At least one core is required')
+
+        if len({c.partition_size for c in cores} | {llc.partition_size}) != 1:
+            raise ValueError('All the caches must have the same '
+                             'partition size')
+
+        for c in cores:
+            if not c.write_back or not c.write_allocate:
+                raise ValueError('Private caches must be write-back and '
+                                 'write-allocate')
+
+        self.cores = list(cores)
+        self.llc = llc
+        self.protocol = protocol
+        self.partition_size = llc.partition_size
+        self._clear()
+
+    def _clear(self):
+        # Block to state, for every core
+        self.states = [{} for _ in self.cores]
+        # Block to the words written by other cores since it was
+        # invalidated, for every core
+        self.invalidated = [{} for _ in self.cores]
+
+        self.invalidations = 0
+        self.transfers = 0
+        self.writebacks = 0
+        self.upgrades = 0
+        # Block to [invalidations, transfers, true sharing, false sharing]
+        self.blocks = defaultdict(lambda: [0, 0, 0, 0])
+
+    def reset(self):
+        """Resets every cache and the counters"""
+        for c in self.cores:
+            c.reset()
+        self.llc.reset()
+        self._clear()
+
+    def _writeback(self, address):
+        """Writes a dirty block back to the last level cache"""
+        self.writebacks += 1
+        self.llc.access(address, write=True)
+
+    def _evicted(self, core):
+        """Forgets the block the core just evicted, if any"""
+        address = self.cores[core].evicted
+        if address is None:
+            return
+        state = self.states[core].pop(address // self.partition_size)
+        if state in 'MO':
+            self._writeback(address)
+
+    def _invalidate(self, core, block, ref, dirty):
+        """Invalidates the block (holding 'ref') on the core. If it was
+           dirty, its data was passed on and it's not written back.
+        """
+        cache = self.cores[core]
+        if dirty:
+            s, line = cache._line_of(ref)
+            cache.state.dirty[line] = False
+        cache.invalidate(ref)
+        del self.states[core][block]
+        self.invalidated[core][block] = set()
+        self.invalidations += 1
+        self.blocks[block][0] += 1
+
+    def _classify(self, core, block, word):
+        """Classifies the miss of a core on a block, if it was caused by
+           another core invalidating it
+        """
+        written = self.invalidated[core].pop(block, None)
+        if written is not None:
+            self.blocks[block][2 if word in written else 3] += 1
+
+    def _written(self, core, block, word):
+        """Remembers that the core wrote the word of the block"""
+        for other, invalidated in enumerate(self.invalidated):
+            if other != core:
+                written = invalidated.get(block)
+                if written is not None:
+                    written.add(word)
+
+    def access(self, core, ref, write=False):
+        """Accesses the reference from the given core, returning where the
+           data came from: 'hit', 'transfer' (from another core), 'llc'
+           or 'memory'
+        """
+        block, word = divmod(ref, self.partition_size)
+        states = self.states[core]
+        cache = self.cores[core]
+        state = states.get(block)
+        if state is not None:
+            cache.access(ref, write=write)
+            if write and state != 'M':
+                if state in 'SO':
+                    self.upgrades += 1
+                    for other, others in enumerate(self.states):
+                        if other != core and block in others:
+                            self._invalidate(other, block, ref,
+                                             others[block] in 'MO')
+                states[block] = 'M'
+            if write:
+                self._written(core, block, word)
+            return 'hit'
+
+        self._classify(core, block, word)
+        owner = None
+        sharers = []
+        for other, others in enumerate(self.states):
+            if other != core and block in others:
+                sharers.append(other)
+                if others[block] in 'MO':
+                    owner = other
+
+        if owner is not None:
+            source = 'transfer'
+            self.transfers += 1
+            self.blocks[block][1] += 1
+        else:
+            self.llc.access(ref)
+            source = 'llc' if self.llc.last_access[0] else 'memory'
+
+        if write:
+            for other in sharers:
+                self._invalidate(other, block, ref, other == owner)
+            self._written(core, block, word)
+            states[block] = 'M'
+        elif not sharers:
+            states[block] = 'E'
+        else:
+            states[block] = 'S'
+            for other in sharers:
+                others = self.states[other]
+                if others[block] == 'M' and self.protocol == 'moesi':
+                    others[block] = 'O'
+                elif others[block] == 'M':
+                    # The block is clean everywhere once written back
+                    self._writeback(block * self.partition_size)
+                    c = self.cores[other]
+                    c.state.dirty[c._line_of(ref)[1]] = False
+                    others[block] = 'S'
+                elif others[block] == 'E':
+                    others[block] = 'S'
+
+        cache.access(ref, write=write)
+        self._evicted(core)
+        return source
+
+    def access_all(self, accesses):
+        """Accesses all the (core, ref, write) accesses in order, where
+           'write' may be left out for reads
+        """
+        for access in accesses:
+            self.access(*access)
+
+    def false_sharing(self, top=None):
+        """Returns (address, false sharing misses, true sharing misses) for
+           the blocks with the most false sharing, only those which had any
+        """
+        result = sorted(((b * self.partition_size, s[3], s[2])
+                         for b, s in self.blocks.items() if s[3]),
+                        key=lambda x: (-x[1], x[0]))
+        return result[:top] if top else result
+
+    def __str__(self):
+        lines = ['Multicore(protocol="{}", invalidations={}, transfers={}, '
+                 'writebacks={}, upgrades={})'.format(
+                     self.protocol, self.invalidations, self.transfers,
+                     self.writebacks, self.upgrades)]
+        for i, c in enumerate(self.cores):
+            lines.append('  Core {}: {}'.format(i, c))
+        lines.append('  LLC: {}'.format(self.llc))
+        return '\n'.join(lines)
+
+
+def interleave(*traces, writes=None):
+    """Yields (core, ref, write) accesses from the trace of every core,
+       taking one reference from each in turn until they run out.
+       'writes' may tell which references are writes on every trace.
+    """
+    iters = [iter(t) for t in traces]
+    witers = [iter(w) for w in writes] if writes is not None else None
+    active = list(range(len(iters)))
+    while active:
+        for core in list(active):
+            try:
+                ref = next(iters[core])
+            except StopIteration:
+                active.remove(core)
+                continue
+            write = bool(next(witers[core])) if witers else False
+            yield core, int(ref), write
+
+
+if __name__ == '__main__':
+    # Every core increments its own counter, all of them in the same block,
+    # and then reads everyone else's counters
+    cores = 4
+    for protocol in PROTOCOLS:
+        m = Multicore([Cache(8, 64, 4, 'lru') for _ in range(cores)],
+                      Cache(8, 1024, 8, 'lru'), protocol)
+        for _ in range(100):
+            for core in range(cores):
+                m.access(core, 1024 + core, write=True)
+            for core in range(cores):
+                m.access(core, 1024 + (core + 1) % cores)
+        print(m)
+        for address, false, true in m.false_sharing():
+            print('  Block at {}: {} false sharing and {} true sharing misses'
+                  .format(address, false, true))
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""Structured events of the accesses a 'Cache' makes, for anything that
+   wants to follow them without the cost of formatting and printing them.
+
+   Observers are callables given to 'Cache.observe', which are called after
+   every access with (position, ref, set, way, hit, write, victim, reason):
+   * position : how many references were accessed before this one.
+   * set, way : where the block was found or placed (way -1 if a write
+                missed and was not allocated).
+   * victim   : address of the block evicted by the access, or -1.
+   * reason   : 'HIT', 'FILLED' (an empty way), 'EVICTED' (the policy chose
+                a block to evict) or 'BYPASSED' (a write that missed and
+                was not allocated).
+   Nothing is done on the accesses of caches without observers, and caches
+   with observers replay their references one by one so that they see every
+   access.
+
+   Two observers keep the events compactly, which can be read back later as
+   'Event' tuples:
+   * 'EventRing' : the last 'capacity' events, in preallocated arrays.
+   * 'EventLog'  : every event, appended to a binary file in blocks and
+                   decoded with 'read_events'.
+"""
+import struct
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+Event = namedtuple('Event', 'position ref set way hit write victim reason')
+
+# Why an access placed the block where it did
+HIT = 0
+FILLED = 1
+EVICTED = 2
+BYPASSED = 3
+
+REASONS = ('hit', 'filled an empty way', 'evicted a block',
+           'bypassed on a write')
+
+_MAGIC = b'CEVT'
+_VERSION = 1
+
+# position, ref, set, way, victim and flags (hit, write, and the reason)
+_EVENT = struct.Struct('<QqqqqB')
+
+
+def _flags(hit, write, reason):
+    return hit | write << 1 | reason << 2
+
+
+def _event(position, ref, s, way, victim, flags):
+    return Event(position, ref, s, way, bool(flags & 1), bool(flags & 2),
+                 victim, flags >> 2)
+
+
+def describe(event):
+    """Returns a line telling what happened on the event"""
+    if event.hit:
+        text = 'Hit for {} on set {} at way {}'
+    elif event.reason == BYPASSED:
+        text = 'Miss for {}, written through without allocating'
+    else:
+        text = 'Miss for {} on set {} using way {}'
+    text = text.format(event.ref, event.set, event.way)
+    if event.victim != -1:
+        text += ', evicting the block at {}'.format(event.victim)
+    return text
+
+
+class EventRing:
+    def __init__(self, capacity=65536):
+        """capacity = how many of the last events are kept"""
+        if capacity < 1:
+            raise ValueError('The capacity must be at least 1')
+        self.capacity = capacity
+        self.positions = array('Q', bytes(8 * capacity))
+        self.refs = array('q', bytes(8 * capacity))
+        self.sets = array('q', bytes(8 * capacity))
+        self.ways = array('q', bytes(8 * capacity))
+        self.victims = array('q', bytes(8 * capacity))
+        self.flags = bytearray(capacity)
+        self.count = 0
+
+    def __call__(self, position, ref, s, way, hit, write, victim, reason):
+        i = self.count % self.capacity
+        self.positions[i] = position
+        self.refs[i] = ref
+        self.sets[i] = s
+        self.ways[i] = way
+        self.victims[i] = victim
+        self.flags[i] = _flags(hit, write, reason)
+        self.count += 1
+
+    def clear(self):
+        """Forgets every event (the arrays are kept)"""
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def dropped(self):
+        """How many events were overwritten by newer ones"""
+        return self.count - len(self)
+
+    def _order(self):
+        """The slots of the events kept, oldest first"""
+        if self.count <= self.capacity:
+            return range(self.count)
+        start = self.count % self.capacity
+        return [*range(start, self.capacity), *range(start)]
+
+    def __iter__(self):
+        for i in self._order():
+            yield _event(self.positions[i], self.refs[i], self.sets[i],
+                         self.ways[i], self.victims[i], self.flags[i])
+
+    def arrays(self):
+        """Returns the fields of the events kept, oldest first, as NumPy
+           arrays if available
+        """
+        order = self._order()
+        if np is not None:
+            order = np.asarray(order, dtype=np.int64)
+            flags = np.frombuffer(self.flags, dtype=np.uint8)[order]
+            return {
+                'position': np.frombuffer(self.positions,
+                                          dtype=np.uint64)[order],
+                'ref': np.frombuffer(self.refs, dtype=np.int64)[order],
+                'set': np.frombuffer(self.sets, dtype=np.int64)[order],
+                'way': np.frombuffer(self.ways, dtype=np.int64)[order],
+                'hit': (flags & 1).astype(bool),
+                'write': (flags & 2).astype(bool),
+                'victim': np.frombuffer(self.victims, dtype=np.int64)[order],
+                'reason': flags >> 2,
+            }
+
+        flags = [self.flags[i] for i in order]
+        return {
+            'position': array('Q', (self.positions[i] for i in order)),
+            'ref': array('q', (self.refs[i] for i in order)),
+            'set': array('q', (self.sets[i] for i in order)),
+            'way': array('q', (self.ways[i] for i in order)),
+            'hit': [bool(f & 1) for f in flags],
+            'write': [bool(f & 2) for f in flags],
+            'victim': array('q', (self.victims[i] for i in order)),
+            'reason': bytearray(f >> 2 for f in flags),
+        }
+
+    def __str__(self):
+        return '(EventRing(capacity={}, events={}, dropped={}))' \
+               .format(self.capacity, len(self), self.dropped)
+
+
+class EventLog:
+    def __init__(self, path, buffered=4096):
+        """path     = file to write the events to (it's overwritten)
+           buffered = how many events are packed before writing them
+        """
+        self.file = open(path, 'wb')
+        self.file.write(_MAGIC + bytes([_VERSION]))
+        self.buffer = bytearray(_EVENT.size * buffered)
+        self.buffered = buffered
+        self.pending = 0
+        self.count = 0
+
+    def __call__(self, position, ref, s, way, hit, write, victim, reason):
+        _EVENT.pack_into(self.buffer, self.pending * _EVENT.size, position,
+                         ref, s, way, victim, _flags(hit, write, reason))
+        self.pending += 1
+        self.count += 1
+        if self.pending == self.buffered:
+            self.flush()
+
+    def flush(self):
+        """Writes the events packed so far"""
+        if self.pending:
+            self.file.write(memoryview(self.buffer)
+                            [:self.pending * _EVENT.size])
+            self.pending = 0
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_events(path, chunk_size=65536):
+    """Yields every 'Event' of a log written by 'EventLog'"""
+    with open(path, 'rb') as f:
+        header = f.read(len(_MAGIC) + 1)
+        if header[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('Not an event log: '+str(path))
+        if header[len(_MAGIC)] != _VERSION:
+            raise ValueError('Unsupported event log version: {}'
+                             .format(header[len(_MAGIC)]))
+        while True:
+            data = f.read(chunk_size * _EVENT.size)
+            if not data:
+                break
+            if len(data) % _EVENT.size:
+                raise ValueError('Truncated event log: '+str(path))
+            for fields in _EVENT.iter_unpack(data):
+                yield _event(*fields)
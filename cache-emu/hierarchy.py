@@ -0,0 +1,536 @@
+#!/usr/bin/python3
+"""Multi-level cache hierarchies (such as L1, L2 and L3) built by chaining
+   'Cache' instances, where the misses of a level go to the next one.
+
+   The inclusion policies are:
+   * 'non-inclusive' : blocks are placed on every level they missed, and
+                       evicting from a level doesn't affect the others.
+   * 'inclusive'     : like 'non-inclusive', but when a level evicts a
+                       block it is also invalidated from the levels above
+                       (back-invalidation), so every level holds all the
+                       blocks of those above it.
+   * 'exclusive'     : blocks are only placed on the first level. Blocks
+                       evicted from a level move to the next one, and the
+                       blocks found on a lower level move to the first.
+
+   On non-inclusive hierarchies no level affects those above it, so each
+   replays all the misses of the previous one in a single batch. Inclusive
+   ones (and non-inclusive ones with writes) replay chunks of references
+   in a batch too, going back when a back-invalidation or a write-back
+   would have changed what a level held. Exclusive ones only replay the
+   first level in a batch, its misses going reference by reference.
+
+   Writes are made to the first level (or the first that allocates the
+   block), and dirty blocks evicted from a level are written back to the
+   next one, where they are placed as dirty without counting as accesses.
+   Exclusive levels move blocks with their dirty bit instead, and dirty
+   blocks that inclusive levels back-invalidate are written back by the
+   level that evicted them. The memory traffic of every level
+   ('Cache.bytes_read' and 'Cache.bytes_written') is the amount of data
+   read from and written to the level below it, the last one's being the
+   traffic with the main memory.
+"""
+from bisect import bisect_right
+
+from memory import Cache, np, parse_refs
+
+
+POLICIES = ('non-inclusive', 'inclusive', 'exclusive')
+
+# References replayed at once on every level (see 'Hierarchy.access_all'),
+# at most and at least (after finding a level that changed those above)
+BATCH_SIZE = 4096
+BATCH_MIN = 64
+
+
+def _replay(level, refs, writes, victims):
+    """Replays the references on a level, returning (refs, missed) with
+       the positions of the misses, as 'Cache.replay' would do it
+    """
+    if level.observers:
+        return level._access_each(refs, writes, victims)
+    return level._replay(refs, writes, True, victims)
+
+
+def _last(positions, q):
+    """The last of the sorted positions up to q, or -1 if there's none"""
+    if positions is None:
+        return -1
+    i = bisect_right(positions, q)
+    return positions[i - 1] if i else -1
+
+
+class _Timeline:
+    """When a level filled and evicted every block during a batch, to know
+       whether it held some block at any point of it
+    """
+    def __init__(self, level, state):
+        """level = the 'Cache'
+           state = its 'CacheState' before the batch
+        """
+        self.level = level
+        self.state = state
+        self.fills = {}
+        self.evictions = {}
+
+    def holds(self, block, q):
+        """Did the level hold the block right after the reference at
+           position q of the batch (-1 being before the batch)?
+        """
+        fill = _last(self.fills.get(block), q)
+        evict = _last(self.evictions.get(block), q)
+        if fill == evict == -1:
+            t, s = divmod(block, self.level.sets)
+            start = s * self.level.ways
+            return self.state.find(start, start + self.level.ways, t) != -1
+        return fill > evict
+
+
+class Hierarchy:
+    def __init__(self, levels, policy='non-inclusive',
+                 latencies=None, memory_latency=100):
+        """levels         = list of 'Cache', the first being the closest
+           policy         = inclusion policy, see 'POLICIES'
+           latencies      = access latency of every level (in cycles)
+           memory_latency = latency of the main memory, after the last level
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy given: '+policy)
+
+        if not levels:
+            raise ValueError('At least one level is required')
+
+        if latencies is None:
+            # Something close to what current machines have
+            latencies = [4 * 3**i for i in range(len(levels))]
+
+        if len(latencies) != len(levels):
+            raise ValueError('Every level needs its own latency')
+
+        if policy == 'exclusive' and len({
+                c.partition_size for c in levels}) != 1:
+            raise ValueError('Exclusive levels must have the same '
+                             'partition size')
+
+        self.levels = list(levels)
+        self.policy = policy
+        self.latencies = list(latencies)
+        self.memory_latency = memory_latency
+
+    def access(self, ref, write=False):
+        """Accesses a single reference, returning the index of the level
+           where it hit (or 'len(levels)' if it had to go to memory)
+        """
+        if self.policy == 'exclusive':
+            return self._access_exclusive(ref, write)
+        return self._access_from(0, ref, write)
+
+    def _access_from(self, first, ref, write):
+        """Accesses the reference from level 'first' down, as 'access'"""
+        for i in range(first, len(self.levels)):
+            level = self.levels[i]
+            level.access(ref, write=write)
+            if level.evicted is not None:
+                self._evicted(i, level.evicted, level.evicted_dirty)
+            if level.last_access[0]:
+                return i
+            # Only a write that didn't allocate the block goes on as one
+            write = write and level.last_access[1] is None
+
+        return len(self.levels)
+
+    def _evicted(self, i, address, dirty):
+        """Handles the block that level 'i' evicted, back-invalidating it
+           from the levels above if inclusive, and writing it back to the
+           next level if it (or a copy above) was dirty
+        """
+        level = self.levels[i]
+        if i and self.policy == 'inclusive' \
+                and self._back_invalidate(i, address, level.partition_size) \
+                and not dirty:
+            # The data written above goes through this level to the next
+            level._account(0, 1, 0)
+            dirty = True
+        if dirty:
+            self._write_back(i, address, level.partition_size)
+
+    def _back_invalidate(self, i, address, size):
+        """Invalidates the 'size' words starting at 'address' from all the
+           levels above 'i', returning whether any of them was dirty
+        """
+        dirty = False
+        for upper in self.levels[:i]:
+            for ref in range(address, address + size, upper.partition_size):
+                dirty = upper.is_dirty(ref) or dirty
+                upper.invalidate(ref)
+        return dirty
+
+    def _write_back(self, i, address, size):
+        """Writes the dirty block evicted from level 'i' to the next one
+           (past the last level, its traffic is all there is to account)
+        """
+        if i + 1 == len(self.levels):
+            return
+        lower = self.levels[i + 1]
+        for ref in range(address, address + size, lower.partition_size):
+            evicted = lower.insert(ref, dirty=True)
+            if evicted is not None:
+                self._evicted(i + 1, evicted, lower.evicted_dirty)
+
+    def _access_exclusive(self, ref, write):
+        first = self.levels[0]
+        first.access(ref, write=write)
+        if first.last_access[0]:
+            return 0
+
+        found, dirty = self._take(ref, first.last_access[1] is not None)
+        if dirty:
+            first.insert(ref, dirty=True)
+
+        # And whatever the first level evicted moves down the hierarchy
+        if first.evicted is not None:
+            self._move_down(0, first.evicted, first.evicted_dirty)
+
+        return found
+
+    def _take(self, ref, allocated):
+        """Looks up a block that missed the first exclusive level, which
+           leaves the level where it's found for the first one along with
+           its data (so it's not written back), unless the first level
+           didn't allocate it for a write, which is then made there.
+           Returns the index of the level and whether it was dirty.
+        """
+        for i, level in enumerate(self.levels[1:], start=1):
+            if not allocated:
+                if level.contains(ref):
+                    level.insert(ref, dirty=True)
+                    level.hits += 1
+                    return i, False
+            else:
+                dirty = level.is_dirty(ref)
+                if level.invalidate(ref, write_back=False):
+                    level.hits += 1
+                    return i, dirty
+            level.misses += 1
+
+        return len(self.levels), False
+
+    def _move_down(self, i, address, dirty):
+        """Moves the block evicted from exclusive level 'i' to the next
+           one, and so on with whatever that evicts for it
+        """
+        for lower in self.levels[i + 1:]:
+            address = lower.insert(address, dirty)
+            if address is None:
+                break
+            dirty = lower.evicted_dirty
+
+    def access_all(self, refs, writes=None):
+        """Accesses all the references, with the same results as calling
+           'access' for each of them. 'writes' may tell which of them are
+           writes, as in 'Cache.replay'.
+
+           Every level replays the misses of the previous one in a batch
+           as long as nothing makes a level change those above it, which
+           is always the case for non-inclusive levels without writes.
+           Otherwise the levels are replayed in chunks of 'BATCH_SIZE'
+           references (see '_batch'), back-invalidations and write-backs
+           being worked out after each. If any of them would have changed
+           the outcome, the chunk is replayed again up to that reference,
+           which is then accessed on its own. This needs levels that can be
+           saved (no index, instruments nor observers) with partitions no
+           larger than those of the levels below, or they go one by one.
+
+           The first exclusive level doesn't depend on the others, so it
+           replays all of them in a batch too, but its misses go down the
+           rest of the hierarchy one by one.
+        """
+        refs = parse_refs(refs)
+        if writes is not None:
+            if np is not None:
+                writes = np.asarray(writes, dtype=bool)
+                if not writes.any():
+                    writes = None
+            else:
+                writes = [bool(w) for w in writes]
+                if not any(writes):
+                    writes = None
+
+        if self.policy == 'exclusive':
+            self._access_all_exclusive(refs, writes)
+        elif self.policy == 'non-inclusive' and writes is None:
+            self._access_all_non_inclusive(refs, writes)
+        elif self._batched():
+            if np is not None:
+                refs = np.asarray(refs, dtype=np.int64)
+            else:
+                refs = list(refs)
+            start = 0
+            size = BATCH_SIZE
+            while start < len(refs):
+                end = start + size
+                done = self._batch(refs[start:end], None if writes is None
+                                   else writes[start:end])
+                start += done
+                # Chunks that go wrong early are made shorter
+                size = min(BATCH_SIZE, max(BATCH_MIN, 2 * done))
+        elif self.policy == 'non-inclusive':
+            self._access_all_non_inclusive(refs, writes)
+        else:
+            for i, ref in enumerate(refs):
+                self._access_from(0, int(ref),
+                                  writes is not None and writes[i])
+
+    def _batched(self):
+        """Can all the levels be replayed in chunks by '_batch'?"""
+        sizes = [level.partition_size for level in self.levels]
+        return sizes == sorted(sizes) and not any(
+            level.index or level.instruments is not None or level.observers
+            for level in self.levels)
+
+    def _batch(self, refs, writes):
+        """Replays the references on every level in a batch, the misses of
+           a level being the references of the next, and returns how many
+           of them were accessed.
+
+           Levels don't see the blocks that the level above writes back to
+           them, nor the back-invalidations of the levels below, while they
+           replay. Both are worked out afterwards from the blocks filled
+           and evicted by every level: write-backs only set the dirty bit
+           of blocks that the level holds, which makes them dirty when
+           they're evicted, and back-invalidations do nothing on levels
+           that don't hold the block. Otherwise, everything from that
+           reference on is wrong, and the levels go back to the start of
+           the chunk to replay it only up to that reference.
+        """
+        saved = [level._save() for level in self.levels]
+        count = len(refs)
+        # Where the batch first went wrong
+        wrong = count
+        batch_refs, batch_writes = refs, writes
+        positions = np.arange(count) if np is not None \
+            else list(range(count))
+        # (position, address) of the blocks written back to the level
+        marks = []
+        timelines = []
+        # (level, blocks written back that it didn't know were dirty, and
+        # the blocks left dirty which it doesn't know about)
+        pending = []
+        for k, level in enumerate(self.levels):
+            psize = level.partition_size
+            victims = []
+            _, missed = level._replay(refs, writes, True, victims)
+            timeline = _Timeline(level, saved[k][0])
+            timelines.append(timeline)
+            for i in missed:
+                i = int(i)
+                if level.write_allocate or writes is None or not writes[i]:
+                    timeline.fills.setdefault(
+                        int(refs[i]) // psize, []).append(int(positions[i]))
+
+            events = []
+            for i, address, dirty in victims:
+                q = int(positions[i])
+                timeline.evictions.setdefault(
+                    address // psize, []).append(q)
+                events.append((q, 1, address, dirty))
+                if self.policy != 'inclusive' or q >= wrong:
+                    continue
+                # Back-invalidations must find nothing above
+                for upper in timelines[:k]:
+                    size = upper.level.partition_size
+                    for ref in range(address, address + psize, size):
+                        if upper.holds(ref // size, q):
+                            wrong = q
+                            break
+
+            for q, address in marks:
+                # Placing a block written back would change the level
+                if q < wrong and not timeline.holds(address // psize, q - 1):
+                    wrong = q
+                events.append((q, 0, address, False))
+
+            # Blocks written back before they're evicted make them dirty
+            # (those written back at the same reference, from above, too)
+            events.sort()
+            dirty_blocks = set()
+            written = 0
+            marks = []
+            for q, evicted, address, dirty in events:
+                block = address // psize
+                if not evicted:
+                    dirty_blocks.add(block)
+                    continue
+                if block in dirty_blocks:
+                    dirty_blocks.discard(block)
+                    if not dirty:
+                        written += 1
+                        dirty = True
+                if dirty:
+                    marks.append((q, address))
+            pending.append((level, written, dirty_blocks))
+
+            if not len(missed) or k + 1 == len(self.levels):
+                break
+            # Only writes that didn't allocate the block go on as writes
+            if writes is not None and not level.write_allocate:
+                writes = writes[missed] if np is not None \
+                    else [writes[i] for i in missed]
+            else:
+                writes = None
+            if np is not None:
+                refs = refs[missed]
+                positions = positions[missed]
+            else:
+                refs = [refs[i] for i in missed]
+                positions = [positions[i] for i in missed]
+
+        if wrong < count:
+            for level, state in zip(self.levels, saved):
+                level._restore(state)
+            if wrong:
+                self._batch(batch_refs[:wrong], None if batch_writes is None
+                            else batch_writes[:wrong])
+            self._access_from(0, int(batch_refs[wrong]),
+                              batch_writes is not None
+                              and bool(batch_writes[wrong]))
+            return wrong + 1
+
+        for level, written, dirty_blocks in pending:
+            if written:
+                level._account(0, written, 0)
+            for block in dirty_blocks:
+                level.insert(block * level.partition_size, dirty=True)
+        return count
+
+    def _access_all_exclusive(self, refs, writes):
+        first = self.levels[0]
+        psize = first.partition_size
+        victims = []
+        refs, missed = _replay(first, refs, writes, victims)
+        victims = {p: (address, dirty) for p, address, dirty in victims}
+
+        # Blocks moved up dirty, which the first level (replayed before
+        # they were) doesn't know to be dirty until they're evicted
+        carried = set()
+        for p in missed:
+            p = int(p)
+            ref = int(refs[p])
+            allocated = first.write_allocate \
+                or writes is None or not writes[p]
+            _, dirty = self._take(ref, allocated)
+            if dirty:
+                carried.add(ref // psize)
+
+            victim = victims.get(p)
+            if victim is not None:
+                address, dirty = victim
+                if address // psize in carried:
+                    carried.discard(address // psize)
+                    if not dirty:
+                        first._account(0, 1, 0)
+                        dirty = True
+                self._move_down(0, address, dirty)
+
+        for block in carried:
+            first.insert(block * psize, dirty=True)
+
+    def _access_all_non_inclusive(self, refs, writes):
+        for i, level in enumerate(self.levels):
+            victims = []
+            refs, missed = _replay(level, refs, writes, victims)
+            if not len(missed) or i + 1 == len(self.levels):
+                break
+
+            # Only writes that didn't allocate the block go on as writes
+            if writes is not None and not level.write_allocate:
+                writes = [bool(writes[p]) for p in missed]
+            else:
+                writes = None
+            dirty = {p: address for p, address, d in victims if d}
+            if not dirty:
+                refs = refs[missed] if np is not None \
+                    else [refs[p] for p in missed]
+                continue
+
+            # Write-backs are placed between the misses, so the rest of
+            # the hierarchy has to go reference by reference
+            for j, p in enumerate(missed):
+                p = int(p)
+                if p in dirty:
+                    self._write_back(i, dirty[p], level.partition_size)
+                self._access_from(i + 1, int(refs[p]),
+                                  writes is not None and writes[j])
+            break
+
+    def reset(self):
+        """Resets the status of every level"""
+        for level in self.levels:
+            level.reset()
+
+    def stats(self):
+        """Returns a list with (accesses, hits, misses, hit rate) for every
+           level, where the hit rate is local to the level
+        """
+        result = []
+        for level in self.levels:
+            accesses = level.hits + level.misses
+            result.append((accesses, level.hits, level.misses,
+                           level.hits / accesses if accesses else 0.0))
+        return result
+
+    def amat(self):
+        """Average memory access time (in cycles) of all the accesses made,
+           from the latencies of every level and the main memory
+        """
+        total = self.levels[0].hits + self.levels[0].misses
+        if not total:
+            return 0.0
+
+        cycles = 0
+        for level, latency in zip(self.levels, self.latencies):
+            cycles += (level.hits + level.misses) * latency
+        cycles += self.levels[-1].misses * self.memory_latency
+        return cycles / total
+
+    def __str__(self):
+        lines = ['Hierarchy(policy="{}", amat={:.2f})'
+                 .format(self.policy, self.amat())]
+        for i, (level, (accesses, hits, misses, rate)) in enumerate(
+                zip(self.levels, self.stats()), start=1):
+            lines.append('  L{}: {} accesses, {} hits, {} misses ({:.2%} '
+                         'hit rate) on {}'.format(i, accesses, hits, misses,
+                                                  rate, level))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import random
+
+    # A 30% of writes, over more data than the last level holds
+    refs = [random.randrange(1 << 18) for _ in range(100000)]
+    writes = [random.random() < 0.3 for _ in refs]
+
+    def levels():
+        return [
+            Cache(16, 64, 4, 'lru'),
+            Cache(16, 512, 8, 'lru'),
+            Cache(16, 4096, 16, 'lru'),
+        ]
+
+    for policy in POLICIES:
+        h = Hierarchy(levels(), policy)
+        h.access_all(refs, writes)
+        print(h)
+        traffic = [c.bytes_written for c in h.levels]
+        print('  Bytes written to the level below:', traffic)
+        if not traffic[-1]:
+            print('  Dirty blocks never reached the main memory!')
+
+        # Going reference by reference must end up exactly the same
+        single = Hierarchy(levels(), policy)
+        for r, w in zip(refs, writes):
+            single.access(r, w)
+        if single.stats() != h.stats() \
+                or [c.bytes_written for c in single.levels] != traffic:
+            print('  Accessing one by one gave different results!')
@@ -1,13 +1,22 @@
 #!/usr/bin/python3
 
 import time
+from array import array
+from collections import OrderedDict
+from heapq import heapify, heappop, heappush
+
+from events import BYPASSED, EVICTED, FILLED, HIT
+from replacement import POLICIES as REPLACEMENTS
 
 
 try:
     import numpy as np
-    import matplotlib.pyplot as plt
 except ImportError:
     np = None
+
+try:
+    import matplotlib.pyplot as plt
+except ImportError:
     plt = None
 
 try:
@@ -16,61 +25,357 @@ except ImportError:
     colorama = None
 
 
-class ListView:
-    """Similar to memoryview(bytes_buffer), but for any list"""
-    def __init__(self, lst, start=None, end=None):
-        self.lst = lst
-        self.move(start, end)
-    
-    def move(self, start, end):
-        self.start = 0 if start is None else max(start, 0)
-        self.end = len(self.lst) if end is None else min(end, len(self.lst))
-    
-    def __iter__(self):
-        for i in range(self.start, self.end):
-            yield self.lst[i]
-    
-    def __len__(self):
-        return self.end - self.start
-    
-    def __contains__(self, x):
-        for i in range(self.start, self.end):
-            if self.lst[i] == x:
-                return True
-        return False
-    
-    def _getindex(self, key):
-        i = self.end + key if key < 0 else self.start + key
-        if self.start <= i < self.end:
+# Caches with this many ways or more index their sets by default
+INDEXED_WAYS = 32
+
+# Next use of the blocks that will never be used again ('opt')
+NEVER = (1 << 63) - 1
+
+
+def parse_refs(refs):
+    """Parses the references if they are a string of comma, semicolon,
+       or space separated values, or returns them unchanged otherwise
+    """
+    if isinstance(refs, str):
+        if ',' in refs:
+            refs = [int(s.strip()) for s in refs.split(',')]
+        elif ';' in refs:
+            refs = [int(s.strip()) for s in refs.split(';')]
+        else:
+            refs = [int(s) for s in refs.split()]
+    return refs
+
+
+def next_uses(blocks, offset=0):
+    """Returns when every block is used next (its position, plus 'offset'),
+       or 'NEVER' if it isn't, in a single backward pass over the blocks
+    """
+    if np is not None:
+        # Same as the backward pass, but sorting the blocks to find the
+        # next position of the same block in a vectorized way instead
+        blocks = np.asarray(blocks, dtype=np.int64)
+        order = np.argsort(blocks, kind='stable')
+        result = np.full(len(blocks), NEVER, dtype=np.int64)
+        same = blocks[order[1:]] == blocks[order[:-1]]
+        result[order[:-1][same]] = order[1:][same] + offset
+        return result
+    
+    result = array('q', bytes(8 * len(blocks)))
+    last = {}
+    for i in reversed(range(len(blocks))):
+        b = blocks[i]
+        result[i] = last.get(b, NEVER)
+        last[b] = i + offset
+    return result
+
+
+class CacheState:
+    """Compact state of all the partitions in a cache, laid out on typed
+       arrays with one row of 'ways' partitions per set.
+       
+       Rather than making every partition older on each access, every
+       set has a clock which ticks on each access to it, and partitions
+       remember the time at which they were last used and first added.
+       Their age is then the difference between both.
+       
+       The optimal policy ('opt') also needs to know when the block on
+       every partition will be used next, which is an absolute position
+       on the trace rather than a time of the set.
+       
+       Policies from 'replacement' keep their own state in a 64-bit word
+       and a byte for every set instead.
+    """
+    __slots__ = ('sets', 'ways', 'tags', 'valid', 'dirty', 'usecount',
+                 'lastuse', 'firstuse', 'nextuse', 'clock', 'bits', 'aux')
+    
+    def __init__(self, sets, ways):
+        size = sets * ways
+        self.sets = sets
+        self.ways = ways
+        self.tags = array('q', bytes(8 * size))
+        self.valid = bytearray(size)
+        self.dirty = bytearray(size)
+        self.usecount = array('Q', bytes(8 * size))  # 'lfu'
+        self.lastuse = array('Q', bytes(8 * size))   # 'lru'
+        self.firstuse = array('Q', bytes(8 * size))  # 'fifo'
+        self.nextuse = array('q', bytes(8 * size))   # 'opt'
+        self.clock = array('Q', bytes(8 * sets))
+        self.bits = array('Q', bytes(8 * sets))
+        self.aux = bytearray(sets)
+    
+    def find(self, start, end, tag):
+        """Returns the valid partition in [start, end) with the given tag,
+           or -1 if there is none, without creating any intermediate list
+        """
+        tags = self.tags
+        try:
+            i = tags.index(tag, start, end)
+            while not self.valid[i]:
+                i = tags.index(tag, i + 1, end)
             return i
+        except ValueError:
+            return -1
+    
+    def copy(self):
+        """Returns a copy of the state, sharing nothing with it"""
+        other = CacheState.__new__(CacheState)
+        other.sets = self.sets
+        other.ways = self.ways
+        for name in self.__slots__[2:]:
+            setattr(other, name, getattr(self, name)[:])
+        return other
+    
+    def lasttime(self, partition):
+        """How long ago the partition was last used"""
+        return self.clock[partition // self.ways] - self.lastuse[partition]
+    
+    def firsttime(self, partition):
+        """How long ago the partition was first added"""
+        return self.clock[partition // self.ways] - self.firstuse[partition]
+    
+    def nbytes(self):
+        """Returns how many bytes the state takes"""
+        return sum(len(a) * a.itemsize for a in (
+            self.tags, self.usecount, self.lastuse, self.firstuse,
+            self.nextuse, self.clock, self.bits
+        )) + len(self.valid) + len(self.dirty) + len(self.aux)
+
+
+class SetIndex:
+    """Index over the ways of a single set, so that finding a tag or the
+       victim to evict needs no scan over all of them. Tags map to their
+       way, and the ways are kept in the order in which the policy would
+       evict them ('lru' and 'fifo'), or in a heap by use count ('lfu')
+       or by how far in the future they are used next ('opt').
+       
+       The heap is updated lazily: ways are pushed again whenever their
+       key changes and outdated entries are skipped when found.
+       
+       Empty ways are always used first, lower ones before (as the policy
+       would do, since they would all have been used as long ago).
+    """
+    __slots__ = ('ways', 'policy', 'lookup', 'order', 'heap', 'free')
+    
+    def __init__(self, ways, policy):
+        self.ways = ways
+        self.policy = policy
+        self.lookup = {}
+        self.order = OrderedDict()
+        self.heap = []
+        self.free = list(range(ways))
+    
+    def _key(self, state, line):
+        """Key of the partition on the heap, the lowest being evicted"""
+        if self.policy == 'lfu':
+            return state.usecount[line]
+        return -state.nextuse[line]
+    
+    def used(self, way, state, start):
+        """The way was hit (or, for 'opt', its next use is now known)"""
+        if self.policy == 'lru':
+            self.order.move_to_end(way)
+        elif self.policy in ('lfu', 'opt'):
+            heap = self.heap
+            heappush(heap, (self._key(state, start + way), way))
+            if len(heap) > 4 * self.ways:
+                # Too many outdated entries, rebuild it from scratch
+                heap[:] = [(self._key(state, start + w), w)
+                           for w in range(self.ways)]
+                heapify(heap)
+    
+    def victim(self, state, start):
+        """Returns the way that should be evicted next"""
+        if self.free:
+            return self.free[0]
         
-        raise IndexError('list index out of range')
+        if self.policy in ('lfu', 'opt'):
+            heap = self.heap
+            while True:
+                key, way = heap[0]
+                if self._key(state, start + way) == key:
+                    return way
+                heappop(heap)
+        
+        return next(iter(self.order))
     
-    def __getitem__(self, key):
-        return self.lst[self._getindex(key)]
+    def fill(self, way, tag, old_tag=None):
+        """The way is now used by 'tag' instead of 'old_tag'"""
+        if self.free and self.free[0] == way:
+            heappop(self.free)
+        if old_tag is not None and self.lookup.get(old_tag) == way:
+            del self.lookup[old_tag]
+        self.lookup[tag] = way
+        if self.policy == 'lfu':
+            heappush(self.heap, (1, way))
+        elif self.policy == 'opt':
+            pass  # Pushed once its next use is known
+        else:
+            self.order[way] = None
+            self.order.move_to_end(way)
     
-    def __setitem__(self, key, value):
-        self.lst[self._getindex(key)] = value
+    def empty(self, way, tag):
+        """The way no longer holds 'tag' and is now empty"""
+        if self.lookup.get(tag) == way:
+            del self.lookup[tag]
+        self.order.pop(way, None)
+        heappush(self.free, way)
     
-    def __str__(self):
-        return str(self.lst[self.start:self.end])
+    def load(self, state, start):
+        """Indexes the ways of the set starting at the partition 'start'
+           as they are found on the 'state' (for example, once restored)
+        """
+        self.lookup.clear()
+        self.order.clear()
+        self.free = []
+        used = []
+        for way in reversed(range(self.ways)):
+            line = start + way
+            if state.valid[line]:
+                self.lookup[state.tags[line]] = way
+                stamp = state.firstuse if self.policy == 'fifo' \
+                    else state.lastuse
+                used.append((stamp[line], way))
+            else:
+                self.free.append(way)
+        heapify(self.free)
+        for _, way in sorted(used):
+            self.order[way] = None
+        self.heap = [(self._key(state, start + w), w) for _, w in used]
+        heapify(self.heap)
+
+
+class Instruments:
+    """Instrumentation for a 'Cache', which classifies every miss as:
+       * compulsory : the block was never accessed before.
+       * capacity   : a fully associative LRU cache of the same size
+                      would have missed too.
+       * conflict   : any other miss (caused by the block's set being
+                      too crowded).
+       
+       It also counts the accesses and misses on every set, and how many
+       blocks were evicted from every partition and how long they lived
+       (in accesses to their set), so that sets which thrash stand out.
+    """
+    __slots__ = ('partition_size', 'compulsory', 'capacity', 'conflict',
+                 'seen', 'shadow', 'set_accesses', 'set_misses',
+                 'evictions', 'lifetimes')
+    
+    def __init__(self, cache):
+        self.partition_size = cache.partition_size
+        self.compulsory = 0
+        self.capacity = 0
+        self.conflict = 0
+        self.seen = set()
+        # The shadow cache works on block numbers directly
+        self.shadow = Cache(1, cache.partitions, cache.partitions, 'lru')
+        self.set_accesses = array('Q', bytes(8 * cache.sets))
+        self.set_misses = array('Q', bytes(8 * cache.sets))
+        self.evictions = array('Q', bytes(8 * cache.partitions))
+        self.lifetimes = array('Q', bytes(8 * cache.partitions))
     
-    def __repr__(self):
-        return repr(self.lst[self.start:self.end])
+    def access(self, block, s, hit):
+        """Records a single access to 'block' on set 's'"""
+        self.set_accesses[s] += 1
+        self.shadow.access(block)
+        if hit:
+            return
+        
+        self.set_misses[s] += 1
+        if block not in self.seen:
+            self.seen.add(block)
+            self.compulsory += 1
+        elif self.shadow.last_access[0]:
+            self.conflict += 1
+        else:
+            self.capacity += 1
     
-    def index(self, value):
-        for i in range(self.start, self.end):
-            if self.lst[i] == value:
-                return i - self.start
+    def record(self, refs, sets, missed):
+        """Records a batch of accesses, 'missed' being the (sorted)
+           positions of the references that missed
+        """
+        _, shadow_missed = self.shadow._replay(
+            [r // self.partition_size for r in refs] if np is None
+            else refs // self.partition_size, None, True)
+        
+        if np is None:
+            for s in sets:
+                self.set_accesses[s] += 1
+            compulsory = 0
+            for i in missed:
+                self.set_misses[sets[i]] += 1
+                block = refs[i] // self.partition_size
+                if block not in self.seen:
+                    self.seen.add(block)
+                    compulsory += 1
+            both = len(set(missed).intersection(shadow_missed))
+        else:
+            size = len(self.set_accesses)
+            np.frombuffer(self.set_accesses, dtype=np.uint64)[:] += \
+                np.bincount(sets, minlength=size).astype(np.uint64)
+            np.frombuffer(self.set_misses, dtype=np.uint64)[:] += \
+                np.bincount(sets[missed], minlength=size).astype(np.uint64)
+            blocks = np.unique(refs[missed] // self.partition_size).tolist()
+            new = [b for b in blocks if b not in self.seen]
+            self.seen.update(new)
+            compulsory = len(new)
+            both = len(np.intersect1d(missed, shadow_missed,
+                                      assume_unique=True))
         
-        raise ValueError('{} is not in list'.format(value))
+        self.compulsory += compulsory
+        self.capacity += both - compulsory
+        self.conflict += len(missed) - both
     
-    def original(self, index):
-        return self.start + index
+    def evicted(self, lines, lifetimes):
+        """Records the eviction of blocks from the given partitions,
+           which had lived for the given number of accesses
+        """
+        if np is not None and isinstance(lines, np.ndarray):
+            np.add.at(np.frombuffer(self.evictions, dtype=np.uint64),
+                      lines, 1)
+            np.add.at(np.frombuffer(self.lifetimes, dtype=np.uint64),
+                      lines, lifetimes.astype(np.uint64))
+            return
+        
+        for line, lifetime in zip(lines, lifetimes):
+            self.evictions[line] += 1
+            self.lifetimes[line] += int(lifetime)
+    
+    def arrays(self):
+        """Returns the per set and per partition counters, as NumPy arrays
+           if available (one value per set or partition respectively)
+        """
+        result = {
+            'set_accesses': self.set_accesses,
+            'set_misses': self.set_misses,
+            'evictions': self.evictions,
+            'lifetimes': self.lifetimes,
+        }
+        for key, value in result.items():
+            if np is not None:
+                result[key] = np.array(value, dtype=np.uint64)
+            else:
+                result[key] = array('Q', value)
+        return result
+    
+    def set_miss_rates(self):
+        """Returns the miss rate of every set (0 for unused sets)"""
+        return [m / a if a else 0.0
+                for a, m in zip(self.set_accesses, self.set_misses)]
+    
+    def mean_lifetimes(self):
+        """Returns how long blocks lived on every partition on average"""
+        return [l / e if e else 0.0
+                for e, l in zip(self.evictions, self.lifetimes)]
+    
+    def __str__(self):
+        return '(Instruments(compulsory={}, capacity={}, conflict={}))' \
+               .format(self.compulsory, self.capacity, self.conflict)
 
 
 class Cache:
-    def __init__(self, partition_size, partitions, ways=1, policy=None):
+    def __init__(self, partition_size, partitions, ways=1, policy=None,
+                 indexed=None, write_policy='write-back', write_allocate=True,
+                 word_size=1, instrument=False, seed=0):
         """partition_size = partition size in words
            partitions     = number of partitions
            ways.          = number of way (associativity degree)
@@ -78,28 +383,111 @@ class Cache:
                |= 1     : direct mapping
                |= n     : partially associative (needs 'policy')
                |= else  : fully associative
-
+           
            policy = access policy when 'ways' ≠ 1, 'partitions'
                   |= 'lfu'  : Least Frequently Used
                   |= 'lru'  : Least Recently Used
                   |= 'fifo' : First In, First Out
+                  |= 'opt'  : Belady's optimal policy, which evicts the
+                  |           block used the furthest in the future (and
+                  |           needs to know it, see 'plan' and 'replay')
+                  |= 'plru', 'clock', 'random',
+                     'srrip', 'brrip', 'drrip' : as hardware implements
+                                                 them, see 'replacement'
+           
+           indexed = whether every set should keep an index of its ways,
+                     so that hits and evictions take constant time (or
+                     logarithmic, for 'lfu') instead of scanning all the
+                     ways. By default, used with 'INDEXED_WAYS' or more
+                     (and always with 'opt').
+           
+           write_policy = what happens when a present block is written
+                        |= 'write-back'    : it's marked as dirty, and will
+                        |                    be written to the next level
+                        |                    when it's evicted
+                        |= 'write-through' : the word is written to the
+                                             next level right away
+           
+           write_allocate = whether a block that's written and missed
+                            should be brought into the cache. Otherwise
+                            the word is written to the next level only.
+           
+           word_size = size of a word in bytes, to account memory traffic
+           
+           instrument = whether to keep 'Instruments' on the accesses made,
+                        classifying the misses and counting them per set
+           
+           seed = seed for the 'random' policy, the same seed choosing the
+                  same ways to evict every time
         """
         if ways != 1 and policy is None:
             raise ValueError('A policy is required unless using direct mapping')
         
-        if policy not in [None, 'lfu', 'lru', 'fifo']:
+        if policy not in [None, 'lfu', 'lru', 'fifo', 'opt'] \
+                and policy not in REPLACEMENTS:
             raise ValueError('Unknown policy given: '+policy)
         
+        if write_policy not in ['write-back', 'write-through']:
+            raise ValueError('Unknown write policy given: '+write_policy)
+        
         self.partition_size = partition_size
         self.partitions = partitions
         self.ways = ways
         self.sets = partitions // ways
         self.policy = policy
+        if indexed is None:
+            indexed = ways >= INDEXED_WAYS
+        if policy == 'opt':
+            # The block used the furthest is only kept track of by the index
+            indexed = True
+        if policy in REPLACEMENTS:
+            # Their state is already compact, and they have few ways
+            indexed = False
+        self.indexed = bool(indexed) and ways != 1
+        self.seed = seed
+        if policy in REPLACEMENTS and ways != 1:
+            self.replacement = REPLACEMENTS[policy](ways, self.sets, seed)
+        else:
+            self.replacement = None
+        self.write_back = write_policy == 'write-back'
+        self.write_allocate = write_allocate
+        self.word_size = word_size
+        self.block_bytes = partition_size * word_size
+        self.instrument = instrument
+        # Called after every access, see 'observe'
+        self.observers = []
         self.reset()
     
+    # Views over the state of every partition, kept for convenience
+    @property
+    def tags(self):
+        return self.state.tags
+    
+    @property
+    def valid(self):
+        return self.state.valid
+    
+    @property
+    def dirty(self):
+        return self.state.dirty
+    
+    @property
+    def usecount(self):
+        return self.state.usecount
+    
+    @property
+    def lasttime(self):
+        return [self.state.lasttime(i) for i in range(self.partitions)]
+    
+    @property
+    def firsttime(self):
+        return [self.state.firsttime(i) for i in range(self.partitions)]
+    
     def access(self, ref, show=False, draw=False,
-               delay=0, delay_hit=None, delay_miss=None):
-        """Accesses a single reference on the main memory"""
+               delay=0, delay_hit=None, delay_miss=None, write=False):
+        """Accesses a single reference on the main memory,
+           reading from it unless 'write' is True
+        """
         # Offset, tag and set indexs
         m, o = divmod(ref, self.partition_size)
         t, s = divmod(m, self.sets)
@@ -113,29 +501,48 @@ class Cache:
         # For any other case, we will only choose a specific set
         start = s   * self.ways  # Set index, each of 'ways' ways
         end = start + self.ways  # Next way end
+        state = self.state
+        
+        # Everything in the set just got older
+        now = state.clock[s] + 1
+        state.clock[s] = now
         
-        # Slice everything to work on a local copy
-        wtags = ListView(self.tags, start, end)
-        wvalid = ListView(self.valid, start, end)
-        wusecount = ListView(self.usecount, start, end)
-        wlasttime = ListView(self.lasttime, start, end)
-        wfirsttime = ListView(self.firsttime, start, end)
+        # When the block will be used again, as planned ('opt' only)
+        next_use = self._next_use() if self.policy == 'opt' else NEVER
+        self.position += 1
         
-        # Everything in the cache just got older
-        for i in range(self.ways):
-            wlasttime[i]  += 1
-            wfirsttime[i] += 1
+        index = self.index[s] if self.index else None
+        if index is None:
+            line = state.find(start, end, t)
+        else:
+            way = index.lookup.get(t)
+            line = -1 if way is None else start + way
         
-        if t in wtags and wvalid[wtags.index(t)]:
+        if line != -1:
             # Hit
             self.hits += 1
-            way = wtags.index(t)
-            wusecount[way] += 1
-            wlasttime[way]  = 0
-            #  wfirsttime is the same
+            self.evicted = None
+            way = line - start
+            state.usecount[line] += 1
+            state.lastuse[line] = now
+            state.nextuse[line] = next_use
+            if index is not None:
+                index.used(way, state, start)
+            elif self.replacement is not None:
+                self.replacement.hit(state, s, way)
+            if write:
+                if self.write_back:
+                    state.dirty[line] = True
+                else:
+                    self.bytes_written += self.word_size
+            if self.instruments is not None:
+                self.instruments.access(m, s, True)
+            #  firstuse is the same
             #
             # Hit, at position (original index)
-            self.last_access = True, wtags.original(t)
+            self.last_access = True, line
+            if self.observers:
+                self._notify(ref, s, way, True, write, -1, HIT)
             if show:
                 if self.ways == 1:
                     print('Hit for {} at partition {}, word offset {}'
@@ -149,27 +556,27 @@ class Cache:
         else:
             # Miss
             self.misses += 1
-            if self.ways == 1:
-                # Single way, no choice
-                reason = None
-                way = 0
-            
-            elif self.policy == 'lfu':
-                # Least Frequently Used, where wusecount is minimum
-                way = min(range(len(wusecount)), key=wusecount.__getitem__)
-                reason = 'it was only used {} times'.format(wusecount[way])
-            
-            elif self.policy == 'lru':
-                # Least Recently Used, where wlasttime is maximum
-                way = max(range(len(wlasttime)), key=wlasttime.__getitem__)
-                reason = 'it was last used {}t ago'.format(wlasttime[way])
-            
-            elif self.policy == 'fifo':
-                # First In, First Out, where wfirsttime is maximum
-                way = max(range(len(wfirsttime)), key=wfirsttime.__getitem__)
-                reason = 'it was first added at {}t'.format(wfirsttime[way])
+            if self.instruments is not None:
+                self.instruments.access(m, s, False)
+            if write and not self.write_allocate:
+                # Goes straight to the next level, nothing else changes
+                self.bytes_written += self.word_size
+                self.evicted = None
+                self.last_access = False, None
+                if self.observers:
+                    self._notify(ref, s, -1, False, True, -1, BYPASSED)
+                if show:
+                    print('Miss for {}, written through without allocating, '
+                          'word offset {}'.format(ref, o))
+                self._after_access(ref, draw, delay, delay_hit, delay_miss)
+                return
             
+            way = self._victim(start, index)
+            if self.instruments is not None and state.valid[start + way]:
+                self.instruments.evicted(
+                    [start + way], [now - state.firstuse[start + way]])
             if show:
+                reason = self._reason(start + way, now)
                 if self.ways == 1:
                     print('Miss for {}, using partition {}, word offset {}'
                           .format(ref, s, o))
@@ -179,20 +586,49 @@ class Cache:
                 else:
                     print('Miss for {} on set {} using way {} because {}, '
                           'word offset {}'.format(ref, s, way, reason, o))
-            wtags[way] = t
-            wvalid[way] = True
-            
-            # Reset everything (first use, last and first time now)
-            wusecount[way]  = 1
-            wlasttime[way]  = 0
-            wfirsttime[way] = 0
+            self.evicted = self._fill(s, way, t, now, index, next_use)
+            self.bytes_read += self.block_bytes
+            if write:
+                if self.write_back:
+                    state.dirty[start + way] = True
+                else:
+                    self.bytes_written += self.word_size
             # Miss, at position (original index)
-            self.last_access = False, wtags.original(way)
+            self.last_access = False, start + way
+            if self.observers:
+                if self.evicted is None:
+                    self._notify(ref, s, way, False, write, -1, FILLED)
+                else:
+                    self._notify(ref, s, way, False, write, self.evicted,
+                                 EVICTED)
         
+        self._after_access(ref, draw, delay, delay_hit, delay_miss)
+    
+    def observe(self, observer):
+        """Calls 'observer(position, ref, set, way, hit, write, victim,
+           reason)' after every access from now on, see 'events'
+        """
+        self.observers.append(observer)
+    
+    def unobserve(self, observer):
+        """Stops calling the observer after every access"""
+        self.observers.remove(observer)
+    
+    def _notify(self, ref, s, way, hit, write, victim, reason):
+        """Tells every observer about the access just made"""
+        position = self.position - 1
+        for observer in self.observers:
+            observer(position, ref, s, way, hit, write, victim, reason)
+    
+    def _after_access(self, ref, draw, delay, delay_hit, delay_miss):
+        """Draws and waits after an access as requested"""
         if draw:
-            self.draw()
-            print(' -> Accessed word', ref, '-',
-                  self.hits, 'hits and', self.misses, 'misses')
+            # Only the partitions that changed are drawn again
+            if self.renderer is None:
+                from render import Renderer
+                self.renderer = Renderer(self)
+            self.renderer.update(' -> Accessed word {} - {} hits and {} '
+                                 'misses'.format(ref, self.hits, self.misses))
         
         hit, _ = self.last_access
         if hit and delay_hit:
@@ -207,34 +643,864 @@ class Cache:
         """Accesses all the references (either a list, or a
            string, comma, semicolon, or space separated values)
         """
-        if isinstance(refs, str):
-            if ',' in refs:
-                refs = [int(s.strip()) for s in refs.split(',')]
-            elif ';' in refs:
-                refs = [int(s.strip()) for s in refs.split(';')]
-            else:
-                refs = [int(s) for s in refs.split()]
+        refs = parse_refs(refs)
+        if not (show or draw or delay or delay_hit or delay_miss):
+            # Nothing to show for every access, so we can go fast
+            self.replay(refs)
+            return
         
         for r in refs:
             self.access(r, show=show, draw=draw, delay=delay,
                         delay_hit=delay_hit, delay_miss=delay_miss)
     
+    def replay(self, refs, misses=False, writes=None, victims=None):
+        """Accesses all the references (a NumPy array, any buffer such
+           as an 'array.array', or any iterable of integers) in a batch.
+           
+           The tag and set of every reference are worked out at once,
+           and then each set replays its own references in a tight loop
+           since the sets never interfere with each other. The hits,
+           misses and final state are the same as calling 'access' for
+           every reference in order, only much faster.
+           
+           If 'misses' is True, the references that missed are returned
+           in the same order they were accessed.
+           
+           'writes' may tell which references are writes, with anything
+           that has a truth value for each of the references.
+           
+           'victims' may be a list, to which (position, address, dirty) is
+           appended for every block evicted, in the order of the positions
+           (in the batch) of the references that evicted them.
+           
+           With the 'opt' policy, the references are also looked ahead
+           to know when every block is used next, unless they were all
+           given to 'plan' before (otherwise, nothing after them is
+           known and the blocks they don't use again are never used).
+           
+           Caches with observers access the references one by one instead,
+           so that the observers are told about every access.
+        """
+        if self.observers:
+            refs, missed = self._access_each(refs, writes, victims)
+        else:
+            refs, missed = self._replay(refs, writes, misses, victims)
+        if not misses:
+            return None
+        if np is not None:
+            return refs[missed]
+        return [refs[i] for i in missed]
+    
+    def plan(self, refs):
+        """Tells the references that will be accessed from now on, so that
+           the 'opt' policy knows when every block is used next even if
+           they are accessed one by one or in several batches
+        """
+        refs = parse_refs(refs)
+        if np is not None:
+            blocks = np.asarray(refs, dtype=np.int64) // self.partition_size
+        else:
+            blocks = [r // self.partition_size for r in refs]
+        self.future = next_uses(blocks, self.position)
+        self.planned = self.position
+    
+    def _next_use(self):
+        """When the reference being accessed will be accessed next"""
+        at = self.position - self.planned
+        if self.future is not None and 0 <= at < len(self.future):
+            return int(self.future[at])
+        return NEVER
+    
+    def _next_uses(self, refs):
+        """When every reference in the batch will be accessed next"""
+        at = self.position - self.planned
+        if self.future is not None and 0 <= at \
+                and at + len(refs) <= len(self.future):
+            return self.future[at:at + len(refs)]
+        return next_uses(refs // self.partition_size if np is not None
+                         else [r // self.partition_size for r in refs],
+                         self.position)
+    
+    def _access_each(self, refs, writes, victims=None):
+        """Accesses the references one by one, returning (refs, missed)
+           as '_replay' does
+        """
+        refs = parse_refs(refs)
+        if np is not None:
+            refs = np.asarray(refs, dtype=np.int64)
+        else:
+            refs = list(refs)
+        if self.policy == 'opt':
+            # Looked ahead as in a batch, unless they were planned
+            self.future = self._next_uses(refs)
+            self.planned = self.position
+        
+        missed = []
+        for i, ref in enumerate(refs):
+            self.access(int(ref),
+                        write=writes is not None and bool(writes[i]))
+            if not self.last_access[0]:
+                missed.append(i)
+                if victims is not None and self.evicted is not None:
+                    victims.append((i, self.evicted, self.evicted_dirty))
+        return refs, missed
+    
+    def _replay(self, refs, writes, track, victims=None):
+        """Replays the references, returning (refs, missed), the latter
+           being the sorted positions of those that missed if 'track'.
+           The blocks evicted are appended to 'victims' if given.
+        """
+        refs, tags, sets = self._split(refs)
+        if not len(tags):
+            return refs, ([] if track else None)
+        
+        nexts = None
+        if self.policy == 'opt' and self.index:
+            nexts = self._next_uses(refs)
+        self.position += len(tags)
+        
+        instruments = self.instruments
+        if instruments is not None:
+            track = True
+        
+        if writes is not None:
+            if np is not None:
+                writes = np.asarray(writes, dtype=bool)
+                if not writes.any():
+                    writes = None
+            else:
+                writes = [bool(w) for w in writes]
+                if not any(writes):
+                    writes = None
+        
+        if np is not None and self.ways == 1 and writes is None \
+                and victims is None:
+            missed = self._replay_direct(tags, sets)
+            if instruments is not None:
+                instruments.record(refs, sets, missed)
+            return refs, missed
+        
+        missed = [] if track else None
+        last_set = int(sets[-1])
+        if self.index:
+            replay_set = self._replay_indexed
+        elif self.replacement is not None:
+            replay_set = self._replay_bits
+        else:
+            replay_set = self._replay_set
+        
+        groups = self._group(tags, sets)
+        if self.policy == 'drrip' and self.replacement is not None:
+            # Sets depend on each other, but only through the leaders
+            groups = self.replacement.batch(groups)
+        
+        for s, group, positions in groups:
+            if writes is None:
+                group_writes = None
+            elif np is not None:
+                group_writes = writes[positions].tolist()
+            else:
+                group_writes = [writes[i] for i in positions]
+            
+            extra = {}
+            if victims is not None:
+                extra['victims'] = at_victims = []
+            if nexts is not None:
+                extra['nexts'] = nexts[positions].tolist() if np is not None \
+                    else [nexts[i] for i in positions]
+            elif self.policy == 'drrip' and self.replacement is not None:
+                extra['positions'] = positions
+            
+            if missed is None:
+                hits, last_access = replay_set(s, group, None, group_writes,
+                                               **extra)
+            else:
+                at = []
+                hits, last_access = replay_set(s, group, at, group_writes,
+                                               **extra)
+                missed.extend(positions[i] for i in at)
+            if victims is not None:
+                victims.extend((int(positions[i]), address, dirty)
+                               for i, address, dirty in at_victims)
+            self.hits += hits
+            self.misses += len(group) - hits
+            if s == last_set:
+                self.last_access = last_access
+        
+        if victims is not None:
+            victims.sort()
+        if missed is None:
+            return refs, None
+        missed.sort()
+        if np is not None:
+            missed = np.array(missed, dtype=np.int64)
+        if instruments is not None:
+            instruments.record(refs, sets, missed)
+        return refs, missed
+    
+    def _split(self, refs):
+        """Splits the references into their (refs, tags, sets)"""
+        if np is not None:
+            if isinstance(refs, (bytes, bytearray)):
+                raise TypeError('raw bytes have no item size, use a '
+                                'memoryview.cast() or an array instead')
+            refs = np.asarray(refs, dtype=np.int64)
+            blocks = refs // self.partition_size
+            return refs, blocks // self.sets, blocks % self.sets
+        
+        refs = list(refs)
+        tags = []
+        sets = []
+        for r in refs:
+            t, s = divmod(r // self.partition_size, self.sets)
+            tags.append(t)
+            sets.append(s)
+        return refs, tags, sets
+    
+    def _group(self, tags, sets):
+        """Yields (set, tags, positions) for every set, keeping the
+           access order, 'positions' being where the tags were
+        """
+        if np is not None:
+            order = np.argsort(sets, kind='stable')
+            sets = sets[order]
+            tags = tags[order].tolist()
+            bounds = np.flatnonzero(sets[1:] != sets[:-1]) + 1
+            start = 0
+            for end in bounds.tolist() + [len(tags)]:
+                yield int(sets[start]), tags[start:end], order[start:end]
+                start = end
+        else:
+            groups = {}
+            for i, (t, s) in enumerate(zip(tags, sets)):
+                group = groups.get(s)
+                if group is None:
+                    group = groups[s] = [], []
+                group[0].append(t)
+                group[1].append(i)
+            for s, (group, positions) in groups.items():
+                yield s, group, positions
+    
+    def _replay_set(self, s, refs, missed=None, writes=None, victims=None):
+        """Replays the given tags on set 's', returning how many hits
+           there were and what the last access was like. The index of
+           the tags that missed are appended to 'missed' if given, and
+           'writes' tells which of the tags are written if given.
+           (index, address, dirty) of every block evicted is appended to
+           'victims' if given.
+        """
+        start = s * self.ways
+        end = start + self.ways
+        policy = self.policy
+        state = self.state
+        
+        wtags = state.tags[start:end].tolist()
+        wvalid = list(state.valid[start:end])
+        wdirty = list(state.dirty[start:end])
+        wusecount = state.usecount[start:end].tolist()
+        wlast = state.lastuse[start:end].tolist()
+        wfirst = state.firstuse[start:end].tolist()
+        
+        # Lower ways win if the same tag is present more than once
+        lookup = {}
+        for way in reversed(range(self.ways)):
+            if wvalid[way]:
+                lookup[wtags[way]] = way
+        
+        write_back = self.write_back
+        write_allocate = self.write_allocate
+        fills = writebacks = through = 0
+        lifetimes = None
+        if self.instruments is not None:
+            lifetimes = self.instruments.lifetimes
+            evictions = self.instruments.evictions
+        
+        hits = 0
+        clock = state.clock[s]
+        hit = False
+        line = None
+        for i, t in enumerate(refs):
+            clock += 1
+            write = writes is not None and writes[i]
+            way = lookup.get(t)
+            if way is not None:
+                hit = True
+                hits += 1
+                wusecount[way] += 1
+                wlast[way] = clock
+                line = start + way
+                if write:
+                    if write_back:
+                        wdirty[way] = True
+                    else:
+                        through += 1
+                continue
+            
+            hit = False
+            if missed is not None:
+                missed.append(i)
+            if write and not write_allocate:
+                through += 1
+                line = None
+                continue
+            
+            if self.ways == 1:
+                way = 0
+            elif policy == 'lfu':
+                way = wusecount.index(min(wusecount))
+            elif policy == 'lru':
+                way = wlast.index(min(wlast))
+            else:
+                way = wfirst.index(min(wfirst))
+            
+            if wvalid[way]:
+                if lookup.get(wtags[way]) == way:
+                    del lookup[wtags[way]]
+                if wdirty[way]:
+                    writebacks += 1
+                if victims is not None:
+                    victims.append((i, self.address_of(wtags[way], s),
+                                    bool(wdirty[way])))
+                if lifetimes is not None:
+                    lifetimes[start + way] += clock - wfirst[way]
+                    evictions[start + way] += 1
+            
+            lookup[t] = way
+            wtags[way] = t
+            wvalid[way] = True
+            wusecount[way] = 1
+            wlast[way] = clock
+            wfirst[way] = clock
+            fills += 1
+            line = start + way
+            if write and write_back:
+                wdirty[way] = True
+            else:
+                wdirty[way] = False
+                if write:
+                    through += 1
+        
+        state.tags[start:end] = array('q', wtags)
+        state.valid[start:end] = bytes(wvalid)
+        state.dirty[start:end] = bytes(wdirty)
+        state.usecount[start:end] = array('Q', wusecount)
+        state.lastuse[start:end] = array('Q', wlast)
+        state.firstuse[start:end] = array('Q', wfirst)
+        state.clock[s] = clock
+        self._account(fills, writebacks, through)
+        return hits, (hit, line)
+    
+    def _replay_indexed(self, s, refs, missed=None, writes=None,
+                        nexts=None, victims=None):
+        """Like '_replay_set', but relying on the set's index. 'nexts'
+           tells when every tag will be used next, for the 'opt' policy.
+        """
+        start = s * self.ways
+        state = self.state
+        index = self.index[s]
+        lookup = index.lookup
+        tags = state.tags
+        valid = state.valid
+        dirty = state.dirty
+        usecount = state.usecount
+        lastuse = state.lastuse
+        firstuse = state.firstuse
+        nextuse = state.nextuse
+        
+        write_back = self.write_back
+        write_allocate = self.write_allocate
+        fills = writebacks = through = 0
+        lifetimes = None
+        if self.instruments is not None:
+            lifetimes = self.instruments.lifetimes
+            evictions = self.instruments.evictions
+        
+        hits = 0
+        clock = state.clock[s]
+        hit = False
+        line = None
+        for i, t in enumerate(refs):
+            clock += 1
+            write = writes is not None and writes[i]
+            way = lookup.get(t)
+            if way is not None:
+                hit = True
+                hits += 1
+                line = start + way
+                usecount[line] += 1
+                lastuse[line] = clock
+                if nexts is not None:
+                    nextuse[line] = nexts[i]
+                index.used(way, state, start)
+                if write:
+                    if write_back:
+                        dirty[line] = True
+                    else:
+                        through += 1
+                continue
+            
+            hit = False
+            if missed is not None:
+                missed.append(i)
+            if write and not write_allocate:
+                through += 1
+                line = None
+                continue
+            
+            way = index.victim(state, start)
+            line = start + way
+            if valid[line]:
+                index.fill(way, t, tags[line])
+                if dirty[line]:
+                    writebacks += 1
+                if victims is not None:
+                    victims.append((i, self.address_of(tags[line], s),
+                                    bool(dirty[line])))
+                if lifetimes is not None:
+                    lifetimes[line] += clock - firstuse[line]
+                    evictions[line] += 1
+            else:
+                index.fill(way, t)
+            tags[line] = t
+            valid[line] = True
+            usecount[line] = 1
+            lastuse[line] = clock
+            firstuse[line] = clock
+            if nexts is not None:
+                nextuse[line] = nexts[i]
+                index.used(way, state, start)
+            fills += 1
+            if write and write_back:
+                dirty[line] = True
+            else:
+                dirty[line] = False
+                if write:
+                    through += 1
+        
+        state.clock[s] = clock
+        self._account(fills, writebacks, through)
+        return hits, (hit, line)
+    
+    def _replay_bits(self, s, refs, missed=None, writes=None,
+                     positions=None, victims=None):
+        """Like '_replay_set', but for the policies from 'replacement'.
+           'positions' tells where every tag was in the batch ('drrip').
+        """
+        start = s * self.ways
+        end = start + self.ways
+        state = self.state
+        policy = self.replacement
+        tags = state.tags
+        valid = state.valid
+        dirty = state.dirty
+        usecount = state.usecount
+        lastuse = state.lastuse
+        firstuse = state.firstuse
+        
+        # Lower ways win if the same tag is present more than once
+        lookup = {}
+        for line in reversed(range(start, end)):
+            if valid[line]:
+                lookup[tags[line]] = line - start
+        
+        write_back = self.write_back
+        write_allocate = self.write_allocate
+        fills = writebacks = through = 0
+        lifetimes = None
+        if self.instruments is not None:
+            lifetimes = self.instruments.lifetimes
+            evictions = self.instruments.evictions
+        
+        hits = 0
+        clock = state.clock[s]
+        hit = False
+        line = None
+        for i, t in enumerate(refs):
+            clock += 1
+            write = writes is not None and writes[i]
+            way = lookup.get(t)
+            if way is not None:
+                hit = True
+                hits += 1
+                line = start + way
+                usecount[line] += 1
+                lastuse[line] = clock
+                policy.hit(state, s, way)
+                if write:
+                    if write_back:
+                        dirty[line] = True
+                    else:
+                        through += 1
+                continue
+            
+            hit = False
+            if missed is not None:
+                missed.append(i)
+            if write and not write_allocate:
+                through += 1
+                line = None
+                continue
+            
+            line = valid.find(0, start, end)
+            if line == -1:
+                line = start + policy.victim(state, s)
+            way = line - start
+            if valid[line]:
+                if lookup.get(tags[line]) == way:
+                    del lookup[tags[line]]
+                if dirty[line]:
+                    writebacks += 1
+                if victims is not None:
+                    victims.append((i, self.address_of(tags[line], s),
+                                    bool(dirty[line])))
+                if lifetimes is not None:
+                    lifetimes[line] += clock - firstuse[line]
+                    evictions[line] += 1
+            
+            lookup[t] = way
+            tags[line] = t
+            valid[line] = True
+            usecount[line] = 1
+            lastuse[line] = clock
+            firstuse[line] = clock
+            policy.fill(state, s, way,
+                        None if positions is None else positions[i])
+            fills += 1
+            if write and write_back:
+                dirty[line] = True
+            else:
+                dirty[line] = False
+                if write:
+                    through += 1
+        
+        state.clock[s] = clock
+        self._account(fills, writebacks, through)
+        return hits, (hit, line)
+    
+    def _account(self, fills, writebacks, through):
+        """Accounts the memory traffic of a batch of accesses"""
+        self.bytes_read += fills * self.block_bytes
+        self.bytes_written += (writebacks * self.block_bytes
+                               + through * self.word_size)
+        self.writebacks += writebacks
+    
+    def _replay_direct(self, tags, sets):
+        """Direct mapping fast path, there is no choice on where to put
+           a block so an access hits if and only if the previous access
+           to the same set was for the same tag (and it was valid).
+           
+           Returns the positions of the references that missed.
+        """
+        n = len(tags)
+        order = np.argsort(sets, kind='stable')
+        sets = sets[order]
+        tags = tags[order]
+        
+        first = np.empty(n, dtype=bool)
+        first[0] = True
+        first[1:] = sets[1:] != sets[:-1]
+        last = np.empty(n, dtype=bool)
+        last[-1] = True
+        last[:-1] = first[1:]
+        
+        # The state is modified in-place through views over its arrays
+        state = self.state
+        ctags = np.frombuffer(state.tags, dtype=np.int64)
+        cvalid = np.frombuffer(state.valid, dtype=np.uint8)
+        cdirty = np.frombuffer(state.dirty, dtype=np.uint8)
+        usecount = np.frombuffer(state.usecount, dtype=np.uint64)
+        lastuse = np.frombuffer(state.lastuse, dtype=np.uint64)
+        firstuse = np.frombuffer(state.firstuse, dtype=np.uint64)
+        clock = np.frombuffer(state.clock, dtype=np.uint64)
+        
+        # The previous tag is the one in the cache for the first access
+        prev = np.empty(n, dtype=np.int64)
+        prev[1:] = tags[:-1]
+        prev[first] = ctags[sets[first]]
+        prev_valid = np.ones(n, dtype=bool)
+        prev_valid[first] = cvalid[sets[first]] != 0
+        hit = prev_valid & (prev == tags)
+        
+        hits = int(np.count_nonzero(hit))
+        self.hits += hits
+        self.misses += n - hits
+        
+        # Every access since the last miss on each set was a hit, which
+        # determines the use count and first use for the final block
+        pos = np.arange(n)
+        start = np.maximum.accumulate(np.where(first, pos, 0))
+        mark = np.maximum.accumulate(np.where(first | ~hit, pos, 0))
+        mark, start = mark[last], start[last]
+        since_miss = ~hit[mark]
+        last_sets = sets[last]
+        
+        # Only the first miss on a set can find the old block (if dirty)
+        missed_sets = last_sets[
+            np.logical_or.reduceat(~hit, np.flatnonzero(first))]
+        writebacks = int(np.count_nonzero(
+            cvalid[missed_sets] & cdirty[missed_sets]))
+        cdirty[missed_sets] = 0
+        self._account(n - hits, writebacks, 0)
+        
+        if self.instruments is not None:
+            # Every miss evicts the block brought by the previous miss on
+            # the same set, or the one that was there before (if any)
+            miss = np.flatnonzero(~hit)
+            miss_sets = sets[miss]
+            group_start = np.maximum.accumulate(np.where(first, pos, 0))
+            now = clock[miss_sets] + (miss - group_start[miss] + 1) \
+                .astype(np.uint64)
+            filled = np.empty(len(miss), dtype=np.uint64)
+            filled[1:] = now[:-1]
+            evicts = np.ones(len(miss), dtype=bool)
+            new_set = np.ones(len(miss), dtype=bool)
+            new_set[1:] = miss_sets[1:] != miss_sets[:-1]
+            filled[new_set] = firstuse[miss_sets[new_set]]
+            evicts[new_set] = cvalid[miss_sets[new_set]] != 0
+            self.instruments.evicted(miss_sets[evicts],
+                                     (now - filled)[evicts])
+        
+        old_clock = clock[last_sets]
+        new_clock = old_clock + (pos[last] - start + 1).astype(np.uint64)
+        usecount[last_sets] = np.where(
+            since_miss, (pos[last] - mark + 1).astype(np.uint64),
+            usecount[last_sets] + (pos[last] - mark + 1).astype(np.uint64))
+        firstuse[last_sets] = np.where(
+            since_miss, old_clock + (mark - start + 1).astype(np.uint64),
+            firstuse[last_sets])
+        lastuse[last_sets] = new_clock
+        clock[last_sets] = new_clock
+        ctags[last_sets] = tags[last]
+        cvalid[last_sets] = 1
+        
+        at = int(np.flatnonzero(order == n - 1)[0])
+        self.last_access = bool(hit[at]), int(sets[at])
+        return np.sort(order[~hit])
+    
+    def _victim(self, start, index):
+        """Returns the way that the policy chooses to evict on the set
+           starting at the partition 'start'
+        """
+        if self.ways == 1:
+            # Single way, no choice
+            return 0
+        
+        if index is not None:
+            # The index keeps the ways in the order they're evicted
+            return index.victim(self.state, start)
+        
+        if self.replacement is not None:
+            # Empty ways first, or whatever the policy chooses
+            way = self.state.valid.find(0, start, start + self.ways)
+            if way != -1:
+                return way - start
+            return self.replacement.victim(self.state, start // self.ways)
+        
+        if self.policy == 'lfu':
+            # Least Frequently Used, where usecount is minimum
+            order = self.state.usecount
+        elif self.policy == 'lru':
+            # Least Recently Used, where lastuse is oldest
+            order = self.state.lastuse
+        else:
+            # First In, First Out, where firstuse is oldest
+            order = self.state.firstuse
+        
+        end = start + self.ways
+        return order.index(min(order[start:end]), start, end) - start
+    
+    def _fill(self, s, way, t, now, index, next_use=NEVER):
+        """Places the tag on the given way of set 's', returning the address
+           of the block that was evicted from there (None if it was empty)
+        """
+        state = self.state
+        line = s * self.ways + way
+        evicted = None
+        self.evicted_dirty = False
+        if state.valid[line]:
+            evicted = self.address_of(state.tags[line], s)
+            if state.dirty[line]:
+                self._account(0, 1, 0)
+                self.evicted_dirty = True
+        state.dirty[line] = False
+        if index is not None:
+            index.fill(way, t, state.tags[line] if evicted is not None else None)
+        state.tags[line] = t
+        state.valid[line] = True
+        
+        # Reset everything (first use, last and first time now)
+        state.usecount[line] = 1
+        state.lastuse[line] = now
+        state.firstuse[line] = now
+        state.nextuse[line] = next_use
+        if index is not None and self.policy == 'opt':
+            index.used(way, state, s * self.ways)
+        elif self.replacement is not None:
+            self.replacement.fill(state, s, way)
+        return evicted
+    
+    def _line_of(self, ref):
+        """Returns (set, line) for the reference, line being -1 if it's
+           not present in the cache
+        """
+        t, s = divmod(ref // self.partition_size, self.sets)
+        start = s * self.ways
+        if self.index:
+            way = self.index[s].lookup.get(t)
+            return s, (-1 if way is None else start + way)
+        return s, self.state.find(start, start + self.ways, t)
+    
+    def contains(self, ref):
+        """Is the block holding the reference present in the cache?
+           This does not count as an access.
+        """
+        return self._line_of(ref)[1] != -1
+    
+    def is_dirty(self, ref):
+        """Is the block holding the reference present and dirty? This
+           does not count as an access.
+        """
+        line = self._line_of(ref)[1]
+        return line != -1 and bool(self.state.dirty[line])
+    
+    def invalidate(self, ref, write_back=True):
+        """Invalidates the block holding the reference, returning whether
+           it was present. The partition will be the next to be used.
+           
+           A dirty block is written back unless 'write_back' is False, for
+           when its data is moved somewhere else instead.
+        """
+        s, line = self._line_of(ref)
+        if line == -1:
+            return False
+        
+        state = self.state
+        if self.index:
+            self.index[s].empty(line - s * self.ways, state.tags[line])
+        if state.dirty[line] and write_back:
+            self._account(0, 1, 0)
+        state.valid[line] = False
+        state.dirty[line] = False
+        state.usecount[line] = 0
+        state.lastuse[line] = 0
+        state.firstuse[line] = 0
+        state.nextuse[line] = 0
+        return True
+    
+    def insert(self, ref, dirty=False):
+        """Places the block holding the reference without counting it as
+           an access, returning the address of the block that had to be
+           evicted for it (None if it was already present or not needed)
+        """
+        s, line = self._line_of(ref)
+        if line != -1:
+            if dirty:
+                self.state.dirty[line] = True
+            return None
+        
+        state = self.state
+        now = state.clock[s] + 1
+        state.clock[s] = now
+        index = self.index[s] if self.index else None
+        way = self._victim(s * self.ways, index)
+        t = ref // self.partition_size // self.sets
+        evicted = self._fill(s, way, t, now, index)
+        self.state.dirty[s * self.ways + way] = dirty
+        return evicted
+    
+    def flush(self):
+        """Writes back every dirty block, returning how many there were"""
+        dirty = self.state.dirty
+        count = dirty.count(1)
+        self._account(0, count, 0)
+        dirty[:] = bytes(len(dirty))
+        return count
+    
+    def _save(self):
+        """Returns a copy of the state and counters to '_restore' later,
+           for caches that have no index, instruments nor plan
+        """
+        return (self.state.copy(), self.hits, self.misses, self.position,
+                self.bytes_read, self.bytes_written, self.writebacks,
+                self.last_access, self.evicted, self.evicted_dirty,
+                getattr(self.replacement, 'psel', None))
+    
+    def _restore(self, saved):
+        """Goes back to the state and counters given by '_save' (which
+           becomes the state in use, so it can only be restored once)
+        """
+        (self.state, self.hits, self.misses, self.position,
+         self.bytes_read, self.bytes_written, self.writebacks,
+         self.last_access, self.evicted, self.evicted_dirty, psel) = saved
+        if psel is not None:
+            self.replacement.psel = psel
+    
+    def address_of(self, tag, set_):
+        """Returns the first address of the block with this tag and set"""
+        return (tag * self.sets + set_) * self.partition_size
+    
+    def _reason(self, line, now):
+        """Why the policy chose to evict the given partition"""
+        state = self.state
+        if self.ways == 1:
+            return None
+        elif self.replacement is not None:
+            return self.replacement.reason
+        elif self.policy == 'lfu':
+            return 'it was only used {} times'.format(state.usecount[line])
+        elif self.policy == 'lru':
+            return 'it was last used {}t ago'.format(now - state.lastuse[line])
+        elif self.policy == 'opt':
+            if state.nextuse[line] == NEVER:
+                return 'it is never used again'
+            return 'it is used again the furthest, at {}' \
+                   .format(state.nextuse[line])
+        else:
+            return 'it was first added at {}t'.format(now - state.firstuse[line])
+    
     def reset(self):
         """Resets the status of the cache"""
-        self.valid = [False] * self.partitions
-        self.tags = [0] * self.partitions
+        # Tags, validity and policy related (use count, last and
+        # first use) information of every partition
+        self.state = CacheState(self.sets, self.ways)
+        if self.replacement is not None:
+            self.replacement.reset(self.state)
+        
+        # Highly associative caches also index every set
+        if self.indexed:
+            self.index = [SetIndex(self.ways, self.policy)
+                          for _ in range(self.sets)]
+        else:
+            self.index = None
         
         # Stats
         self.misses = 0
         self.hits = 0
         
+        # How many references were accessed, and those planned from
+        # 'planned' on (when each of them will be used next, for 'opt')
+        self.position = 0
+        self.planned = 0
+        self.future = None
+        
         # Was hit? At which partition? (tuple)
         self.last_access = None, None
         
-        # Policy related
-        self.usecount  = [0] * self.partitions  # 'lfu'
-        self.lasttime  = [0] * self.partitions  # 'lru'
-        self.firsttime = [0] * self.partitions  # 'fifo'
+        # Address of the block evicted by the last access, if any, and
+        # whether it was dirty (and so written back)
+        self.evicted = None
+        self.evicted_dirty = False
+        
+        # Draws the cache on every access with 'draw=True'
+        self.renderer = None
+        
+        # Optional instrumentation of every access
+        self.instruments = Instruments(self) if self.instrument else None
+        
+        # Memory traffic with the next level, in bytes
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.writebacks = 0
     
     def __str__(self):
         return '(Cache(partitions={}, size={}, sets={}, ways={}, ' \
@@ -247,50 +1513,71 @@ class Cache:
         if self.valid[partition]:
             set_ = partition // self.ways
             tag  = self.tags[partition]
-            
-            memory_block = (tag << set_.bit_length()) | set_
-            start = memory_block * self.partition_size
+            start = self.address_of(tag, set_)
             
             return '{}-{}'.format(start, start + self.partition_size - 1)
         return ''
-
-    def draw(self, show_partition=True, show_content=True, show_way=True):
+    
+    def _draw_paddings(self):
+        """Returns the (partition, content) paddings used when drawing"""
         partition_padding = len(str(self.partitions - 1))
-        ways_padding = len(str(self.ways - 1))
         content_padding = max(
             # len(largest) + len('-') + len(largest)
             1 + 2*len(str(self.partitions * self.partition_size)),
             len('Content')
         )
+        return partition_padding, content_padding
+    
+    def _draw_items(self, i, show_partition, show_content, show_way,
+                    paddings):
+        """Returns the items drawn for the partition 'i'"""
+        partition_padding, content_padding = paddings
+        items = []
+        if show_partition:
+            items.append(str(i).rjust(partition_padding))
+        
+        if show_content:
+            content = self.content_of(i).center(content_padding)
+            hit, at = self.last_access
+            if colorama and i == at:
+                if hit:
+                    items.append(colorama.Back.GREEN +
+                                 content +
+                                 colorama.Style.RESET_ALL)
+                else:
+                    items.append(colorama.Back.RED +
+                                 content +
+                                 colorama.Style.RESET_ALL)
+            else:
+                items.append(content)
+        
+        if show_way:
+            items.append(str(i % self.ways).ljust(partition_padding))
+        
+        return items
+    
+    def draw_row(self, i, show_partition=True, show_content=True,
+                 show_way=True):
+        """Returns the line drawn for the partition 'i' alone"""
+        items = self._draw_items(i, show_partition, show_content, show_way,
+                                 self._draw_paddings())
+        return '│' + '│'.join(items) + '│'
+    
+    def draw_lines(self, show_partition=True, show_content=True,
+                   show_way=True):
+        """Returns the lines that 'draw' would print. The partition 'i'
+           is drawn on the line 'partitions + 1 - i' (the last ones first).
+        """
+        paddings = self._draw_paddings()
+        partition_padding, content_padding = paddings
         
         # Resulting items will be spread accross many lines
         lines = []
         
         # All the partitions in the cache
         for i in range(self.partitions):
-            items = []
-            if show_partition:
-                items.append(str(i).rjust(partition_padding))
-            
-            if show_content:
-                content = self.content_of(i).center(content_padding)
-                hit, at = self.last_access
-                if colorama and i == at:
-                    if hit:
-                        items.append(colorama.Back.GREEN +
-                                     content +
-                                     colorama.Style.RESET_ALL)
-                    else:
-                        items.append(colorama.Back.RED +
-                                     content +
-                                     colorama.Style.RESET_ALL)
-                else:
-                    items.append(content)
-            
-            if show_way:
-                items.append(str(i % self.ways).ljust(partition_padding))
-            
-            lines.append(items)
+            lines.append(self._draw_items(i, show_partition, show_content,
+                                          show_way, paddings))
         
         # Then the column headers
         items = []
@@ -328,16 +1615,21 @@ class Cache:
             line.append('┴')
         line[-1] = '┘';
         result.append(''.join(line))
-        print('\n'.join(result))
+        return result
+    
+    def draw(self, show_partition=True, show_content=True, show_way=True):
+        print('\n'.join(self.draw_lines(show_partition, show_content,
+                                        show_way)))
 
 
-def plot_ways(policy='lru'):
+def plot_ways(policy='lru', refs=None):
     if np is None or plt is None:
         print('numpy and matplotlib are required for plotting')
         return
     
     fig, ax = plt.subplots()
-    refs = '1 65 129 193 1 129 1 65 129 1 1 65 129 129'
+    if refs is None:
+        refs = '1 65 129 193 1 129 1 65 129 1 1 65 129 129'
     psize = 4
     partc = 16
     
@@ -345,8 +1637,22 @@ def plot_ways(policy='lru'):
     hits = []
     miss = []
     
+    if policy == 'lru':
+        # A single pass per number of sets is enough for every way
+        from stackdist import LRUProfile
+        profile = LRUProfile(parse_refs(refs), psize, max_sets=partc)
+    else:
+        profile = None
+    
     wayc = 1 
     while wayc <= partc:
+        if profile:
+            ways.append(wayc)
+            hits.append(profile.hits(partc, wayc))
+            miss.append(profile.misses(partc, wayc))
+            wayc *= 2
+            continue
+        
         c = Cache(psize, partc, wayc, policy)
         c.access_all(refs)
         ways.append(wayc)
@@ -365,13 +1671,14 @@ def plot_ways(policy='lru'):
     ax.set_xscale('log', basex=2)
     plt.show()
 
-def plot_psize():
+def plot_psize(refs=None):
     if np is None or plt is None:
         print('numpy and matplotlib are required for plotting')
         return
     
     fig, ax = plt.subplots()
-    refs = '1 4 8 5 20 17 19 56 9 11 4 43 5 6 9 17 181'
+    if refs is None:
+        refs = '1 4 8 5 20 17 19 56 9 11 4 43 5 6 9 17 181'
     psize = 1
     partc = 16
     
@@ -401,13 +1708,16 @@ def plot_psize():
 
 
 def draw_example():
+    import asyncio
+    from render import animate
+    
     c = Cache(4, 8, 2, 'lru')
+    refs = []
     for i in range(3):
-     for j in range(32):
-      c.access(j, draw=True, delay_hit=0.05, delay_miss=0.2)
-     for j in range(32+4, 32+8):
-      c.access(j, draw=True, delay_hit=0.05, delay_miss=0.2)
-
+     refs.extend(range(32))
+     refs.extend(range(32+4, 32+8))
+    
+    asyncio.run(animate(c, refs, delay_hit=0.05, delay_miss=0.2))
     print(c)
 
 
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+"""A set-associative cache for Python objects, which works exactly as the
+   simulated 'Cache' does, so that a configuration tuned by replaying
+   traces behaves the same when used for real.
+
+   Keys are placed on the set given by their hash, and each set has
+   'ways' entries indexed by a 'SetIndex', which chooses the victims with
+   the same policies (and ties) as the simulator. Lookups and insertions
+   take constant time ('lfu' being logarithmic on the ways). The hardware
+   policies from 'replacement' can be used too, except for 'opt'.
+
+   Given the same integer keys (not negative and smaller than 2**61, so
+   that they are their own hash), an 'ObjectCache(partitions, ways, policy)'
+   has the same hits and misses as 'Cache(1, partitions, ways, policy)'
+   as long as every miss is followed by putting the key in, which is what
+   'memoize' does.
+"""
+import functools
+import threading
+from collections import namedtuple
+
+from memory import CacheState, SetIndex
+from replacement import POLICIES as REPLACEMENTS
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses partitions size')
+
+# Tells apart missing keys from those whose value is None
+_MISSING = object()
+
+
+class ObjectCache:
+    def __init__(self, partitions, ways=1, policy=None, seed=0):
+        """partitions = how many entries the cache can hold
+           ways       = entries per set, as in 'Cache'
+           policy     = replacement policy when 'ways' ≠ 1, as in 'Cache'
+           seed       = seed for the 'random' policy
+        """
+        if ways != 1 and policy is None:
+            raise ValueError('A policy is required unless using direct mapping')
+
+        if policy not in [None, 'lfu', 'lru', 'fifo'] \
+                and policy not in REPLACEMENTS:
+            raise ValueError('Unknown policy given: '+policy)
+
+        if partitions % ways:
+            raise ValueError('The partitions must be a multiple of the ways')
+
+        self.partitions = partitions
+        self.ways = ways
+        self.sets = partitions // ways
+        self.policy = policy
+        self.seed = seed
+        if policy in REPLACEMENTS and ways != 1:
+            self.replacement = REPLACEMENTS[policy](ways, self.sets, seed)
+        else:
+            self.replacement = None
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Removes every entry and resets the counters"""
+        with self.lock:
+            self.state = CacheState(self.sets, self.ways)
+            if self.replacement is not None:
+                self.replacement.reset(self.state)
+            self.index = [SetIndex(self.ways, self.policy)
+                          for _ in range(self.sets)]
+            self.keys = [None] * self.partitions
+            self.values = [None] * self.partitions
+            self.hits = 0
+            self.misses = 0
+            self.size = 0
+
+    def get(self, key, default=None):
+        """Returns the value of the key, counting it as a hit, or counts a
+           miss and returns 'default'
+        """
+        s = hash(key) % self.sets
+        with self.lock:
+            state = self.state
+            index = self.index[s]
+            state.clock[s] += 1
+            way = index.lookup.get(key)
+            if way is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            start = s * self.ways
+            line = start + way
+            state.usecount[line] += 1
+            state.lastuse[line] = state.clock[s]
+            index.used(way, state, start)
+            if self.replacement is not None:
+                self.replacement.hit(state, s, way)
+            return self.values[line]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value):
+        """Places the value of the key, evicting another entry from its
+           set if it's full. Placing a key again only replaces its value.
+        """
+        s = hash(key) % self.sets
+        with self.lock:
+            state = self.state
+            index = self.index[s]
+            start = s * self.ways
+            way = index.lookup.get(key)
+            if way is not None:
+                self.values[start + way] = value
+                return
+
+            if self.replacement is not None and not index.free:
+                way = self.replacement.victim(state, s)
+            else:
+                way = index.victim(state, start)
+
+            line = start + way
+            if state.valid[line]:
+                index.fill(way, key, self.keys[line])
+            else:
+                index.fill(way, key)
+                self.size += 1
+            state.valid[line] = True
+            state.usecount[line] = 1
+            state.lastuse[line] = state.clock[s]
+            state.firstuse[line] = state.clock[s]
+            if self.replacement is not None:
+                self.replacement.fill(state, s, way)
+            self.keys[line] = key
+            self.values[line] = value
+
+    def pop(self, key, default=_MISSING):
+        """Removes the key, returning its value (which is not an access)"""
+        s = hash(key) % self.sets
+        with self.lock:
+            index = self.index[s]
+            way = index.lookup.get(key)
+            if way is None:
+                if default is _MISSING:
+                    raise KeyError(key)
+                return default
+
+            state = self.state
+            line = s * self.ways + way
+            value = self.values[line]
+            index.empty(way, key)
+            state.valid[line] = False
+            state.usecount[line] = 0
+            state.lastuse[line] = 0
+            state.firstuse[line] = 0
+            self.keys[line] = None
+            self.values[line] = None
+            self.size -= 1
+            return value
+
+    def __contains__(self, key):
+        """Is the key present? This does not count as an access."""
+        with self.lock:
+            return key in self.index[hash(key) % self.sets].lookup
+
+    def __len__(self):
+        return self.size
+
+    def info(self):
+        """Returns the hits, misses, partitions and current size"""
+        with self.lock:
+            return CacheInfo(self.hits, self.misses,
+                             self.partitions, self.size)
+
+    def __str__(self):
+        return '(ObjectCache(partitions={}, sets={}, ways={}, hits={}, ' \
+               'misses={}, policy="{}"))' \
+               .format(self.partitions, self.sets, self.ways,
+                       self.hits, self.misses, self.policy)
+
+
+def _make_key(args, kwargs):
+    """Builds a hashable key from the arguments of a call"""
+    if kwargs:
+        return args + (_MISSING,) + tuple(sorted(kwargs.items()))
+    if len(args) == 1 and type(args[0]) in (int, str):
+        return args[0]
+    return args
+
+
+def memoize(partitions=1024, ways=8, policy='lru', seed=0):
+    """Decorator that remembers the results of a function on an
+       'ObjectCache', which is available as its 'cache' attribute.
+       It's safe to call from several threads, although concurrent
+       calls with the same arguments may compute the result each.
+    """
+    def decorator(function):
+        cache = ObjectCache(partitions, ways, policy, seed)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            value = cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = function(*args, **kwargs)
+                cache.put(key, value)
+            return value
+
+        wrapper.cache = cache
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+if __name__ == '__main__':
+    import random
+    from memory import Cache
+
+    keys = [int(random.paretovariate(1)) for _ in range(100000)]
+    for policy in ('lru', 'lfu', 'fifo', 'plru', 'srrip'):
+        @memoize(256, 8, policy)
+        def square(n):
+            return n * n
+
+        for k in keys:
+            assert square(k) == k * k
+
+        c = Cache(1, 256, 8, policy)
+        c.replay(keys)
+        print(square.cache, 'simulated', c.hits, 'hits and',
+              c.misses, 'misses')
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+"""Hardware prefetchers, which bring blocks into a 'Cache' before they
+   are accessed by guessing them from the accesses made so far.
+
+   Prefetchers only suggest which blocks to bring, and 'Prefetching' puts
+   them in the cache (with 'Cache.insert', so they are not accesses) and
+   keeps track of what happens to them:
+   * issued   : blocks that were brought (those present are not).
+   * useful   : prefetched blocks that were accessed before being evicted.
+   * useless  : prefetched blocks that were evicted without being used.
+   * late     : useful blocks that were accessed before they had time to
+                arrive, 'latency' accesses after they were prefetched.
+
+   From them, the accuracy is the fraction of issued prefetches that were
+   useful, the coverage the fraction of misses that prefetching avoided
+   (the useful prefetches out of them plus the misses left), and the
+   lateness the fraction of useful prefetches that came late.
+
+   The prefetchers are:
+   * 'NextLine' : the next blocks after a miss, or after the first use of
+                  a prefetched block (tagged prefetching).
+   * 'Stride'   : a reference prediction table which learns the stride
+                  between consecutive accesses of the same instruction
+                  (or memory region, if the trace has no program counters)
+                  and prefetches along it once it's steady.
+   * 'Stream'   : follows streams of misses going up or down through
+                  nearby blocks, and runs ahead of them once confirmed.
+
+   Prefetching makes every set depend on the others, so the references
+   are always accessed one by one in order.
+"""
+from collections import OrderedDict
+
+from memory import parse_refs
+
+
+class NextLine:
+    def __init__(self, degree=1):
+        """degree = how many of the following blocks to prefetch"""
+        self.degree = degree
+
+    def reset(self, partition_size):
+        """Forgets everything, before prefetching blocks of the given size
+           (in words) into an empty cache
+        """
+
+    def observe(self, ref, block, hit, first_use, pc=None):
+        """Returns the blocks to prefetch after accessing 'block'. 'hit'
+           tells whether it was present, and 'first_use' whether this was
+           the first access to it since it was prefetched.
+        """
+        if hit and not first_use:
+            return ()
+        return range(block + 1, block + 1 + self.degree)
+
+
+# States of an entry on the reference prediction table
+INITIAL = 0
+TRANSIENT = 1
+STEADY = 2
+NO_PREDICTION = 3
+
+
+class Stride:
+    def __init__(self, entries=64, degree=2, region=4096):
+        """entries = size of the reference prediction table
+           degree  = how many strides ahead to prefetch when steady
+           region  = size of the memory regions (in words) that entries
+                     are kept for when the accesses have no 'pc'
+        """
+        self.entries = entries
+        self.degree = degree
+        self.region = region
+        self.reset(1)
+
+    def reset(self, partition_size):
+        # Key (program counter or region) to [last ref, stride, state]
+        self.table = OrderedDict()
+        self.partition_size = partition_size
+
+    def observe(self, ref, block, hit, first_use, pc=None):
+        key = ('region', ref // self.region) if pc is None else pc
+        entry = self.table.get(key)
+        if entry is None:
+            self.table[key] = [ref, 0, INITIAL]
+            if len(self.table) > self.entries:
+                self.table.popitem(last=False)
+            return ()
+
+        self.table.move_to_end(key)
+        last, stride, state = entry
+        correct = ref - last == stride
+        if correct:
+            state = STEADY if state != NO_PREDICTION else TRANSIENT
+        elif state == STEADY:
+            state = INITIAL
+        elif state == INITIAL:
+            state, stride = TRANSIENT, ref - last
+        else:
+            state, stride = NO_PREDICTION, ref - last
+        entry[:] = ref, stride, state
+
+        if state != STEADY or not stride:
+            return ()
+        return [(ref + stride * k) // self.partition_size
+                for k in range(1, self.degree + 1)]
+
+
+class Stream:
+    def __init__(self, streams=16, window=16, distance=16, degree=4,
+                 confirm=2):
+        """streams  = how many streams are tracked at once
+           window   = how close (in blocks) a miss must be to a stream
+           distance = how far ahead of the stream blocks are prefetched
+           degree   = how many blocks are prefetched at once
+           confirm  = how many misses in the same direction confirm it
+        """
+        self.streams = streams
+        self.window = window
+        self.distance = distance
+        self.degree = degree
+        self.confirm = confirm
+        self.reset(1)
+
+    def reset(self, partition_size):
+        # [last block, direction, confirmations, furthest prefetched]
+        self.tracked = []
+
+    def observe(self, ref, block, hit, first_use, pc=None):
+        if hit and not first_use:
+            return ()
+
+        for i, stream in enumerate(self.tracked):
+            last, direction, confirmed, head = stream
+            delta = block - last
+            if delta and abs(delta) <= self.window:
+                break
+        else:
+            self.tracked.insert(0, [block, 0, 0, block])
+            del self.tracked[self.streams:]
+            return ()
+
+        # Most recently used streams are kept first
+        del self.tracked[i]
+        self.tracked.insert(0, stream)
+        step = 1 if delta > 0 else -1
+        if step == direction:
+            confirmed += 1
+        else:
+            direction, confirmed, head = step, 1, block
+
+        stream[:] = block, direction, confirmed, head
+        if confirmed < self.confirm:
+            return ()
+
+        # Run ahead of the block, up to the distance
+        start = max(head, block) if direction > 0 else min(head, block)
+        end = block + direction * self.distance
+        blocks = list(range(start + direction, end + direction,
+                            direction))[:self.degree]
+        if blocks:
+            stream[3] = blocks[-1]
+        return blocks
+
+
+class Prefetching:
+    def __init__(self, cache, prefetcher, latency=0):
+        """cache      = the 'Cache' to prefetch into
+           prefetcher = the prefetcher which chooses the blocks
+           latency    = how many accesses a prefetched block takes to
+                        arrive, to tell late prefetches apart
+        """
+        self.cache = cache
+        self.prefetcher = prefetcher
+        self.latency = latency
+        self._clear()
+
+    def reset(self):
+        """Resets the cache, the prefetcher and the counters"""
+        self.cache.reset()
+        self._clear()
+
+    def _clear(self):
+        self.prefetcher.reset(self.cache.partition_size)
+        self.issued = 0
+        self.useful = 0
+        self.useless = 0
+        self.late = 0
+        self.now = 0
+        # Prefetched blocks not used yet, and when they arrive
+        self.pending = {}
+
+    def _evicted(self, address):
+        """Accounts for the block at 'address' having been evicted"""
+        if address is not None \
+                and self.pending.pop(address // self.cache.partition_size,
+                                     None) is not None:
+            self.useless += 1
+
+    def access(self, ref, write=False, pc=None):
+        """Accesses a single reference and then prefetches whatever the
+           prefetcher suggests. Returns whether it hit.
+        """
+        cache = self.cache
+        psize = cache.partition_size
+        self.now += 1
+        block = ref // psize
+        cache.access(ref, write=write)
+        hit = bool(cache.last_access[0])
+        self._evicted(cache.evicted)
+
+        first_use = False
+        arrival = self.pending.pop(block, None)
+        if arrival is not None:
+            if hit:
+                first_use = True
+                self.useful += 1
+                if arrival > self.now:
+                    self.late += 1
+
+        for b in self.prefetcher.observe(ref, block, hit, first_use, pc):
+            if b < 0 or cache.contains(b * psize):
+                continue
+            self._evicted(cache.insert(b * psize))
+            cache.bytes_read += cache.block_bytes
+            self.issued += 1
+            self.pending[b] = self.now + self.latency
+
+        return hit
+
+    def replay(self, refs, writes=None, pcs=None):
+        """Accesses all the references in order, 'writes' and 'pcs'
+           telling which are writes and their program counters if given
+        """
+        refs = parse_refs(refs)
+        for i, ref in enumerate(refs):
+            self.access(int(ref),
+                        writes is not None and bool(writes[i]),
+                        None if pcs is None else pcs[i])
+
+    def accuracy(self):
+        """Fraction of the prefetched blocks that were used"""
+        return self.useful / self.issued if self.issued else 0.0
+
+    def coverage(self):
+        """Fraction of the misses that were avoided by prefetching"""
+        total = self.useful + self.cache.misses
+        return self.useful / total if total else 0.0
+
+    def lateness(self):
+        """Fraction of the useful prefetches that arrived late"""
+        return self.late / self.useful if self.useful else 0.0
+
+    def __str__(self):
+        return '(Prefetching({}, issued={}, accuracy={:.2%}, ' \
+               'coverage={:.2%}, lateness={:.2%}) on {})' \
+               .format(type(self.prefetcher).__name__, self.issued,
+                       self.accuracy(), self.coverage(), self.lateness(),
+                       self.cache)
+
+
+if __name__ == '__main__':
+    import random
+    from memory import Cache
+
+    # Walks over arrays of structures, with some noise in between
+    refs = []
+    for _ in range(200):
+        base = random.randrange(1 << 20)
+        refs.extend(range(base, base + 4096, 8))
+        refs.extend(random.randrange(1 << 20) for _ in range(64))
+
+    c = Cache(16, 256, 4, 'lru')
+    c.replay(refs)
+    print('No prefetching:', c)
+    for prefetcher in (NextLine(), Stride(), Stream()):
+        p = Prefetching(Cache(16, 256, 4, 'lru'), prefetcher, latency=4)
+        p.replay(refs)
+        print(p)
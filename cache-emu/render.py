@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+"""Incremental rendering of a 'Cache' on a terminal.
+
+   Rather than printing the whole table after every access, only the rows
+   of the partitions that changed are repainted, moving the cursor there
+   with ANSI escape codes. Animations run on an 'asyncio' timer instead of
+   sleeping, and every frame can be recorded to a file for later playback.
+"""
+import asyncio
+import json
+import sys
+import time
+
+from memory import parse_refs
+
+
+# Moves the cursor up or down a number of lines (to their first column),
+# and clears the line from the cursor to its end
+UP = '\x1b[{}F'
+DOWN = '\x1b[{}E'
+CLEAR = '\x1b[K'
+
+
+class Renderer:
+    def __init__(self, cache, out=None, record=None,
+                 show_partition=True, show_content=True, show_way=True):
+        """cache  = the 'Cache' to render
+           out    = where to write to (standard output by default)
+           record = file where every frame is recorded, one JSON
+                    '[seconds, text]' per line, for 'play' to use
+        """
+        self.cache = cache
+        self.out = out or sys.stdout
+        self.record = record
+        self.options = show_partition, show_content, show_way
+        self.rows = None
+        self.status = ''
+        self.height = 0
+        self.highlight = None
+        self.started = None
+
+    def _emit(self, text):
+        self.out.write(text)
+        self.out.flush()
+        if self.record:
+            self.record.write(json.dumps(
+                [time.monotonic() - self.started, text]) + '\n')
+
+    def start(self, status=''):
+        """Paints the whole table once, below the cursor"""
+        if self.started is None:
+            self.started = time.monotonic()
+        lines = self.cache.draw_lines(*self.options)
+        # The partition 'i' is on the line 'partitions + 1 - i'
+        self.rows = [lines[self.cache.partitions + 1 - i]
+                     for i in range(self.cache.partitions)]
+        self.status = status
+        self.height = len(lines) + 1
+        self.highlight = self.cache.last_access[1]
+        self._emit('\n'.join(lines) + '\n' + status + '\n')
+
+    def update(self, status='', rows=None):
+        """Repaints the rows of the partitions that may have changed since
+           the last update (those last accessed, unless others are given)
+        """
+        if self.rows is None:
+            self.start(status)
+            return
+
+        cache = self.cache
+        if rows is None:
+            at = cache.last_access[1]
+            rows = {at, self.highlight}
+            self.highlight = at
+
+        moves = []
+        for i in rows:
+            if i is None:
+                continue
+            row = cache.draw_row(i, *self.options)
+            if row != self.rows[i]:
+                self.rows[i] = row
+                up = self.height - (cache.partitions + 1 - i)
+                moves.append(UP.format(up) + row + CLEAR + DOWN.format(up))
+
+        if status != self.status:
+            self.status = status
+            moves.append(UP.format(1) + status + CLEAR + DOWN.format(1))
+
+        if moves:
+            self._emit(''.join(moves))
+
+    def refresh(self, status=None):
+        """Compares every row, in case partitions other than the last
+           accessed changed (for example, after being invalidated)
+        """
+        self.update(self.status if status is None else status,
+                    range(self.cache.partitions))
+
+
+def status_of(cache, ref):
+    return ' -> Accessed word {} - {} hits and {} misses'.format(
+        ref, cache.hits, cache.misses)
+
+
+async def animate(cache, refs, delay=0, delay_hit=None, delay_miss=None,
+                  renderer=None):
+    """Accesses all the references, rendering the cache after each one.
+       The delays are the same as those of 'Cache.access', but other tasks
+       can run meanwhile and the timing does not drift with rendering.
+    """
+    if renderer is None:
+        renderer = Renderer(cache)
+    if renderer.rows is None:
+        renderer.start()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    for ref in parse_refs(refs):
+        cache.access(ref)
+        renderer.update(status_of(cache, ref))
+
+        hit, _ = cache.last_access
+        if hit and delay_hit:
+            deadline += delay_hit
+        elif not hit and delay_miss:
+            deadline += delay_miss
+        else:
+            deadline += delay
+        await asyncio.sleep(max(0, deadline - loop.time()))
+
+    return renderer
+
+
+async def play(path, speed=1.0, out=None):
+    """Plays back the frames recorded to the file at 'path'"""
+    out = out or sys.stdout
+    loop = asyncio.get_running_loop()
+    begin = loop.time()
+    with open(path) as f:
+        for line in f:
+            at, text = json.loads(line)
+            await asyncio.sleep(max(0, begin + at / speed - loop.time()))
+            out.write(text)
+            out.flush()
+
+
+if __name__ == '__main__':
+    from memory import Cache
+
+    if len(sys.argv) > 1:
+        asyncio.run(play(sys.argv[1]))
+    else:
+        c = Cache(4, 8, 2, 'lru')
+        refs = (list(range(32)) + list(range(32+4, 32+8))) * 3
+        asyncio.run(animate(c, refs, delay_hit=0.05, delay_miss=0.2))
+        print(c)
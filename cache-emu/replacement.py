@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+"""Replacement policies as hardware implements them, with a compact state
+   for every set instead of the stamps that 'lru', 'lfu' and 'fifo' use.
+
+   Every set has a 64-bit word ('CacheState.bits') and a byte
+   ('CacheState.aux') for the policy to keep its state in:
+   * 'plru'   : tree pseudo-LRU, a binary tree of 'ways - 1' bits which
+                point away from the ways used most recently.
+   * 'clock'  : CLOCK (second chance), a reference bit for every way and
+                the position of the hand, which clears reference bits as
+                it goes until it finds a way without it.
+   * 'random' : a xorshift generator for every set, seeded from the seed
+                given to the cache and the set, so it's reproducible.
+   * 'srrip'  : static re-reference interval prediction, 2 bits for every
+                way, new blocks being predicted to be re-referenced in a
+                long interval and hits in the near future.
+   * 'brrip'  : bimodal RRIP, like 'srrip' but new blocks are predicted to
+                be re-referenced in a distant interval except for one out
+                of every 'BRRIP_EVERY' (counted by 'aux').
+   * 'drrip'  : dynamic RRIP, where a few leader sets always use 'srrip'
+                or 'brrip' and the rest follow the one which misses less,
+                according to a saturating counter ('DRRIP.psel').
+
+   Empty ways are always used first, lower ones before, as with the rest of
+   policies. Policies are only told about the hits, the victims they have
+   to choose and the blocks placed ('fill'), never about the tags.
+"""
+from bisect import bisect_right
+
+
+# 'brrip' inserts blocks with a long re-reference interval once every
+BRRIP_EVERY = 32
+
+# One of every this many sets is a leader of each policy on 'drrip'
+DRRIP_LEADERS = 32
+
+# Bits of the policy selection counter of 'drrip'
+PSEL_BITS = 10
+
+# Re-reference prediction values (hits are predicted near, as 0)
+_LONG = 2
+_DISTANT = 3
+
+
+class TreePLRU:
+    reason = 'the tree pointed to it'
+
+    def __init__(self, ways, sets, seed=0):
+        if ways & (ways - 1) or ways > 64:
+            raise ValueError('Tree pseudo-LRU needs a power of two number '
+                             'of ways, up to 64')
+        self.levels = ways.bit_length() - 1
+
+    def reset(self, state):
+        pass
+
+    def hit(self, state, s, way):
+        # Every node on the way's path points to the other half
+        bits = state.bits[s]
+        node = 1
+        for level in reversed(range(self.levels)):
+            right = (way >> level) & 1
+            if right:
+                bits &= ~(1 << (node - 1))
+            else:
+                bits |= 1 << (node - 1)
+            node = 2 * node + right
+        state.bits[s] = bits
+
+    def victim(self, state, s):
+        bits = state.bits[s]
+        node = 1
+        way = 0
+        for _ in range(self.levels):
+            right = (bits >> (node - 1)) & 1
+            way = 2 * way + right
+            node = 2 * node + right
+        return way
+
+    def fill(self, state, s, way, at=None):
+        self.hit(state, s, way)
+
+
+class Clock:
+    reason = 'its reference bit was clear'
+
+    def __init__(self, ways, sets, seed=0):
+        if ways > 64:
+            raise ValueError('CLOCK supports up to 64 ways')
+        self.ways = ways
+
+    def reset(self, state):
+        pass
+
+    def hit(self, state, s, way):
+        state.bits[s] |= 1 << way
+
+    def victim(self, state, s):
+        bits = state.bits[s]
+        hand = state.aux[s]
+        while (bits >> hand) & 1:
+            bits &= ~(1 << hand)
+            hand = (hand + 1) % self.ways
+        state.bits[s] = bits
+        state.aux[s] = (hand + 1) % self.ways
+        return hand
+
+    def fill(self, state, s, way, at=None):
+        state.bits[s] |= 1 << way
+
+
+class Random:
+    reason = 'it was chosen at random'
+
+    def __init__(self, ways, sets, seed=0):
+        self.ways = ways
+        self.seed = seed
+
+    def reset(self, state):
+        # Seeds every set apart with splitmix64, so that the sets can be
+        # replayed in any order and still pick the same ways
+        mask = (1 << 64) - 1
+        for s in range(len(state.bits)):
+            z = (self.seed * 0x9e3779b97f4a7c15 + s + 1) & mask
+            z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & mask
+            z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & mask
+            state.bits[s] = (z ^ (z >> 31)) or 1
+
+    def hit(self, state, s, way):
+        pass
+
+    def victim(self, state, s):
+        x = state.bits[s]
+        x ^= (x << 13) & 0xffffffffffffffff
+        x ^= x >> 7
+        x ^= (x << 17) & 0xffffffffffffffff
+        state.bits[s] = x
+        return x % self.ways
+
+    def fill(self, state, s, way, at=None):
+        pass
+
+
+class SRRIP:
+    reason = 'it was predicted to be re-referenced the furthest'
+
+    def __init__(self, ways, sets, seed=0):
+        if ways > 32:
+            raise ValueError('RRIP policies support up to 32 ways')
+        # The low bit of every way's value
+        self.low = sum(1 << 2*w for w in range(ways))
+
+    def reset(self, state):
+        pass
+
+    def hit(self, state, s, way):
+        state.bits[s] &= ~(3 << 2*way)
+
+    def victim(self, state, s):
+        bits = state.bits[s]
+        distant = bits & (bits >> 1) & self.low
+        if not distant:
+            # Age every way at once, until some is predicted distant
+            if (bits >> 1) & self.low:
+                bits += self.low
+            elif bits & self.low:
+                bits += 2 * self.low
+            else:
+                bits += 3 * self.low
+            state.bits[s] = bits
+            distant = bits & (bits >> 1) & self.low
+        return (distant & -distant).bit_length() // 2
+
+    def _insert(self, state, s, way, value):
+        state.bits[s] = (state.bits[s] & ~(3 << 2*way)) | (value << 2*way)
+
+    def _bimodal(self, state, s):
+        """The value 'brrip' uses to insert the next block on set 's'"""
+        count = state.aux[s]
+        state.aux[s] = (count + 1) % BRRIP_EVERY
+        return _LONG if count == 0 else _DISTANT
+
+    def fill(self, state, s, way, at=None):
+        self._insert(state, s, way, _LONG)
+
+
+class BRRIP(SRRIP):
+    def fill(self, state, s, way, at=None):
+        self._insert(state, s, way, self._bimodal(state, s))
+
+
+class DRRIP(SRRIP):
+    def __init__(self, ways, sets, seed=0):
+        super().__init__(ways, sets, seed)
+        self.max = (1 << PSEL_BITS) - 1
+        self.psel = 1 << (PSEL_BITS - 1)
+        self.events = None
+        self.timeline = None
+
+    def reset(self, state):
+        self.psel = 1 << (PSEL_BITS - 1)
+
+    @staticmethod
+    def leader(s):
+        """Returns 'srrip' or 'brrip' if set 's' leads them, or None"""
+        return {0: 'srrip', 1: 'brrip'}.get(s % DRRIP_LEADERS)
+
+    def fill(self, state, s, way, at=None):
+        leader = self.leader(s)
+        if leader is not None:
+            # A miss on a leader votes for the other policy
+            delta = 1 if leader == 'srrip' else -1
+            if self.events is not None:
+                self.events.append((at, delta))
+            else:
+                self.psel = max(0, min(self.max, self.psel + delta))
+            bimodal = leader == 'brrip'
+        elif self.timeline is not None:
+            positions, values = self.timeline
+            i = bisect_right(positions, at) - 1
+            bimodal = (values[i] if i >= 0 else self.psel) > self.max // 2
+        else:
+            bimodal = self.psel > self.max // 2
+
+        if bimodal:
+            self._insert(state, s, way, self._bimodal(state, s))
+        else:
+            self._insert(state, s, way, _LONG)
+
+    def batch(self, groups):
+        """Reorders the (set, tags, positions) groups of a batch replay,
+           so that the leader sets come first and the counter is known
+           at every position of the batch before the rest of sets go
+        """
+        leaders = []
+        followers = []
+        for group in groups:
+            (followers if self.leader(group[0]) is None
+             else leaders).append(group)
+
+        self.events = []
+        try:
+            yield from leaders
+            events, self.events = sorted(self.events), None
+
+            psel = self.psel
+            positions = []
+            values = []
+            for at, delta in events:
+                psel = max(0, min(self.max, psel + delta))
+                positions.append(at)
+                values.append(psel)
+            self.timeline = positions, values
+            yield from followers
+            self.psel = psel
+        finally:
+            self.events = None
+            self.timeline = None
+
+
+POLICIES = {
+    'plru': TreePLRU,
+    'clock': Clock,
+    'random': Random,
+    'srrip': SRRIP,
+    'brrip': BRRIP,
+    'drrip': DRRIP,
+}
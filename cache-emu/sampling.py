@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+"""Sampled simulation, to estimate the misses of traces too long to be
+   replayed whole.
+
+   The trace is split into periods of 'period' references, and only a
+   short interval of every period is simulated in detail: 'interval'
+   references are measured, after the 'warmup' references before them
+   warm the cache up (their hits and misses are not counted, and they may
+   come from the previous period). Everything else is fast-forwarded, and
+   never touches the cache at all. Where the interval starts within its
+   period is chosen at random for every period (stratified sampling), so
+   that neither the estimate nor its error are biased by loops of the same
+   length as the period: a single offset for all of them would measure the
+   same phase of the loop every time, and so report a small error however
+   far from the real value it was.
+
+   The miss rate of the whole trace is then estimated from the misses of
+   every sample (as a ratio estimator, since the last sample may be cut
+   short), along with its confidence interval.
+
+   Uncompressed binary traces are mapped in memory, and only the pieces
+   around the samples are ever read, so fast-forwarding costs nothing.
+   Other formats have to be parsed whole, although they are still only
+   simulated where sampled.
+"""
+import mmap
+import os
+import random
+import sys
+from collections import namedtuple
+from statistics import NormalDist
+
+from memory import parse_refs
+from traces import (CHUNK_SIZE, _opener, _split_writes, guess_format,
+                    read_trace)
+
+
+# Counters of a cache that the warm-up must not change
+_COUNTERS = ('hits', 'misses', 'bytes_read', 'bytes_written', 'writebacks')
+
+Estimate = namedtuple('Estimate', [
+    'references',  # how many references the trace has
+    'sampled',     # how many of them were measured
+    'samples',     # how many samples were taken
+    'misses',      # estimated misses on the whole trace
+    'miss_rate',   # estimated miss rate on the whole trace
+    'error',       # half the width of the confidence interval on misses
+    'confidence',  # probability that the real value is within the error
+])
+
+
+def _starts(period, interval, warmup, seed):
+    """Returns a function that tells where the warm-up and the interval
+       of the sample of the k-th period start, the interval being at a
+       random offset within the period (the same for the same seed)
+    """
+    if interval <= 0 or warmup < 0:
+        raise ValueError('The interval must be positive and the warmup '
+                         'cannot be negative')
+    if warmup + interval > period:
+        raise ValueError('The warmup and interval must fit in the period')
+
+    rng = random.Random(seed)
+    offsets = []
+
+    def start(k):
+        while len(offsets) <= k:
+            offsets.append(rng.randrange(period - interval + 1))
+        base = k * period + offsets[k]
+        # The warm-up can't go back further than the previous interval
+        last = (k - 1) * period + offsets[k - 1] + interval if k else 0
+        return max(base - warmup, last), base
+
+    return start
+
+
+def _simulate(cache, pieces, period, interval, warmup, start):
+    """Simulates the samples found on the pieces of the trace, which are
+       (position, refs, writes) with 'writes' possibly None. Returns how
+       long the trace was and the (references, misses) of every sample.
+    """
+    samples = {}
+    total = 0
+    for pos, refs, writes in pieces:
+        end = pos + len(refs)
+        total = max(total, end)
+
+        # Samples of the periods before the previous one have ended
+        k = max(0, pos // period - 1)
+        while True:
+            first, base = start(k)
+            if first >= end:
+                break
+
+            for a, b, detailed in (
+                    (first, base, False),
+                    (base, base + interval, True)):
+                a = max(a, pos)
+                b = min(b, end)
+                if a >= b:
+                    continue
+
+                part = refs[a - pos:b - pos]
+                part_writes = None if writes is None \
+                    else writes[a - pos:b - pos]
+                if detailed:
+                    misses = cache.misses
+                    cache.replay(part, writes=part_writes)
+                    sample = samples.setdefault(k, [0, 0])
+                    sample[0] += b - a
+                    sample[1] += cache.misses - misses
+                else:
+                    saved = [getattr(cache, c) for c in _COUNTERS]
+                    cache.replay(part, writes=part_writes)
+                    for name, value in zip(_COUNTERS, saved):
+                        setattr(cache, name, value)
+            k += 1
+
+    return total, [tuple(s) for _, s in sorted(samples.items())]
+
+
+def _estimate(total, samples, confidence):
+    """Extrapolates the misses of the whole trace from the samples"""
+    if not samples:
+        raise ValueError('The trace is too short to take a single sample')
+
+    n = len(samples)
+    sampled = sum(u for u, _ in samples)
+    rate = sum(m for _, m in samples) / sampled
+    if n > 1 and sampled < total:
+        mean = sampled / n
+        variance = sum((m - rate * u)**2 for u, m in samples) / (n - 1)
+        # Standard error of a ratio estimator, corrected for the fact
+        # that the samples were taken from a finite trace
+        stderr = (variance / n)**0.5 / mean * (1 - sampled / total)**0.5
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        error = z * stderr * total
+    elif sampled >= total:
+        error = 0.0  # every reference was measured
+    else:
+        error = float('inf')
+
+    return Estimate(total, sampled, n, rate * total, rate, error, confidence)
+
+
+def sample(cache, refs, period=1000000, interval=10000, warmup=50000,
+           writes=None, confidence=0.95, seed=None):
+    """Estimates the misses of the references (anything 'Cache.replay'
+       accepts) on the cache by sampling them, returning an 'Estimate'.
+
+       Afterwards, the hits and misses of the cache are those of the
+       references that were measured only.
+    """
+    refs = parse_refs(refs)
+    start = _starts(period, interval, warmup, seed)
+
+    def pieces():
+        k = 0
+        while start(k)[0] < len(refs):
+            first, base = start(k)
+            end = min(base + interval, len(refs))
+            yield (first, refs[first:end],
+                   None if writes is None else writes[first:end])
+            k += 1
+
+    _, samples = _simulate(cache, pieces(), period, interval, warmup, start)
+    return _estimate(len(refs), samples, confidence)
+
+
+def sample_trace(cache, path, fmt=None, period=1000000, interval=10000,
+                 warmup=50000, confidence=0.95, seed=None,
+                 chunk_size=CHUNK_SIZE, **kwargs):
+    """Like 'sample', but reading the trace from the file at 'path'
+       (see 'traces.read_trace' for the rest of arguments)
+    """
+    if fmt is None:
+        fmt = guess_format(path)
+    start = _starts(period, interval, warmup, seed)
+
+    if fmt != 'binary' or _opener(path) or sys.byteorder != 'little':
+        def pieces():
+            pos = 0
+            for chunk, writes in read_trace(path, fmt, chunk_size,
+                                            kinds=True, **kwargs):
+                yield pos, chunk, writes
+                pos += len(chunk)
+
+        total, samples = _simulate(cache, pieces(), period, interval,
+                                   warmup, start)
+        return _estimate(total, samples, confidence)
+
+    with open(path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size // 8
+        if not total:
+            return _estimate(0, [], confidence)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)[:total * 8].cast('Q')
+            parts = []
+
+            def pieces():
+                k = 0
+                while start(k)[0] < total:
+                    first, base = start(k)
+                    part = view[first:min(base + interval, total)]
+                    parts.append(part)
+                    yield (first, *_split_writes(part, True))
+                    part.release()
+                    k += 1
+
+            try:
+                _, samples = _simulate(cache, pieces(), period, interval,
+                                       warmup, start)
+            finally:
+                for part in parts:
+                    part.release()
+                view.release()
+
+    return _estimate(total, samples, confidence)
+
+
+if __name__ == '__main__':
+    from memory import Cache
+
+    if len(sys.argv) > 1:
+        c = Cache(16, 1024, 4, 'lru')
+        e = sample_trace(c, sys.argv[1], sys.argv[2]
+                         if len(sys.argv) > 2 else None)
+        print('{:.0f} ± {:.0f} misses ({:.2%} miss rate) estimated from {} '
+              'samples on {}'.format(e.misses, e.error, e.miss_rate,
+                                     e.samples, c))
+        sys.exit(0)
+
+    # A program that goes through arrays of different sizes in phases
+    rng = random.Random(1)
+    refs = []
+    while len(refs) < 10000000:
+        size = rng.choice([1 << 10, 1 << 14, 1 << 17])
+        base = rng.randrange(1 << 20)
+        for _ in range(rng.randrange(5, 50)):
+            refs.extend(range(base, base + size, 4))
+
+    whole = Cache(16, 1024, 4, 'lru')
+    whole.replay(refs)
+    c = Cache(16, 1024, 4, 'lru')
+    e = sample(c, refs, period=100000, interval=5000, warmup=10000, seed=1)
+    print('real misses:', whole.misses)
+    print('estimated:   {:.0f} ± {:.0f} ({} of {} references measured)'
+          .format(e.misses, e.error, e.sampled, e.references))
+
+    # Phases as long as the sampling period must not fool the error
+    refs = []
+    for p in range(100):
+        refs.extend(range(p << 20, (p << 20) + 200000, 4))
+        refs.extend(list(range(0, 2048, 4)) * 100)
+    whole = Cache(16, 1024, 4, 'lru')
+    whole.replay(refs)
+    c = Cache(16, 1024, 4, 'lru')
+    e = sample(c, refs, period=100000, interval=5000, warmup=10000, seed=1)
+    print('periodic real misses:', whole.misses)
+    print('estimated:   {:.0f} ± {:.0f}'.format(e.misses, e.error))
+    if abs(e.misses - whole.misses) > e.error:
+        print('  The real misses are outside the confidence interval!')
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+"""Single pass simulation of every LRU cache configuration at once.
+
+   LRU has the inclusion property: a block which is present on a cache
+   with 'w' ways is also present on any other with more ways and the
+   same sets. The LRU stack distance of an access (how many different
+   blocks of its set were used since the same block was last accessed)
+   thus tells with which number of ways it would hit: all those greater
+   than the distance. Counting how many accesses have each distance is
+   then enough to know the hits and misses of any number of ways.
+
+   Distances are found with a Fenwick tree over the accesses, where only
+   the last access to every block is marked, so the distance is just how
+   many marks there are after the previous access to the same block. This
+   is O(n log n) for the whole trace, and has to be done once for every
+   number of sets (which determines how the blocks are split), instead of
+   once for every single configuration.
+"""
+from array import array
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def stack_distances(blocks):
+    """Returns the LRU stack distance for every block accessed, or -1 if
+       it was never used before (a compulsory miss on any cache)
+    """
+    n = len(blocks)
+    tree = [0] * (n + 1)
+    last = {}
+    distances = array('q', bytes(8 * n))
+    for t, b in enumerate(blocks, 1):
+        p = last.get(b)
+        if p is None:
+            distances[t - 1] = -1
+        else:
+            # Marks after 'p' are all the marks minus those up to 'p'
+            marked = 0
+            i = p
+            while i:
+                marked += tree[i]
+                i &= i - 1
+            distances[t - 1] = len(last) - marked
+
+            # The block is no longer last accessed at 'p'
+            i = p
+            while i <= n:
+                tree[i] -= 1
+                i += i & -i
+
+        last[b] = t
+        i = t
+        while i <= n:
+            tree[i] += 1
+            i += i & -i
+
+    return distances
+
+
+def _by_set(blocks, sets):
+    """Reorders the blocks so that those on the same set are together,
+       while keeping their relative order
+    """
+    if sets == 1:
+        return blocks
+    if np is not None:
+        blocks = np.asarray(blocks, dtype=np.int64)
+        return blocks[np.argsort(blocks % sets, kind='stable')].tolist()
+    return sorted(blocks, key=lambda b: b % sets)
+
+
+def histogram(distances):
+    """Returns (counts, cold) where 'counts[d]' is how many accesses had
+       a stack distance of 'd', and 'cold' how many accesses were the
+       first to their block
+    """
+    if np is not None:
+        distances = np.frombuffer(distances, dtype=np.int64)
+        cold = int(np.count_nonzero(distances < 0))
+        return np.bincount(distances[distances >= 0]).tolist(), cold
+
+    counts = []
+    cold = 0
+    for d in distances:
+        if d < 0:
+            cold += 1
+        else:
+            if d >= len(counts):
+                counts.extend([0] * (d + 1 - len(counts)))
+            counts[d] += 1
+    return counts, cold
+
+
+class LRUProfile:
+    def __init__(self, refs, partition_size, max_sets=1):
+        """Profiles the references (any iterable of integers) with one
+           pass for every power of two number of sets up to 'max_sets',
+           after which the hits and misses of any LRU cache with those
+           sets and partition size can be known instantly.
+        """
+        if max_sets & (max_sets - 1):
+            raise ValueError('The number of sets must be a power of two')
+
+        if np is not None:
+            refs = np.asarray(refs, dtype=np.int64)
+            blocks = (refs // partition_size).tolist()
+        else:
+            blocks = [r // partition_size for r in refs]
+
+        self.partition_size = partition_size
+        self.accesses = len(blocks)
+        # Number of sets: (cumulative hits by distance, cold misses)
+        self.profiles = {}
+        sets = 1
+        while sets <= max_sets:
+            counts, cold = histogram(stack_distances(_by_set(blocks, sets)))
+            self.profiles[sets] = list(accumulate(counts)), cold
+            sets *= 2
+
+    def hits(self, partitions, ways):
+        """Hits of a LRU cache with 'partitions' partitions and 'ways' ways"""
+        sets = partitions // ways
+        if sets not in self.profiles:
+            raise ValueError('Not profiled for {} sets'.format(sets))
+
+        cumulative, _ = self.profiles[sets]
+        if not cumulative:
+            return 0
+        return cumulative[min(ways, len(cumulative)) - 1]
+
+    def misses(self, partitions, ways):
+        """Misses of a LRU cache with 'partitions' partitions and 'ways' ways"""
+        return self.accesses - self.hits(partitions, ways)
+
+    def configurations(self, max_partitions):
+        """Yields (partitions, ways, hits, misses) for every power of two
+           number of partitions and ways up to 'max_partitions'
+        """
+        partitions = 1
+        while partitions <= max_partitions:
+            ways = 1
+            while ways <= partitions:
+                if partitions // ways in self.profiles:
+                    hits = self.hits(partitions, ways)
+                    yield partitions, ways, hits, self.accesses - hits
+                ways *= 2
+            partitions *= 2
+
+
+if __name__ == '__main__':
+    import random
+    from memory import Cache
+
+    print('Testing…')
+    refs = [random.randrange(2048) for _ in range(5000)]
+    profile = LRUProfile(refs, 4, max_sets=64)
+    for partitions, ways, hits, misses in profile.configurations(64):
+        c = Cache(4, partitions, ways, 'lru')
+        c.replay(refs)
+        if (c.hits, c.misses) != (hits, misses):
+            print('Mismatch on', c, 'which should have had', hits, 'hits')
+    print('Test done.')
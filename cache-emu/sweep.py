@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+"""Design-space exploration, replaying the same trace on many different
+   cache configurations spread over all the cores of the machine.
+
+   The trace is copied once into shared memory, and every worker process
+   replays its configurations straight from there, so the trace is never
+   pickled. Results are yielded as soon as they are ready, and can be
+   written as CSV or JSON (one object per line) while the sweep goes on.
+"""
+import csv
+import json
+import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from multiprocessing.shared_memory import SharedMemory
+
+from memory import Cache, parse_refs
+
+
+FIELDS = ('partition_size', 'partitions', 'ways', 'policy',
+          'hits', 'misses', 'miss_rate')
+
+# Set on every worker process when it starts
+_shm = None
+_trace = None
+
+
+def grid(partition_sizes, partitions, ways, policies=('lru',)):
+    """Yields every valid (partition_size, partitions, ways, policy)
+       configuration from the given values. Direct mapped caches are
+       only yielded once, with no policy.
+    """
+    seen = set()
+    for psize, partc, wayc, policy in product(
+            partition_sizes, partitions, ways, policies):
+        if wayc > partc or partc % wayc:
+            continue
+        if wayc == 1:
+            policy = None
+        config = psize, partc, wayc, policy
+        if config not in seen:
+            seen.add(config)
+            yield config
+
+
+def _attach(name, length):
+    """Worker initializer, attaches to the shared trace"""
+    global _shm, _trace
+    # Workers share the resource tracker of the process which created
+    # the memory, so attaching here won't make it go away on exit
+    _shm = SharedMemory(name)
+    _trace = _shm.buf[:length * 8].cast('q')
+
+
+def _run(config):
+    """Worker job, replays the whole trace on a single configuration"""
+    psize, partc, wayc, policy = config
+    c = Cache(psize, partc, wayc, policy)
+    c.replay(_trace)
+    total = c.hits + c.misses
+    return {
+        'partition_size': psize,
+        'partitions': partc,
+        'ways': wayc,
+        'policy': policy,
+        'hits': c.hits,
+        'misses': c.misses,
+        'miss_rate': c.misses / total if total else 0.0,
+    }
+
+
+def sweep(refs, configs, workers=None):
+    """Replays the references (anything 'Cache.replay' accepts) on every
+       configuration, yielding the results in the order they finish
+    """
+    refs = array('q', parse_refs(refs))
+    shm = SharedMemory(create=True, size=max(len(refs) * 8, 1))
+    try:
+        shm.buf[:len(refs) * 8] = refs.tobytes()
+        del refs
+        with ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(),
+                initializer=_attach,
+                initargs=(shm.name, len(shm.buf) // 8)) as pool:
+            futures = [pool.submit(_run, config) for config in configs]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def write_csv(results, file=sys.stdout):
+    """Writes the results as CSV rows as they come, returning them all"""
+    writer = csv.DictWriter(file, fieldnames=FIELDS)
+    writer.writeheader()
+    rows = []
+    for row in results:
+        writer.writerow(row)
+        file.flush()
+        rows.append(row)
+    return rows
+
+
+def write_json(results, file=sys.stdout):
+    """Writes the results as JSON lines as they come, returning them all"""
+    rows = []
+    for row in results:
+        file.write(json.dumps(row) + '\n')
+        file.flush()
+        rows.append(row)
+    return rows
+
+
+def plot(rows, partition_size, partitions):
+    """Plots the misses of every way and policy for the given size"""
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is required for plotting')
+        return
+
+    fig, ax = plt.subplots()
+    policies = sorted({r['policy'] for r in rows if r['policy']})
+    for policy in policies:
+        points = sorted(
+            (r['ways'], r['misses']) for r in rows
+            if r['partition_size'] == partition_size
+            and r['partitions'] == partitions
+            and r['policy'] in (policy, None)
+        )
+        ax.plot(*zip(*points), 'o-', label=policy.upper(), linewidth=1)
+
+    ax.set_ylabel('Misses')
+    ax.set_xlabel('Number of ways')
+    ax.legend()
+    ax.set_xscale('log', base=2)
+    plt.show()
+
+
+if __name__ == '__main__':
+    from traces import read_trace
+
+    if len(sys.argv) < 2:
+        print('usage:', sys.argv[0], 'TRACE [OUT.csv|OUT.json]')
+        sys.exit(1)
+
+    refs = array('q')
+    for chunk in read_trace(sys.argv[1]):
+        refs.extend(array('q', chunk))
+
+    configs = grid([4, 16, 64], [2**i for i in range(4, 13)],
+                   [2**i for i in range(6)], ['lru', 'lfu', 'fifo', 'opt'])
+    out = sys.argv[2] if len(sys.argv) > 2 else None
+    with (open(out, 'w', newline='') if out else sys.stdout) as f:
+        if out and out.endswith('.json'):
+            write_json(sweep(refs, configs), f)
+        else:
+            write_csv(sweep(refs, configs), f)
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+"""Address translation: translation lookaside buffers (TLB) in front of a
+   radix page table, to measure from the same traces how often pages miss
+   and what walking the page table costs, and how huge pages change it.
+
+   Every level of the TLB is a 'Cache' with a partition size of 1, whose
+   partitions are the entries and whose sets, ways and policies work as
+   they always do, chained into a (non-inclusive by default) 'Hierarchy'.
+   The entries are keyed by the page number and its size, so pages of
+   every size share the levels.
+
+   Pages can be 4K, 2M or 1G ('PAGE_SIZES'), and 'Pages' tells which size
+   backs every address (for example, huge pages over a few regions). The
+   page table is the x86-64 one, with four levels of 512 entries, which a
+   page walk reads from the root down to the entry of the page: four reads
+   for 4K pages, three for 2M and two for 1G.
+
+   Walks can skip the upper levels if a page walk cache ('pwc', another
+   'Cache' of partition size 1) holds the entry of some level, and the
+   entries can be read through a data 'Cache' (the page tables being
+   placed from 'table_base' on), so that walks compete with the data.
+"""
+from bisect import bisect_right
+
+from hierarchy import Hierarchy
+from memory import Cache, np, parse_refs
+
+
+PAGE_SIZES = {
+    '4K': 1 << 12,
+    '2M': 1 << 21,
+    '1G': 1 << 30,
+}
+
+# Entries of the page table read to translate a page of every size
+WALK_LEVELS = {
+    '4K': 4,
+    '2M': 3,
+    '1G': 2,
+}
+
+# Every table of the page table has 2**9 entries of 8 bytes
+INDEX_BITS = 9
+PTE_SIZE = 8
+TABLE_SIZE = PTE_SIZE << INDEX_BITS
+
+# The sizes, in the order they're numbered inside the keys
+_SIZES = ('4K', '2M', '1G')
+
+# Keys have the page number in their lowest bits (so that they are spread
+# over the sets as usual) and the size or level of the page table above
+_KIND_SHIFT = 60
+_NUMBER_MASK = (1 << _KIND_SHIFT) - 1
+
+
+def _shift(level):
+    """Bits below the index of the given page table level (0 being the
+       root), so that 'address >> _shift(level)' identifies its entry
+    """
+    return 12 + INDEX_BITS * (3 - level)
+
+
+class Pages:
+    def __init__(self, default='4K', regions=()):
+        """default = size of the pages backing the addresses by default
+           regions = (start, end, size) with the addresses (in bytes, end
+                     not included) backed by pages of another size
+        """
+        for size in [default] + [r[2] for r in regions]:
+            if size not in PAGE_SIZES:
+                raise ValueError('Unknown page size given: '+str(size))
+
+        self.default = default
+        self.regions = sorted(regions)
+        for (_, end, _), (start, _, _) in zip(self.regions,
+                                              self.regions[1:]):
+            if start < end:
+                raise ValueError('The regions must not overlap')
+        self.starts = [r[0] for r in self.regions]
+
+    def size_of(self, address):
+        """Returns the size of the page that backs the address"""
+        i = bisect_right(self.starts, address) - 1
+        if i >= 0 and address < self.regions[i][1]:
+            return self.regions[i][2]
+        return self.default
+
+    def keys(self, addresses):
+        """Returns the key of the page of every address, which is its
+           number and size (see '_SIZES') above '_KIND_SHIFT'
+        """
+        if np is None:
+            result = []
+            for a in addresses:
+                size = self.size_of(a)
+                shift = PAGE_SIZES[size].bit_length() - 1
+                result.append(a >> shift
+                              | _SIZES.index(size) << _KIND_SHIFT)
+            return result
+
+        addresses = np.asarray(addresses, dtype=np.int64)
+        sizes = np.full(len(addresses), _SIZES.index(self.default),
+                        dtype=np.int64)
+        if self.regions:
+            i = np.searchsorted(np.asarray(self.starts, dtype=np.int64),
+                                addresses, side='right') - 1
+            ends = np.asarray([r[1] for r in self.regions], dtype=np.int64)
+            inside = (i >= 0) & (addresses < ends[np.maximum(i, 0)])
+            indices = np.asarray([_SIZES.index(r[2]) for r in self.regions],
+                                 dtype=np.int64)
+            sizes[inside] = indices[i[inside]]
+        shifts = np.asarray([PAGE_SIZES[s].bit_length() - 1 for s in _SIZES],
+                            dtype=np.int64)[sizes]
+        return addresses >> shifts | sizes << _KIND_SHIFT
+
+
+class TLB:
+    def __init__(self, levels, pages=None, pwc=None, cache=None,
+                 word_size=1, policy='non-inclusive', latencies=None,
+                 cache_latency=4, memory_latency=100, table_base=1 << 40):
+        """levels         = list of 'Cache' with a partition size of 1, the
+                            first being the closest
+           pages          = the 'Pages' telling the size of every page,
+                            4K everywhere by default
+           pwc            = 'Cache' with a partition size of 1 holding the
+                            entries of the upper levels of the page table,
+                            whose hits and misses count its lookups
+           cache          = data 'Cache' the page table entries are read
+                            through, or None to read them from memory
+           word_size      = size of the words of the references, in bytes
+           policy         = inclusion policy of the levels, as 'Hierarchy'
+           latencies      = lookup latency of every level (in cycles)
+           cache_latency  = latency of reading an entry that hits 'cache'
+           memory_latency = latency of reading an entry from memory
+           table_base     = address (in bytes) where page tables are placed
+        """
+        for c in list(levels) + ([pwc] if pwc is not None else []):
+            if c.partition_size != 1:
+                raise ValueError('Every TLB entry must be a partition of '
+                                 'size 1')
+
+        if latencies is None:
+            # Something close to what current machines have
+            latencies = [1] + [7] * (len(levels) - 1)
+
+        self.levels = Hierarchy(levels, policy, latencies)
+        self.pages = pages if pages is not None else Pages()
+        self.pwc = pwc
+        self.cache = cache
+        self.word_size = word_size
+        self.cache_latency = cache_latency
+        self.memory_latency = memory_latency
+        self.table_base = table_base
+        self._clear()
+
+    def _clear(self):
+        # (level, prefix of the table) to the number of the table
+        self.tables = {}
+        self.translations = 0
+        self.walks = 0
+        self.walk_reads = 0
+        self.walk_cycles = 0
+        # Walks made for the pages of every size
+        self.size_walks = dict.fromkeys(_SIZES, 0)
+
+    def reset(self):
+        """Resets every level, the page walk cache and the counters (the
+           data cache is left as it is)
+        """
+        self.levels.reset()
+        if self.pwc is not None:
+            self.pwc.reset()
+        self._clear()
+
+    def _read(self, address):
+        """Reads a page table entry, returning how long it took"""
+        if self.cache is None:
+            return self.memory_latency
+        self.cache.access(address // self.word_size)
+        if self.cache.last_access[0]:
+            return self.cache_latency
+        return self.memory_latency
+
+    def _walk(self, key):
+        """Walks the page table to translate the page with the given key"""
+        size = _SIZES[key >> _KIND_SHIFT]
+        address = (key & _NUMBER_MASK) * PAGE_SIZES[size]
+        leaf = WALK_LEVELS[size] - 1
+
+        # Start below the deepest entry which the page walk cache has. Every
+        # entry looked up is an access, so the ones that miss are placed
+        # (and they're the entries that the walk is about to read)
+        start = 0
+        if self.pwc is not None:
+            for level in reversed(range(leaf)):
+                entry = address >> _shift(level) | level << _KIND_SHIFT
+                self.pwc.access(entry)
+                if self.pwc.last_access[0]:
+                    start = level + 1
+                    break
+
+        cycles = 0
+        for level in range(start, leaf + 1):
+            prefix = address >> _shift(level)
+            table = self.tables.setdefault((level, prefix >> INDEX_BITS),
+                                           len(self.tables))
+            cycles += self._read(self.table_base + table * TABLE_SIZE
+                                 + (prefix & ((1 << INDEX_BITS) - 1))
+                                 * PTE_SIZE)
+
+        self.walks += 1
+        self.walk_reads += leaf + 1 - start
+        self.walk_cycles += cycles
+        self.size_walks[size] += 1
+
+    def translate(self, ref):
+        """Translates a single reference, returning the index of the level
+           where it hit (or 'len(levels)' if the page table was walked)
+        """
+        key = self.pages.keys([ref * self.word_size])[0]
+        self.translations += 1
+        found = self.levels.access(int(key))
+        if found == len(self.levels.levels):
+            self._walk(int(key))
+        return found
+
+    def translate_all(self, refs):
+        """Translates all the references, looking up every level in a
+           batch when the levels are non-inclusive, and walking the page
+           table for the pages that missed all of them
+        """
+        refs = parse_refs(refs)
+        if np is not None:
+            addresses = np.asarray(refs, dtype=np.int64) * self.word_size
+        else:
+            addresses = [r * self.word_size for r in refs]
+        keys = self.pages.keys(addresses)
+        self.translations += len(keys)
+
+        if self.levels.policy != 'non-inclusive':
+            for key in keys:
+                if self.levels.access(int(key)) == len(self.levels.levels):
+                    self._walk(int(key))
+            return
+
+        for level in self.levels.levels:
+            keys = level.replay(keys, misses=True)
+            if not len(keys):
+                break
+        for key in keys:
+            self._walk(int(key))
+
+    def cycles(self):
+        """Average cycles taken by every translation, looking up the levels
+           and walking the page table
+        """
+        if not self.translations:
+            return 0.0
+        cycles = self.walk_cycles
+        for level, latency in zip(self.levels.levels, self.levels.latencies):
+            cycles += (level.hits + level.misses) * latency
+        return cycles / self.translations
+
+    def __str__(self):
+        lines = ['TLB(translations={}, walks={}, walk_reads={}, '
+                 'walk_cycles={}, cycles={:.2f})'.format(
+                     self.translations, self.walks, self.walk_reads,
+                     self.walk_cycles, self.cycles())]
+        for i, (level, (accesses, hits, misses, rate)) in enumerate(
+                zip(self.levels.levels, self.levels.stats()), start=1):
+            lines.append('  L{}: {} lookups, {} hits, {} misses ({:.2%} '
+                         'hit rate) on {}'.format(i, accesses, hits, misses,
+                                                  rate, level))
+        if self.pwc is not None:
+            lines.append('  PWC: {}'.format(self.pwc))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import random
+
+    # Random accesses over 256MB, with 8-byte words
+    refs = [random.randrange(1 << 25) for _ in range(200000)]
+    for size in ('4K', '2M'):
+        tlb = TLB([Cache(1, 64, 4, 'lru'), Cache(1, 1536, 12, 'lru')],
+                  Pages(size), pwc=Cache(1, 32, 32, 'lru'),
+                  cache=Cache(8, 4096, 8, 'lru'), word_size=8)
+        tlb.translate_all(refs)
+        print('With {} pages:'.format(size), tlb)
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+"""Streaming readers for memory traces, so that huge trace files can be
+   fed to 'Cache.replay' in chunks without loading them whole in memory.
+
+   Supported formats are:
+   * 'din'    : Dinero's "label address" text format (address in hex).
+   * 'lackey' : Valgrind's '--tool=lackey --trace-mem=yes' output.
+   * 'binary' : packed little-endian unsigned 64-bit addresses, where
+                the highest bit ('WRITE_BIT') is set on writes.
+
+   Every reader yields chunks of addresses, or (addresses, writes) if
+   'kinds' is True, 'writes' being a 'bytearray' with 1 for every write.
+
+   Any of them may be compressed with gzip, xz or bzip2, which is detected
+   from the first bytes of the file and decompressed on the fly.
+"""
+import bz2
+import gzip
+import lzma
+import mmap
+import os
+import sys
+from array import array
+
+
+# How many references each chunk holds by default (8MB of addresses)
+CHUNK_SIZE = 1 << 20
+
+# Dinero labels, 2 is an instruction fetch and the rest aren't accesses
+DIN_READ = 0
+DIN_WRITE = 1
+DIN_FETCH = 2
+
+# Set on the addresses of binary traces that are writes
+WRITE_BIT = 1 << 63
+
+_MAGIC = [
+    (b'\x1f\x8b', gzip.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+    (b'BZh', bz2.open),
+]
+
+
+def _opener(path):
+    """Returns the function that should be used to open the file,
+       or None if it isn't compressed
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, opener in _MAGIC:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def open_trace(path):
+    """Opens the trace file for reading in binary mode, decompressing
+       it transparently if it was compressed
+    """
+    return (_opener(path) or open)(path, 'rb')
+
+
+def guess_format(path):
+    """Guesses the trace format from the file name ('binary' otherwise)"""
+    name = os.path.basename(path).lower()
+    for ext in ('.gz', '.xz', '.bz2'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    if name.endswith('.din'):
+        return 'din'
+    if name.endswith(('.lackey', '.out', '.txt')):
+        return 'lackey'
+    return 'binary'
+
+
+def read_din(path, chunk_size=CHUNK_SIZE, fetches=True, kinds=False):
+    """Yields chunks of addresses from a Dinero 'din' trace. Instruction
+       fetches are skipped if 'fetches' is False.
+    """
+    labels = (DIN_READ, DIN_WRITE, DIN_FETCH) if fetches else \
+             (DIN_READ, DIN_WRITE)
+    chunk = array('Q')
+    writes = bytearray()
+    with open_trace(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            label = int(parts[0])
+            if label not in labels:
+                continue
+            chunk.append(int(parts[1], 16))
+            writes.append(label == DIN_WRITE)
+            if len(chunk) == chunk_size:
+                yield (chunk, writes) if kinds else chunk
+                chunk = array('Q')
+                writes = bytearray()
+    if chunk:
+        yield (chunk, writes) if kinds else chunk
+
+
+def read_lackey(path, chunk_size=CHUNK_SIZE, fetches=True, kinds=False):
+    """Yields chunks of addresses from Valgrind's lackey output. Modify
+       ('M') accesses are a load followed by a store to the same address,
+       and instruction fetches ('I') are skipped if 'fetches' is False.
+    """
+    chunk = array('Q')
+    writes = bytearray()
+    with open_trace(path) as f:
+        for line in f:
+            # ' L 1ffefffd78,8', where 'I' fetches have no leading space
+            kind = line[:2].strip()
+            if kind not in (b'L', b'S', b'M', b'I'):
+                continue  # '==pid==' lines and the like
+            if kind == b'I' and not fetches:
+                continue
+            address = int(line[3:line.index(b',', 3)], 16)
+            chunk.append(address)
+            writes.append(kind == b'S')
+            if kind == b'M':
+                chunk.append(address)
+                writes.append(True)
+            if len(chunk) >= chunk_size:
+                yield (chunk, writes) if kinds else chunk
+                chunk = array('Q')
+                writes = bytearray()
+    if chunk:
+        yield (chunk, writes) if kinds else chunk
+
+
+def _split_writes(chunk, kinds):
+    """Removes the 'WRITE_BIT' from the addresses of a binary chunk,
+       returning (addresses, writes) if 'kinds' or the addresses only.
+       Chunks without writes are returned as they are.
+    """
+    if not len(chunk) or max(chunk) < WRITE_BIT:
+        return (chunk, bytearray(len(chunk))) if kinds else chunk
+
+    writes = bytearray(r >= WRITE_BIT for r in chunk)
+    chunk = array('Q', (r & ~WRITE_BIT for r in chunk))
+    return (chunk, writes) if kinds else chunk
+
+
+def read_binary(path, chunk_size=CHUNK_SIZE, kinds=False):
+    """Yields chunks of addresses from a packed little-endian binary trace.
+
+       Uncompressed files are mapped in memory and every chunk is a view
+       over the file itself, which is only valid until the next chunk is
+       requested (copy it, for example with 'array', to keep it around).
+       Chunks with writes are copied, to remove their 'WRITE_BIT'.
+    """
+    itemsize = 8
+    opener = _opener(path)
+    if opener or sys.byteorder != 'little':
+        with (opener or open)(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size * itemsize)
+                if len(data) < itemsize:
+                    break
+                chunk = array('Q')
+                chunk.frombytes(data[:len(data) - len(data) % itemsize])
+                if sys.byteorder != 'little':
+                    chunk.byteswap()
+                yield _split_writes(chunk, kinds)
+        return
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        size -= size % itemsize
+        if not size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                step = chunk_size * itemsize
+                for start in range(0, size, step):
+                    chunk = view[start:min(start + step, size)].cast('Q')
+                    try:
+                        yield _split_writes(chunk, kinds)
+                    finally:
+                        chunk.release()
+            finally:
+                view.release()
+
+
+def write_binary(path, refs, compress=None, writes=None):
+    """Writes the references as a binary trace, which can optionally be
+       compressed with 'gzip', 'xz' or 'bz2'. 'refs' can be any iterable
+       of integers, or an iterable of chunks (arrays or buffers) of them.
+
+       If given, 'writes' tells which of the references are writes, with
+       one value for every reference (not chunk).
+    """
+    opener = {None: open, 'gzip': gzip.open, 'xz': lzma.open,
+              'bz2': bz2.open}[compress]
+    if writes is not None:
+        refs = _mark_writes(refs, iter(writes))
+    written = 0
+    with opener(path, 'wb') as f:
+        chunk = array('Q')
+        for r in refs:
+            if isinstance(r, int):
+                chunk.append(r)
+                if len(chunk) < CHUNK_SIZE:
+                    continue
+            else:
+                chunk.extend(_as_words(r))
+            if sys.byteorder != 'little':
+                chunk.byteswap()
+            f.write(chunk.tobytes())
+            written += len(chunk)
+            chunk = array('Q')
+        if chunk:
+            if sys.byteorder != 'little':
+                chunk.byteswap()
+            f.write(chunk.tobytes())
+            written += len(chunk)
+    return written
+
+
+def _as_words(chunk):
+    """Returns the chunk as an 'array' of unsigned 64-bit integers, copying
+       buffers of 64-bit integers (such as NumPy arrays) all at once
+    """
+    try:
+        view = memoryview(chunk)
+    except TypeError:
+        return array('Q', chunk)
+    with view:
+        if view.itemsize != 8 or view.format[-1:] not in 'qQlL':
+            return array('Q', chunk)
+        words = array('Q')
+        words.frombytes(view.tobytes())
+        return words
+
+
+def _mark_writes(refs, writes):
+    """Yields the references with the 'WRITE_BIT' set on writes"""
+    for r in refs:
+        if isinstance(r, int):
+            yield r | WRITE_BIT if next(writes) else r
+        else:
+            yield array('Q', (x | WRITE_BIT if next(writes) else x
+                              for x in r))
+
+
+READERS = {
+    'din': read_din,
+    'lackey': read_lackey,
+    'binary': read_binary,
+}
+
+
+def read_trace(path, fmt=None, chunk_size=CHUNK_SIZE, **kwargs):
+    """Yields chunks of addresses from the trace in the given format
+       (guessed from the file name if it's not given)
+    """
+    if fmt is None:
+        fmt = guess_format(path)
+    if fmt not in READERS:
+        raise ValueError('Unknown trace format given: '+fmt)
+    return READERS[fmt](path, chunk_size=chunk_size, **kwargs)
+
+
+def replay_trace(cache, path, fmt=None, chunk_size=CHUNK_SIZE, **kwargs):
+    """Replays the whole trace on the given cache chunk by chunk,
+       and returns how many references were accessed
+    """
+    count = 0
+    for chunk, writes in read_trace(path, fmt, chunk_size,
+                                    kinds=True, **kwargs):
+        cache.replay(chunk, writes=writes)
+        count += len(chunk)
+    return count
+
+
+if __name__ == '__main__':
+    from memory import Cache
+
+    if len(sys.argv) < 2:
+        print('usage:', sys.argv[0], 'TRACE [FORMAT]')
+        sys.exit(1)
+
+    c = Cache(16, 1024, 4, 'lru')
+    n = replay_trace(c, sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print(n, 'references replayed on', c)
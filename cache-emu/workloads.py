@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+"""Synthetic workloads, which generate huge traces of the access patterns
+   most programs are made of, so that policies can be compared at scale
+   without having to capture real traces.
+
+   Every generator works out the addresses of many references at once with
+   NumPy and yields them in chunks of up to 'chunk_size', exactly as the
+   trace readers do: arrays of addresses, or (addresses, writes) if 'kinds'
+   is True, 'writes' being an array with 1 for every write. They can then be
+   replayed chunk by chunk ('replay'), gathered into a single (or an already
+   allocated) array ('collect') or streamed to a binary trace ('save').
+
+   The workloads are:
+   * 'strided'       : walks an array with a constant stride, wrapping around.
+   * 'uniform'       : elements chosen uniformly at random.
+   * 'zipf'          : elements chosen following Zipf's law, a few being hot.
+   * 'pointer_chase' : follows a linked list whose nodes are scattered at
+                       random, visiting all of them in a single cycle.
+   * 'stencil'       : a 5-point Jacobi stencil over a grid, which reads the
+                       neighbours of every cell and writes it on another grid.
+   * 'matmul'        : multiplies two square matrices, with the naive loops
+                       or blocked in tiles.
+
+   Addresses are in words, and 'element' words make up every element of
+   the workloads that choose them (so that several don't share a block).
+"""
+import numpy as np
+
+from traces import CHUNK_SIZE, WRITE_BIT, write_binary
+
+
+def _emit(pieces, chunk_size, kinds):
+    """Yields the (refs, writes) pieces (where 'writes' may be None) in
+       chunks of 'chunk_size', joining small pieces and splitting big ones
+    """
+    pending = []
+    count = 0
+    for refs, writes in pieces:
+        if writes is None:
+            writes = np.zeros(len(refs), dtype=np.uint8)
+        pending.append((refs, writes))
+        count += len(refs)
+        if count < chunk_size:
+            continue
+
+        refs = np.concatenate([p[0] for p in pending])
+        writes = np.concatenate([p[1] for p in pending])
+        end = len(refs) - len(refs) % chunk_size
+        for start in range(0, end, chunk_size):
+            stop = start + chunk_size
+            yield (refs[start:stop], writes[start:stop]) if kinds \
+                else refs[start:stop]
+        pending = [(refs[end:], writes[end:])]
+        count = len(refs) - end
+
+    if count:
+        refs = np.concatenate([p[0] for p in pending])
+        writes = np.concatenate([p[1] for p in pending])
+        yield (refs, writes) if kinds else refs
+
+
+def _positions(n, chunk_size):
+    """Yields the positions of the references in chunks"""
+    for start in range(0, n, chunk_size):
+        yield np.arange(start, min(start + chunk_size, n), dtype=np.int64)
+
+
+def strided(n, stride=1, size=None, base=0, chunk_size=CHUNK_SIZE,
+            kinds=False):
+    """n      = how many references to generate
+       stride = words between consecutive references
+       size   = size of the array (in words) to wrap around, if any
+       base   = address of the first reference
+    """
+    def pieces():
+        for i in _positions(n, chunk_size):
+            offsets = i * stride
+            if size:
+                offsets %= size
+            yield offsets + base, None
+
+    return _emit(pieces(), chunk_size, kinds)
+
+
+def uniform(n, size, element=1, base=0, seed=None, chunk_size=CHUNK_SIZE,
+            kinds=False):
+    """n    = how many references to generate
+       size = how many elements there are to choose from
+       seed = seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+
+    def pieces():
+        for i in _positions(n, chunk_size):
+            yield rng.integers(0, size, len(i)) * element + base, None
+
+    return _emit(pieces(), chunk_size, kinds)
+
+
+def zipf(n, size, alpha=1.0, element=1, base=0, scatter=True, seed=None,
+         chunk_size=CHUNK_SIZE, kinds=False):
+    """n       = how many references to generate
+       size    = how many elements there are to choose from
+       alpha   = exponent of the distribution, the k-th most used element
+                 being chosen with probability proportional to 1 / k**alpha
+       scatter = place the elements at random instead of by popularity
+       seed    = seed of the random generator
+    """
+    if size < 1:
+        raise ValueError('At least one element is required')
+
+    rng = np.random.default_rng(seed)
+    cdf = np.cumsum(np.arange(1, size + 1, dtype=np.float64) ** -alpha)
+    cdf /= cdf[-1]
+    if scatter:
+        places = rng.permutation(size)
+
+    def pieces():
+        for i in _positions(n, chunk_size):
+            ranks = np.searchsorted(cdf, rng.random(len(i)), side='right')
+            np.minimum(ranks, size - 1, out=ranks)
+            if scatter:
+                ranks = places[ranks]
+            yield ranks * element + base, None
+
+    return _emit(pieces(), chunk_size, kinds)
+
+
+def pointer_chase(n, nodes, element=1, base=0, seed=None,
+                  chunk_size=CHUNK_SIZE, kinds=False):
+    """n     = how many references (nodes visited) to generate
+       nodes = how many nodes the list has
+       seed  = seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    # Every node points to the next one in this order, and the last one
+    # back to the first, so the list is a single cycle over all of them
+    order = rng.permutation(nodes) * element + base
+
+    def pieces():
+        for i in _positions(n, chunk_size):
+            yield order[i % nodes], None
+
+    return _emit(pieces(), chunk_size, kinds)
+
+
+def stencil(rows, cols, iterations=1, element=1, a=0, b=None,
+            chunk_size=CHUNK_SIZE, kinds=False):
+    """rows, cols  = size of the grids, stored by rows
+       iterations  = how many times the grid is swept, swapping the grids
+                     after every sweep
+       a, b        = addresses of both grids ('b' follows 'a' by default)
+
+       Every inner cell reads the cell above, left, itself, right and below
+       on one grid, and then writes itself on the other.
+    """
+    if rows < 3 or cols < 3:
+        raise ValueError('The grids must be at least 3 by 3')
+    if b is None:
+        b = a + rows * cols * element
+
+    j = np.arange(1, cols - 1, dtype=np.int64)
+    around = np.array([-cols, -1, 0, 1, cols], dtype=np.int64)
+    kinds_row = np.tile(np.array([0, 0, 0, 0, 0, 1], dtype=np.uint8),
+                        len(j))
+    # Several rows are generated at once, up to about a chunk
+    step = max(1, chunk_size // (6 * len(j)))
+
+    def pieces():
+        src, dst = a, b
+        for _ in range(iterations):
+            for first in range(1, rows - 1, step):
+                i = np.arange(first, min(first + step, rows - 1),
+                              dtype=np.int64)
+                cells = (i[:, None] * cols + j[None, :])[:, :, None]
+                reads = src + (cells + around) * element
+                write = dst + cells * element
+                refs = np.concatenate([reads, write], axis=2).ravel()
+                yield refs, np.tile(kinds_row, len(i))
+            src, dst = dst, src
+
+    return _emit(pieces(), chunk_size, kinds)
+
+
+def matmul(n, block=None, element=1, a=0, b=None, c=None,
+           chunk_size=CHUNK_SIZE, kinds=False):
+    """n       = size of the square matrices, stored by rows
+       block   = size of the tiles to block the loops in, or None for the
+                 naive 'i, j, k' loops
+       a, b, c = addresses of the matrices, for 'C = A·B' (each follows
+                 the previous one by default)
+
+       For every element of 'C' (within the tile), it's read, the row of
+       'A' and column of 'B' (within the tile) are read alternately, and
+       then it's written.
+    """
+    if b is None:
+        b = a + n * n * element
+    if c is None:
+        c = b + n * n * element
+    if not block:
+        block = n
+
+    def tile(i, j, k):
+        """References of 'C[i, j] += A[i, k] · B[k, j]' over the ranges"""
+        i = i[:, None, None]
+        j = j[None, :, None]
+        k = k[None, None, :]
+        shape = (i.shape[0], j.shape[1], k.shape[2])
+        inner = np.empty(shape + (2,), dtype=np.int64)
+        inner[..., 0] = a + (i * n + k) * element
+        inner[..., 1] = b + (k * n + j) * element
+        inner = inner.reshape(shape[0], shape[1], 2 * shape[2])
+        target = np.broadcast_to(c + (i * n + j) * element,
+                                 shape[:2] + (1,))
+        refs = np.concatenate([target, inner, target], axis=2)
+        writes = np.zeros(refs.shape, dtype=np.uint8)
+        writes[..., -1] = 1
+        return refs.ravel(), writes.ravel()
+
+    # Naive loops generate several rows at once, up to about a chunk
+    rows = max(1, chunk_size // (n * (2 * n + 2))) if block >= n else block
+    ranges = [np.arange(s, min(s + block, n), dtype=np.int64)
+              for s in range(0, n, block)]
+
+    def pieces():
+        if block >= n:
+            k = np.arange(n, dtype=np.int64)
+            for first in range(0, n, rows):
+                i = np.arange(first, min(first + rows, n), dtype=np.int64)
+                yield tile(i, k, k)
+            return
+
+        for i in ranges:
+            for j in ranges:
+                for k in ranges:
+                    yield tile(i, j, k)
+
+    return _emit(pieces(), chunk_size, kinds)
+
+
+WORKLOADS = {
+    'strided': strided,
+    'uniform': uniform,
+    'zipf': zipf,
+    'pointer_chase': pointer_chase,
+    'stencil': stencil,
+    'matmul': matmul,
+}
+
+
+def collect(chunks, out=None, writes=None):
+    """Gathers the chunks of a workload into a single array, returning it.
+
+       If 'out' is given, the references are placed there instead (raising
+       'ValueError' if they don't fit) and the part filled is returned.
+       Chunks with writes are gathered as (refs, writes), into 'writes'
+       as well if given.
+    """
+    if out is None:
+        chunks = list(chunks)
+        if chunks and isinstance(chunks[0], tuple):
+            return (np.concatenate([c[0] for c in chunks]),
+                    np.concatenate([c[1] for c in chunks]))
+        return np.concatenate(chunks) if chunks \
+            else np.empty(0, dtype=np.int64)
+
+    filled = 0
+    kinds = False
+    for chunk in chunks:
+        if isinstance(chunk, tuple):
+            chunk, chunk_writes = chunk
+            kinds = True
+            if writes is not None:
+                writes[filled:filled + len(chunk)] = chunk_writes
+        if filled + len(chunk) > len(out):
+            raise ValueError('The workload does not fit in the buffer')
+        out[filled:filled + len(chunk)] = chunk
+        filled += len(chunk)
+
+    if kinds and writes is not None:
+        return out[:filled], writes[:filled]
+    return out[:filled]
+
+
+def save(path, chunks, compress=None):
+    """Streams the chunks of a workload to a binary trace (see
+       'traces.write_binary'), returning how many references were written
+    """
+    def marked():
+        for chunk in chunks:
+            if isinstance(chunk, tuple):
+                refs, writes = chunk
+                chunk = refs.astype(np.uint64)
+                chunk[writes.astype(bool)] |= np.uint64(WRITE_BIT)
+            yield chunk
+
+    return write_binary(path, marked(), compress)
+
+
+def replay(cache, chunks):
+    """Replays every chunk of a workload on the given cache, and returns
+       how many references were accessed
+    """
+    count = 0
+    for chunk in chunks:
+        if isinstance(chunk, tuple):
+            cache.replay(chunk[0], writes=chunk[1])
+            count += len(chunk[0])
+        else:
+            cache.replay(chunk)
+            count += len(chunk)
+    return count
+
+
+if __name__ == '__main__':
+    from memory import Cache
+
+    workloads = [
+        ('strided', strided(1 << 20, stride=4, size=6000)),
+        ('uniform', uniform(1 << 20, 1 << 14, seed=1)),
+        ('zipf', zipf(1 << 20, 1 << 16, seed=1)),
+        ('pointer_chase', pointer_chase(1 << 20, 1200, element=8, seed=1)),
+        ('stencil', stencil(256, 256, 4, kinds=True)),
+        ('matmul', matmul(128, kinds=True)),
+        ('matmul (blocked)', matmul(128, block=16, kinds=True)),
+    ]
+    for name, chunks in workloads:
+        refs = collect(chunks)
+        print('{} ({} references):'.format(
+            name, len(refs[0] if isinstance(refs, tuple) else refs)))
+        for policy in ('lru', 'fifo', 'srrip'):
+            c = Cache(8, 1024, 8, policy)
+            replay(c, [refs])
+            print(' ', c)
@@ -1,6 +1,36 @@
 #!/usr/bin/python3
+import mmap
+import os
+import struct
 from bisect import bisect_left, bisect_right
-from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import compress, islice
+from math import isqrt, log
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# How many odd numbers are sieved at once, so that a segment (one byte
+# for each of them) fits comfortably in the L2 cache
+SEGMENT_SIZE = 1 << 18
+
+# Miller–Rabin with these bases tells apart every prime below 2**64
+# (found by Jim Sinclair), so no number below that needs more work
+MILLER_RABIN_BASES = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+
+# Primes tried before anything else, which discards most composites
+TRIAL_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53,
+                59, 61, 67, 71, 73, 79, 83, 89, 97)
 
 
 def is_safe_prime(n):
@@ -12,23 +42,646 @@ def is_safe_prime(n):
 
     if n % 2 == 0:
         return False
-    for i in range(3, n, 2):
+    for i in range(3, isqrt(n) + 1, 2):
         if n % i == 0:
             return False
 
     return True
 
 
+def miller_rabin(n, bases):
+    """Strong probable prime test of an odd n > 2 to the given bases"""
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for a in bases:
+        a %= n
+        if a == 0:
+            continue
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def jacobi(a, n):
+    """The Jacobi symbol (a/n) of an odd positive n"""
+    a %= n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def strong_lucas(n):
+    """Strong Lucas probable prime test of an odd n > 2 which is not a
+       perfect square, with the parameters chosen by Selfridge's method"""
+    # The first of 5, -7, 9, -11… for which (D/n) is -1
+    D = 5
+    while True:
+        j = jacobi(D, n)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != n:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+        if D == -15 and isqrt(n)**2 == n:
+            # Perfect squares would never find one
+            return False
+
+    P = 1
+    Q = (1 - D) // 4
+    d = n + 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    def half(x):
+        # x / 2 modulo n
+        x %= n
+        return (x if x % 2 == 0 else x + n) // 2
+
+    # U(k), V(k) and Q^k, going through the bits of d from the top
+    U, V, Qk = 1, P, Q % n
+    for bit in bin(d)[3:]:
+        U, V = U * V % n, (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if bit == '1':
+            U, V = half(P * U + V), half(D * U + P * V)
+            Qk = Qk * Q % n
+
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if V == 0:
+            return True
+    return False
+
+
+def is_prime(n):
+    """Tells whether n is prime. Below 2**64 it's always right, and above
+       it uses the Baillie–PSW test, for which no mistake is known"""
+    if n < 2:
+        return False
+    for p in TRIAL_PRIMES:
+        if n % p == 0:
+            return n == p
+    if n < TRIAL_PRIMES[-1]**2:
+        return True
+
+    if n < 1 << 64:
+        return miller_rabin(n, MILLER_RABIN_BASES)
+    return miller_rabin(n, (2,)) and strong_lucas(n)
+
+
+def small_primes(limit):
+    """Returns the odd primes up to (and including) limit, with a plain
+       sieve of Eratosthenes over the odd numbers"""
+    if limit < 3:
+        return []
+    # sieve[i] tells whether 2i + 1 is prime
+    size = (limit + 1) // 2
+    sieve = bytearray([1]) * size
+    sieve[0] = 0
+    for i in range(1, (isqrt(limit) + 1) // 2):
+        if sieve[i]:
+            p = 2*i + 1
+            start = p*p // 2
+            sieve[start::p] = bytes(len(range(start, size, p)))
+    return list(compress(range(1, limit + 1, 2), sieve))
+
+
+def _first_multiple(p, low):
+    """Index of the first odd multiple of p to cross out on the segment
+       of odd numbers starting at low (which is odd)"""
+    m = max(p*p, (low + p - 1) // p * p)
+    if m % 2 == 0:
+        m += p
+    return (m - low) // 2
+
+
+def segments(start=0, stop=None, segment_size=SEGMENT_SIZE):
+    """Yields lists with the primes in [start, stop) (forever if there is
+       no stop), one segment at a time, by using a segmented sieve of
+       Eratosthenes over the odd numbers only.
+
+       Only the primes up to the square root of the numbers reached are
+       kept, so the memory used is bounded by the size of the segments
+       plus those, no matter how far the primes go."""
+    if start <= 2 and (stop is None or stop > 2):
+        yield [2]
+    for low, sieve in _sieve(start, stop, segment_size):
+        if np is not None:
+            yield (np.flatnonzero(sieve) * 2 + low).tolist()
+        else:
+            yield list(compress(range(low, low + 2*len(sieve), 2), sieve))
+
+
+def _sieve(start, stop, segment_size, primes=None):
+    """Yields (low, sieve) for every segment of odd numbers in [start,
+       stop), where sieve[i] tells whether low + 2i is prime. The odd
+       primes up to the square root of stop may be given if known"""
+    # Segments start at an odd number and cover 'segment_size' odd numbers
+    low = max(start, 1) | 1
+    # The odd primes used to cross out, up to the square root of 'limit',
+    # and the index of their next multiple relative to the segment
+    if primes is None:
+        limit = 0
+        primes = []
+        nexts = []
+    else:
+        limit = stop
+        nexts = [_first_multiple(p, low) for p in primes]
+    zeros = memoryview(bytes(segment_size))
+    while stop is None or low < stop:
+        size = segment_size
+        if stop is not None:
+            size = min(size, (stop - low + 1) // 2)
+        high = low + 2*size
+        if limit * limit < high:
+            # Need more primes to cross out the numbers of this segment
+            old = len(primes)
+            limit = max(2*limit, isqrt(high) + 1)
+            primes = small_primes(limit)
+            nexts = nexts[:old] + [_first_multiple(p, low)
+                                   for p in primes[old:]]
+
+        if np is not None:
+            sieve = np.ones(size, dtype=bool)
+            _cross_out_numpy(sieve, size, primes, nexts)
+        else:
+            sieve = bytearray([1]) * size
+            for i, p in enumerate(primes):
+                j = nexts[i]
+                if j < size:
+                    count = (size - 1 - j) // p + 1
+                    sieve[j::p] = zeros[:count]
+                    j += count * p
+                nexts[i] = j - size
+
+        if low == 1:
+            # 1 is not prime, but it's not crossed out by any other prime
+            sieve[0] = 0
+        yield low, sieve
+        low = high
+
+
+def _cross_out_numpy(sieve, size, primes, nexts):
+    """Crosses out the multiples of the primes on the sieve segment,
+       updating 'nexts' for the next segment"""
+    # Small primes have many multiples, and slicing is the fastest way to
+    # cross them out. Larger primes have few multiples in the segment, so
+    # it's faster to cross out all of their next multiples at once.
+    split = bisect_left(primes, size // 16)
+    for i in range(split):
+        p = primes[i]
+        j = nexts[i]
+        if j < size:
+            sieve[j::p] = False
+            j += ((size - 1 - j) // p + 1) * p
+        nexts[i] = j - size
+
+    if split == len(primes):
+        return
+    ps = np.array(primes[split:], dtype=np.int64)
+    js = np.array(nexts[split:], dtype=np.int64)
+    hit = js < size
+    while hit.any():
+        sieve[js[hit]] = False
+        js[hit] += ps[hit]
+        hit = js < size
+    nexts[split:] = (js - size).tolist()
+
+
+# Odd numbers sieved by every task of 'primes_in_range' (a few segments, so
+# that sending the primes back is cheap compared to finding them)
+RANGE_TASK_SIZE = 32 * SEGMENT_SIZE
+
+# The base primes of the range being sieved, in every worker process
+_range_primes = None
+
+
+def _set_range_primes(primes):
+    global _range_primes
+    _range_primes = primes
+
+
+def _range_task(start, stop):
+    """Returns the odd primes in [start, stop), crossing out with the base
+       primes given to the worker"""
+    found = []
+    for low, sieve in _sieve(start, stop, SEGMENT_SIZE, _range_primes):
+        if np is not None:
+            found.append(np.flatnonzero(sieve) * 2 + low)
+        else:
+            found.extend(compress(range(low, low + 2*len(sieve), 2), sieve))
+    if np is not None:
+        return np.concatenate(found) if found else np.empty(0, np.int64)
+    return found
+
+
+def range_segments(a, b, processes=None, task_size=RANGE_TASK_SIZE):
+    """Yields lists with the primes in [a, b] (both included), in order,
+       one task at a time. The tasks are sieved in parallel by a pool of
+       'processes' workers (as many as CPUs by default), all of them using
+       the same odd primes up to the square root of b, so the window never
+       has to be sieved from zero.
+
+       Only a few tasks are in flight ahead of the one being yielded, so
+       the memory used stays bounded however wide the window is."""
+    if b < 2 or a > b:
+        return
+    if a <= 2:
+        yield [2]
+    stop = b + 1
+    base = small_primes(isqrt(b))
+    tasks = [(low, min(low + 2*task_size, stop))
+             for low in range(max(a, 1) | 1, stop, 2*task_size)]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(tasks) == 1:
+        # Not worth starting any worker
+        _set_range_primes(base)
+        for low, high in tasks:
+            primes = _range_task(low, high)
+            yield primes.tolist() if np is not None else primes
+        return
+
+    with ProcessPoolExecutor(processes, initializer=_set_range_primes,
+                             initargs=(base,)) as pool:
+        pending = deque()
+        tasks = iter(tasks)
+        for low, high in islice(tasks, 2 * processes):
+            pending.append(pool.submit(_range_task, low, high))
+        while pending:
+            primes = pending.popleft().result()
+            for low, high in islice(tasks, 1):
+                pending.append(pool.submit(_range_task, low, high))
+            yield primes.tolist() if np is not None else primes
+
+
+def iprimes_in_range(a, b, processes=None):
+    """Yields every prime in [a, b] (both included) in order, sieving the
+       range in parallel as 'range_segments' does"""
+    for segment in range_segments(a, b, processes):
+        yield from segment
+
+
+def primes_in_range(a, b, processes=None):
+    """Returns a list with the primes in [a, b] (both included), sieving
+       the range in parallel as 'range_segments' does"""
+    result = []
+    for segment in range_segments(a, b, processes):
+        result.extend(segment)
+    return result
+
+
+def prime_pi(x):
+    """How many primes there are up to (and including) x, counted with
+       Lucy_Hedgehog's method in about x**(3/4) steps without finding them.
+
+       S(v) starts as every number in [2, v], and sieving by every prime p
+       up to the square root of x removes the numbers whose smallest factor
+       is p: S(v) -= S(v // p) - S(p - 1). Only the values x // i are ever
+       needed, which are the v up to the square root ('small') and x // i
+       for the i up to it ('large')."""
+    if x < 2:
+        return 0
+    r = isqrt(x)
+    primes = [2] + small_primes(r)
+    if np is not None and x < 1 << 63:
+        return _prime_pi_numpy(x, r, primes)
+
+    small = [max(v - 1, 0) for v in range(r + 1)]
+    large = [0] + [x // i - 1 for i in range(1, r + 1)]
+    # Below p, S(p - 1) is already how many primes there are (k of them)
+    for k, p in enumerate(primes):
+        end = min(r, x // (p*p))
+        for i in range(1, end + 1):
+            d = i * p
+            large[i] -= (large[d] if d <= r else small[x // d]) - k
+        for v in range(r, p*p - 1, -1):
+            small[v] -= small[v // p] - k
+    return large[1]
+
+
+def _prime_pi_numpy(x, r, primes):
+    """'prime_pi' updating every value for the same prime at once, which
+       is fine since each of them only depends on values not yet updated"""
+    small = np.arange(-1, r, dtype=np.int64)
+    small[0] = 0
+    large = np.zeros(r + 1, dtype=np.int64)
+    large[1:] = x // np.arange(1, r + 1, dtype=np.int64) - 1
+    for k, p in enumerate(primes):
+        end = min(r, x // (p*p))
+        inside = min(end, r // p)
+        values = np.empty(end, dtype=np.int64)
+        values[:inside] = large[p:inside*p + 1:p]
+        values[inside:] = small[x // np.arange((inside + 1) * p,
+                                               end*p + 1, p, dtype=np.int64)]
+        large[1:end + 1] -= values - k
+        if p*p <= r:
+            v = np.arange(p*p, r + 1, dtype=np.int64)
+            small[p*p:] -= small[v // p] - k
+    return int(large[1])
+
+
+def nth_prime(n):
+    """The n-th prime (the 1st being 2), found without enumerating the
+       primes before it: the estimate from the prime number theorem is
+       corrected with 'prime_pi' and the primes left are sieved"""
+    if n < 1:
+        raise ValueError('There is no prime number '+str(n))
+    if n < 6:
+        return (2, 3, 5, 7, 11)[n - 1]
+
+    # Cipolla's approximation, within a fraction of a percent
+    ln = log(n)
+    lnln = log(ln)
+    x = int(n * (ln + lnln - 1 + (lnln - 2) / ln))
+    count = prime_pi(x)
+    if abs(count - n) > 1000:
+        # One step of Newton's method, primes being 1 / log(x) apart
+        x += int((n - count) * log(x))
+        count = prime_pi(x)
+
+    if count < n:
+        # Sieve forward from x until the prime is reached
+        for segment in segments(x + 1):
+            if count + len(segment) >= n:
+                return segment[n - count - 1]
+            count += len(segment)
+
+    # Sieve backward from x, a window at a time
+    width = max(int(2 * (count - n + 1) * log(x)), 2 * SEGMENT_SIZE)
+    while True:
+        low = max(x - width + 1, 2)
+        window = [p for segment in segments(low, x + 1) for p in segment]
+        if count - len(window) < n:
+            return window[n - (count - len(window)) - 1]
+        count -= len(window)
+        x = low - 1
+
+
+# Every block of a prime table has how many primes there are below it
+# (counting 2, which has no bit) and then a bit for every odd number
+TABLE_BLOCK_BYTES = 248
+TABLE_BLOCK_NUMBERS = TABLE_BLOCK_BYTES * 16
+_TABLE_BLOCK = 8 + TABLE_BLOCK_BYTES
+_TABLE_COUNT = struct.Struct('<Q')
+_TABLE_HEADER = struct.Struct('<4sBxxxIxxxx')
+_TABLE_MAGIC = b'PTBL'
+_TABLE_VERSION = 1
+
+# To turn bytes with 0 or 1 into bits and back through binary strings
+_TO_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+_FROM_DIGITS = bytes.maketrans(b'01', b'\x00\x01')
+
+
+def _pack(sieve):
+    """Packs a sieve segment (whose length is a multiple of 8) into bits,
+       the lowest bit of every byte being the first number"""
+    if np is not None:
+        return np.packbits(sieve, bitorder='little').tobytes()
+    digits = bytes(sieve).translate(_TO_DIGITS)[::-1]
+    return int(digits, 2).to_bytes(len(sieve) // 8, 'little')
+
+
+def _unpack(bits):
+    """Unpacks the bits into bytes with 0 or 1, the inverse of '_pack'"""
+    if np is not None:
+        return np.unpackbits(np.frombuffer(bits, dtype=np.uint8),
+                             bitorder='little')
+    digits = bin(int.from_bytes(bits, 'little'))[:1:-1].encode()
+    return digits.translate(_FROM_DIGITS).ljust(8 * len(bits), b'\x00')
+
+
+def _popcount(bits):
+    return bin(int.from_bytes(bits, 'little')).count('1')
+
+
+class PrimeTable:
+    """The primes below 'limit', kept on a file with a bit for every odd
+       number, in blocks that start with how many primes come before them
+       so that any of them can be found without counting from the start.
+       The file is mapped in memory, so several processes can share the
+       same table (and the pages cached by the system), and it's extended
+       in place when primes past the end are needed."""
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.blocks = 0
+        self.limit = 0
+        self._length = 0
+        self._map = None
+        self._cached = None
+        with self._locked() as f:
+            if not os.fstat(f.fileno()).st_size:
+                f.write(_TABLE_HEADER.pack(_TABLE_MAGIC, _TABLE_VERSION,
+                                           TABLE_BLOCK_BYTES))
+
+        self._file = open(path, 'rb')
+        magic, version, block_bytes = _TABLE_HEADER.unpack(
+            self._file.read(_TABLE_HEADER.size))
+        if magic != _TABLE_MAGIC:
+            raise ValueError('Not a prime table: '+str(path))
+        if version != _TABLE_VERSION or block_bytes != TABLE_BLOCK_BYTES:
+            raise ValueError('Unsupported prime table: '+str(path))
+
+        self._remap()
+        if limit:
+            self.extend(limit)
+
+    @contextmanager
+    def _locked(self):
+        """Opens the file to append to it, and only one process at a time"""
+        with open(self.path, 'ab') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+
+    def _remap(self):
+        """Maps every block that the file has, which another process may
+           have added since"""
+        size = os.fstat(self._file.fileno()).st_size
+        blocks = (size - _TABLE_HEADER.size) // _TABLE_BLOCK
+        if blocks == self.blocks:
+            return
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(),
+                              _TABLE_HEADER.size + blocks * _TABLE_BLOCK,
+                              access=mmap.ACCESS_READ)
+        self.blocks = blocks
+        self.limit = blocks * TABLE_BLOCK_NUMBERS
+        self._length = self._count(blocks - 1) \
+            + _popcount(self._bits(blocks - 1)) if blocks else 0
+        self._cached = None
+
+    def _count(self, block):
+        """How many primes there are below the block"""
+        return _TABLE_COUNT.unpack_from(
+            self._map, _TABLE_HEADER.size + block * _TABLE_BLOCK)[0]
+
+    def _bits(self, block, end=TABLE_BLOCK_BYTES):
+        """The bytes of the block, up to 'end'"""
+        start = _TABLE_HEADER.size + block * _TABLE_BLOCK + 8
+        return self._map[start:start + end]
+
+    def extend(self, limit):
+        """Sieves the numbers up to 'limit' (rounded up to whole blocks)
+           and appends them to the table, if it didn't have them"""
+        if limit <= self.limit:
+            return
+        with self._locked() as f:
+            self._remap()
+            if limit <= self.limit:
+                return
+
+            end = -(-limit // TABLE_BLOCK_NUMBERS) * TABLE_BLOCK_NUMBERS
+            count = max(len(self), 1)
+            pending = bytearray()
+            for _, sieve in _sieve(self.limit, end, SEGMENT_SIZE):
+                pending += _pack(sieve)
+                full = len(pending) - len(pending) % TABLE_BLOCK_BYTES
+                blocks = bytearray()
+                for i in range(0, full, TABLE_BLOCK_BYTES):
+                    bits = pending[i:i + TABLE_BLOCK_BYTES]
+                    blocks += _TABLE_COUNT.pack(count)
+                    blocks += bits
+                    count += _popcount(bits)
+                f.write(blocks)
+                del pending[:full]
+        self._remap()
+
+    def __len__(self):
+        return self._length
+
+    def count(self, n):
+        """How many primes there are below n, extending the table if it
+           doesn't reach n"""
+        if n <= 2:
+            return 0
+        self.extend(n)
+        block, offset = divmod(n, TABLE_BLOCK_NUMBERS)
+        if block == self.blocks:
+            return len(self)
+        # Only the odd numbers below n count
+        odds = offset // 2
+        bits = int.from_bytes(self._bits(block, (odds + 7) // 8), 'little')
+        return self._count(block) \
+            + bin(bits & ((1 << odds) - 1)).count('1')
+
+    def __contains__(self, n):
+        if n < 3:
+            return n == 2
+        if n % 2 == 0:
+            return False
+        if n >= self.limit:
+            return is_prime(n)
+        block, offset = divmod(n, TABLE_BLOCK_NUMBERS)
+        i = offset // 2
+        return bool(self._bits(block, i // 8 + 1)[-1] >> (i % 8) & 1)
+
+    def _block(self, block):
+        """The primes in the block (decoded once for several lookups)"""
+        if self._cached is None or self._cached[0] != block:
+            base = block * TABLE_BLOCK_NUMBERS + 1
+            primes = list(compress(
+                range(base, base + TABLE_BLOCK_NUMBERS, 2),
+                _unpack(self._bits(block))))
+            self._cached = block, self._count(block), primes
+        return self._cached[2]
+
+    def __getitem__(self, i):
+        """The i-th prime (2 being the 0th) of the table"""
+        if i < 0:
+            i += self._length
+        if i < 0 or i >= self._length:
+            raise IndexError('prime table index out of range')
+        if i == 0:
+            return 2
+
+        if self._cached is not None:
+            # Most lookups are close to the previous one
+            _, first, primes = self._cached
+            if first <= i < first + len(primes):
+                return primes[i - first]
+
+        # Binary search for the last block with at most i primes below
+        lo, hi = 0, self.blocks
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._count(mid) <= i:
+                lo = mid
+            else:
+                hi = mid
+        return self._block(lo)[i - self._cached[1]]
+
+    def __iter__(self):
+        if self.blocks:
+            yield 2
+        for block in range(self.blocks):
+            yield from self._block(block)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class primeseq:
-    def __init__(self, initial_buffer_size=None):
+    def __init__(self, initial_buffer_size=None, table=None):
         self._i = -1
-        self._e = primeseq.eratosthenes()
-        if initial_buffer_size:
-            self._buffer = [next(self._e) for _ in range(initial_buffer_size)]
-            self._buffersize = initial_buffer_size
+        # The buffer is filled a whole segment of the sieve at a time,
+        # unless it's a 'PrimeTable' (or the path to one) on disk
+        self._segments = segments()
+        if table is None:
+            self._buffer = []
+        elif isinstance(table, PrimeTable):
+            self._buffer = table
+        else:
+            self._buffer = PrimeTable(table)
+        self._buffersize = len(self._buffer)
+        while self._buffersize < (initial_buffer_size or 1):
+            self._grow()
+
+    def _grow(self):
+        """Adds the primes of the next segment to the buffer, or doubles
+           the numbers the table has"""
+        if isinstance(self._buffer, PrimeTable):
+            self._buffer.extend(max(2 * self._buffer.limit,
+                                    TABLE_BLOCK_NUMBERS * 256))
         else:
-            self._buffer = [next(self._e)]
-            self._buffersize = 1
+            self._buffer.extend(next(self._segments))
+        self._buffersize = len(self._buffer)
 
     def __iter__(self):
         self._i = -1
@@ -37,12 +690,25 @@ class primeseq:
     def __next__(self):
         self._i += 1
         if self._i == self._buffersize:
-            p = next(self._e)
-            self._buffer.append(p)
-            self._buffersize += 1
-            return p
-        else:
-            return self._buffer[self._i]
+            self._grow()
+        return self._buffer[self._i]
+
+    def __getitem__(self, i):
+        # The i-th prime (2 being the 0th), straight from the buffer if
+        # it's there, or found on its own (the buffer is left as it is)
+        if i < 0:
+            raise IndexError('primeseq has no end to index from')
+        if i < self._buffersize:
+            return self._buffer[i]
+        return nth_prime(i + 1)
+
+    def pi(self, x):
+        """How many primes there are up to (and including) x"""
+        if self._buffersize and x < self._buffer[-1]:
+            if isinstance(self._buffer, PrimeTable):
+                return self._buffer.count(x + 1)
+            return bisect_right(self._buffer, x, 0, self._buffersize)
+        return prime_pi(x)
 
     def __contains__(self, n):
         # Special cases
@@ -61,58 +727,23 @@ class primeseq:
                 # No need to use binary search at all
                 return True
 
+            if isinstance(self._buffer, PrimeTable):
+                # Straight from its bits
+                return n in self._buffer
+
             # Binary search
             pos = bisect_left(self._buffer, n, 0, self._buffersize)
             return pos != self._buffersize and self._buffer[pos] == n
 
-        # Not in the buffer, so increase it until we have enough primes
-        # to check against n (we may not need to increase it at all)
-        limit = int(n**0.5) + 1
-        if self._buffer[-1] < limit:
-            while self._buffer[-1] < limit:
-                self._buffer.append(next(self._e))
-            self._buffersize = len(self._buffer)
-            # Had to expand until we had just enough, so last is the limit
-            ilimit = self._buffersize
-        else:
-            # We had enough primes in the buffer, so find until which we
-            # should be looking
-            ilimit = bisect_right(self._buffer, limit)
-
-        for p in islice(self._buffer, ilimit):
-            if n % p == 0:
-                return False
-
-        # Nice, we have a new prime
-        return True
+        # Not in the buffer, which would have to grow up to the square
+        # root to trial divide, so test it on its own instead
+        return is_prime(n)
 
     @staticmethod
     def eratosthenes():
-        # Modified version from the second page:
-        # archive.oreilly.com/pub/a/python/excerpt/pythonckbk_chap1/index1.html
-        q = 3
-        D = {}
-        yield 2
-        while True:
-            p = D.pop(q, None)
-            # Check 'if p' instead 'if p is None', which is around 15% faster.
-            if p:
-                # Used to be 'x = p + q', and then 'or x even' in the loop,
-                # implemented as 'or not (x&1)'.
-                #
-                # We know that q is always odd, and p is q*q (where q is odd)
-                # Multiplying an odd number by any other (or even itself) is
-                # always odd. Adding two odds together is always even, so we
-                # always need to add p again, or simply add 2p. ~30% speed-up.
-                p2 = p * 2
-                x = p2 + q
-                while x in D:
-                    x += p2
-                D[x] = p
-            else:
-                yield q
-                D[q*q] = q
-            q += 2
+        # Every prime, segment by segment, in bounded memory
+        for segment in segments():
+            yield from segment
 
     # Call infprimeseq.unwrap() for a faster iterator, but cannot be
     # reused, and checking whether it contains some element will fail.
@@ -128,4 +759,15 @@ if __name__ == '__main__':
                 print(i, '\tshould     be prime, but is it in ps?:', i in ps)
             else:
                 print(i, '\tshould not be prime, but is it in ps?:', i in ps)
+    for i in range(10**12, 10**12 + 1000):
+        if is_prime(i) != is_safe_prime(i):
+            print(i, '\tis_prime says', is_prime(i), 'but it should not')
+    if primes_in_range(10**12, 10**12 + 1000) != \
+            [i for i in range(10**12, 10**12 + 1001) if is_safe_prime(i)]:
+        print('primes_in_range is wrong around 10**12')
+    ps = primeseq()
+    for n in (1, 10, 1000, 10**5):
+        if ps[n - 1] != nth_prime(n) or ps.pi(ps[n - 1]) != n \
+                or prime_pi(nth_prime(n)) != n:
+            print('prime_pi and nth_prime disagree at', n)
     print('Test done.')